@@ -0,0 +1,58 @@
+"""
+Entry point for the scripts of the data preparation pipeline.
+
+Run from the repo root:
+    python -m main <command> [args]
+runs scripts/run_<command>.py with the remaining arguments, e.g.
+`python -m main pipeline` or `python -m main workqueue local 4`. Without a
+command, the available commands are listed. The source directory is added to
+sys.path here once, before the script is run.
+
+With `python -m main --profile <dir> <command> [args]`, the stages are
+profiled and the collapsed stacks of the run are written to
+<dir>/profile.folded (see src/profiler.py).
+
+Contains:
+  - get_commands: function returning the available commands.
+  - main: function running the script of a command.
+"""
+
+# Standard library
+import runpy
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT/'src'))
+
+
+def get_commands() -> dict[str, Path]:
+    """Returns {command: script path} for all scripts/run_<command>.py."""
+    return {path.stem.removeprefix('run_'): path
+            for path in sorted((ROOT/'scripts').glob('run_*.py'))}
+
+def main(argv: list[str]) -> None:
+    """Runs the script of command argv[0] with arguments argv[1:] as if it
+    was run directly. A leading `--profile <dir>` enables profiling."""
+    if argv[:1] == ['--profile']:
+        if len(argv) < 2:
+            sys.exit('usage: python -m main --profile <dir> <command> [args]')
+        from profiler import enable
+        enable(argv[1])
+        argv = argv[2:]
+
+    commands = get_commands()
+    if not argv or argv[0] not in commands:
+        if argv:
+            print(f'unknown command {argv[0]}')
+        print('usage: python -m main [--profile <dir>] <command> [args]')
+        print(f"commands: {', '.join(commands)}")
+        sys.exit(1 if argv else 0)
+
+    path = commands[argv[0]]
+    sys.argv = [str(path), *argv[1:]]
+    runpy.run_path(str(path), run_name='__main__')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
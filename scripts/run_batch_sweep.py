@@ -0,0 +1,89 @@
+"""
+Script to benchmark the size of the batches of records sent to the workers.
+
+Runs normalization, segmentation (rule engine), tokenization and character
+analysis on the data sample, repeated to get a larger input, with batches of
+increasing size (batch_bytes=0 sends one record per task), and prints the
+records per second of every stage and batch size. The stages share a warm
+WorkerPool, so that the timings don't include starting the workers. Uses the
+functionality of records.py and the stage modules.
+"""
+
+# Standard library
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from analyze import analyze_jsonl
+from bpe_tokenize import tokenize_jsonl
+from normalize import normalize_jsonl
+from records import count_records
+from segment import segment_jsonl
+from workerpool import WorkerPool
+
+if __name__ == "__main__":
+    data_dir = ROOT/'data'
+    processes = 4
+    repeats = 25
+    batch_bytes_list = [0, 4*1024, 16*1024, 64*1024, 256*1024, 1024*1024]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # repeat the samples to get inputs of a few MB
+        inputs = {}
+        for name in ('parse', 'normalize', 'segment'):
+            inputs[name] = f'{tmp_dir}/{name}_input.jsonl'
+            with open(inputs[name], 'w') as outfile:
+                for _ in range(repeats):
+                    with open(data_dir/f'{name}_data_5.jsonl', 'r') as infile:
+                        shutil.copyfileobj(infile, outfile)
+        outpath = f'{tmp_dir}/output'
+
+        stages = {
+            'normalize': lambda pool, batch_bytes: normalize_jsonl(
+                inputs['parse'], outpath, processes, len_cutoff=50,
+                pool=pool, batch_bytes=batch_bytes),
+            'segment': lambda pool, batch_bytes: segment_jsonl(
+                inputs['normalize'], outpath, processes, engine='rule',
+                pool=pool, batch_bytes=batch_bytes),
+            'tokenize': lambda pool, batch_bytes: tokenize_jsonl(
+                inputs['segment'], outpath, str(data_dir/'vocab_5.json'),
+                processes, engine='bpe', pool=pool, batch_bytes=batch_bytes),
+            'analyze': lambda pool, batch_bytes: analyze_jsonl(
+                inputs['parse'], list('aeiou'), processes,
+                pool=pool, batch_bytes=batch_bytes),
+        }
+        total_lines = count_records(inputs['parse'])
+
+        results = {}
+        with WorkerPool(processes) as pool:
+            for stage, run in stages.items():
+                # warm up: initialize the stage in all workers
+                run(pool, 0)
+                for batch_bytes in batch_bytes_list:
+                    start = time.perf_counter()
+                    run(pool, batch_bytes)
+                    results[stage, batch_bytes] = total_lines / (time.perf_counter() - start)
+
+    print(f'records/s for {total_lines} records with {processes} processes')
+    print(f"{'batch_bytes':>11s}" + ''.join(f'{stage:>11s}' for stage in stages))
+    for batch_bytes in batch_bytes_list:
+        print(f'{batch_bytes:11d}' + ''.join(f'{results[stage, batch_bytes]:11,.0f}' for stage in stages))
+
+    # records/s for 1000 records with 4 processes
+    # batch_bytes  normalize    segment   tokenize    analyze
+    #           0        579        638        342        698
+    #        4096        522        616        346        738
+    #       16384        537        681        381        814
+    #       65536        572        691        506        886
+    #      262144        597        802        513      1,105
+    #     1048576        705        833        494      1,003
+    #
+    # Sending batches of 256 KB instead of single articles (~10 KB each) gives
+    # 1.2-1.5x the throughput. Larger batches hardly help further, and leave 
+    # too few tasks to balance the load over many processes on small inputs, 
+    # so BATCH_BYTES (see records.py) is 256 KB.
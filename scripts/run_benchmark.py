@@ -0,0 +1,43 @@
+"""
+Script to benchmark all stages on a synthetic corpus. 
+
+Uses the functionality of benchmark.py, configured by the 'benchmark' section 
+of config/config.yaml. Writes the results (records per second and peak RSS of 
+each stage) as json to the output path, and if a baseline results file is 
+given, exits with an error listing the stages that regressed.
+"""
+
+# Standard library
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from benchmark import compare_results, run_benchmark
+from utils import load_json, load_yaml
+
+if __name__ == "__main__":
+    config = load_yaml(str(ROOT/'config'/'config.yaml'))['benchmark']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = str(ROOT/config['work_dir']) if config['work_dir'] else tmp_dir
+        results = run_benchmark(work_dir, 
+                                config['articles'], 
+                                seed=config['seed'], 
+                                dup_rate=config['dup_rate'], 
+                                jaccard_levels=config['jaccard_levels'], 
+                                params=config['params'])
+
+    with open(ROOT/config['output'], 'w') as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if config['baseline']:
+        regressions = compare_results(results, load_json(str(ROOT/config['baseline'])), 
+                                      config['tolerance'])
+        if regressions:
+            sys.exit('Performance regressions:\n' + '\n'.join(regressions))
+        print('No performance regressions')
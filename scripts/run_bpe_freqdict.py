@@ -19,4 +19,5 @@ if __name__ == "__main__":
 
     # Create and store word frequency dict
     freq_dict_path = str(ROOT/'data'/'freq_dict.jsonl')
-    create_freq_dict_from_jsonl(corpus_path, freq_dict_path, processes=10)
\ No newline at end of file
+    create_freq_dict_from_jsonl(corpus_path, freq_dict_path, processes=10, 
+                                memory_budget_mb=None)  # e.g. 1024, to spill counts to disk
\ No newline at end of file
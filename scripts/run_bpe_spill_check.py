@@ -0,0 +1,54 @@
+"""
+Script to check that spilling the counts of the word frequency dict to disk
+gives the same freq dict, and the same BPE vocab, as counting in memory.
+
+Creates the freq dict of the data sample in memory and with max_words small
+enough that the counts are spilled in several runs, compares the files, and
+trains a vocab of 300 tokens on each (the Vocab breaks ties between pairs by
+the order of the words, so the merges depend on the order of the freq dict).
+Fails if the freq dicts or vocabs differ. Uses the functionality of
+bpe_freqdict.py and bpe_vocab.py.
+"""
+
+# Standard library
+import filecmp
+import sys
+import tempfile
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from bpe_freqdict import create_freq_dict_from_jsonl
+from bpe_vocab import Vocab
+
+RUNS = {'in memory': None, 'spilled': 500}  # max_words
+
+if __name__ == "__main__":
+    corpus_path = str(ROOT/'data'/'segment_data_5.jsonl')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokens = {}
+        for name, max_words in RUNS.items():
+            freq_dict_path = f"{tmp_dir}/{name.replace(' ', '_')}.jsonl"
+            create_freq_dict_from_jsonl(corpus_path, freq_dict_path, processes=2,
+                                        chunk_lines=1, max_words=max_words)
+            vocab = Vocab(freq_dict_path, f"{tmp_dir}/{name.replace(' ', '_')}.json")
+            vocab.increase_vocab(size=300)
+            tokens[name] = vocab.tokens()
+
+        same_freq_dict = filecmp.cmp(f'{tmp_dir}/in_memory.jsonl', f'{tmp_dir}/spilled.jsonl',
+                                     shallow=False)
+    same_vocab = tokens['in memory'] == tokens['spilled']
+    print(f"freq dict {'same' if same_freq_dict else 'DIFFERENT'}")
+    print(f"vocab     {'same' if same_vocab else 'DIFFERENT'}")
+    if not (same_freq_dict and same_vocab):
+        sys.exit('spilling to disk changed the freq dict or vocab')
+    print('spilled freq dict and vocab match those counted in memory')
+
+    # freq dict same
+    # vocab     same
+    # spilled freq dict and vocab match those counted in memory
+    #
+    # Before the spilled words were put back in order of first occurrence, the
+    # spilled freq dict was sorted by word, and the vocabs differed in 2 of the
+    # 300 tokens (and in the ids of 9).
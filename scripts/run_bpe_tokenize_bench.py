@@ -0,0 +1,50 @@
+"""
+Script to benchmark the greedy BPE tokenizer. 
+
+Compares the trie-based greedy tokenizer with the naive implementation on the 
+sentences of segment_data_5.jsonl, and checks that both produce the same 
+tokens. Uses the functionality of bpe_tokenize.py.
+"""
+
+# Standard library
+import json
+import sys
+import time
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from bpe_tokenize import Tokenizer
+
+if __name__ == "__main__":
+    inpath = str(ROOT/'data'/'segment_data_5.jsonl')
+    vocab_path = str(ROOT/'data'/'vocab_5.json')
+    repeats = 5
+
+    sentences = []
+    with open(inpath, 'r') as file:
+        for line in file:
+            for section in json.loads(line)['text_list']:
+                sentences.extend(section)
+    n_chars = sum(len(sentence) for sentence in sentences)
+
+    tokenizer = Tokenizer(vocab_path)
+    results = {}
+    for name, tokenize in [('naive', tokenizer.tokenize_greedy_naive), 
+                           ('trie', tokenizer.tokenize_greedy)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            results[name] = [tokenize(sentence) for sentence in sentences]
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f'{name:5s}: {elapsed:.3f} s  ({n_chars / elapsed:12,.0f} chars/s)')
+
+    assert results['naive'] == results['trie'], 'tokenizations differ'
+    print(f'identical tokenizations of {len(sentences)} sentences')
+
+    # naive: 0.133 s  (   2,740,521 chars/s)
+    # trie : 0.108 s  (   3,358,345 chars/s)
+    # identical tokenizations of 2679 sentences
+    #
+    # The tokens of the 1000-token sample vocab are short; with a vocab of 8000 
+    # tokens (trained on the same sample) the trie is ~1.5x faster than naive.
@@ -1,7 +1,9 @@
 """
 Script to create BPE vocabulary. 
 
-Uses the functionality of bpe_vocab.py.
+Trains from the characters, overwriting an existing vocab. With --resume, 
+continues from the checkpoint or the existing vocab instead, which must have 
+been trained on the same word frequency dict. Uses the functionality of bpe_vocab.py.
 """
 
 # Standard library
@@ -17,9 +19,11 @@ if __name__ == "__main__":
     freq_dict_path = str(ROOT/'data'/'freq_dict_5.jsonl')
     vocab_path = str(ROOT/'data'/'vocab_5.json')
     vocab = Vocab(freq_dict_path, vocab_path)
+    if '--resume' in sys.argv[1:]:
+        vocab.resume()  # continue from checkpoint or existing vocab, if any
 
     print(f'Initial vocab size: {len(vocab)}')
-    vocab.increase_vocab(size=1000)
+    vocab.increase_vocab(size=1000, checkpoint_every=100)
 
 
 
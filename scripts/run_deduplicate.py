@@ -22,6 +22,7 @@ if __name__ == "__main__":
                                 gram_len=5,
                                 signature_len=128,
                                 band_size=16,
-                                similarity_threshold=0.8)
+                                similarity_threshold=0.8,
+                                memory_budget_mb=None)  # e.g. 1024, to use external memory
 
     deduplicator.deduplicate()
\ No newline at end of file
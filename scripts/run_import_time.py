@@ -0,0 +1,78 @@
+"""
+Script to check the import time of the source modules.
+
+Imports each module of src in a fresh interpreter with `python -X importtime`,
+and prints its cumulative import time. Fails if a module imports one of the
+heavy packages which should only be imported when used (see LAZY_IMPORTS),
+e.g. spacy when importing segment.py, or matplotlib when importing utils.py
+to load the config.
+"""
+
+# Standard library
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# packages no module may import at import time, except the modules which
+# always need them
+LAZY_IMPORTS = {
+    'spacy': [],
+    'matplotlib': [],
+    'html5lib': ['crawl'],
+    'bs4': ['crawl'],
+}
+
+def import_time(module: str) -> tuple[float, set[str]]:
+    """Returns cumulative import time of module in seconds, and the set of
+    top-level packages it imports."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=str(ROOT/'src'), capture_output=True, text=True, check=True)
+    total = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        packages.add(name.strip().split('.')[0])
+        if name.strip() == module:
+            total = int(cumulative) / 1e6
+    return total, packages
+
+if __name__ == "__main__":
+    modules = sorted(path.stem for path in (ROOT/'src').glob('*.py'))
+    failures = []
+    for module in modules:
+        total, packages = import_time(module)
+        lazy = [package for package, allowed in LAZY_IMPORTS.items()
+                if package in packages and module not in allowed]
+        print(f'{module:16s} {total:6.3f} s' + (f"  imports {', '.join(lazy)}" if lazy else ''))
+        if lazy:
+            failures.append(module)
+
+    if failures:
+        sys.exit(f"heavy packages imported by {', '.join(failures)}")
+    print('no heavy imports')
+
+    # analyze           0.085 s
+    # bpe_freqdict      0.084 s
+    # bpe_pretokenize   0.000 s
+    # bpe_tokenize      0.174 s
+    # bpe_vocab         0.096 s
+    # crawl             0.211 s
+    # deduplicate       0.151 s
+    # logger            0.048 s
+    # normalize         0.083 s
+    # parse             0.087 s
+    # pipeline          0.183 s
+    # records           0.006 s
+    # segment           0.089 s
+    # utils             0.035 s
+    # workerpool        0.023 s
+    # workqueue         0.243 s
+    # no heavy imports
+    #
+    # Before spacy, bs4 and matplotlib were imported lazily, importing segment 
+    # took 1.0 s, utils 0.96 s, and pipeline and workqueue ~1.0 s.
@@ -0,0 +1,20 @@
+"""
+Script to run the data preparation pipeline end to end. 
+
+Uses the functionality of pipeline.py, configured by the 'pipeline' section of 
+config/config.yaml.
+"""
+
+# Standard library
+import sys
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from pipeline import run_pipeline
+from utils import load_yaml
+
+if __name__ == "__main__":
+    config = load_yaml(str(ROOT/'config'/'config.yaml'))
+    run_pipeline(config['pipeline'])
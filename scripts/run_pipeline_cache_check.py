@@ -0,0 +1,72 @@
+"""
+Script to check that the stage cache of the pipeline gives the same outputs
+as a cold run.
+
+Runs the pipeline (normalize, deduplicate, segment with the rule engine and
+tokenize) on the data sample with a fresh cache_dir, once cold and then warm:
+without taps, and with a tap on each stage, including those whose input is
+not cached (the first stage, and the stage after deduplicate). Fails if an
+output or tap differs from the cold run. Uses the functionality of
+pipeline.py.
+"""
+
+# Standard library
+import filecmp
+import sys
+import tempfile
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from pipeline import run_pipeline
+
+STAGES = ['normalize', 'deduplicate', 'segment', 'tokenize']
+TAPPED = ['normalize', 'deduplicate', 'segment']
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = {
+            'input': str(ROOT/'data'/'parse_data_5.jsonl'),
+            'processes': 2,
+            'shard_lines': 10,
+            'stages': STAGES,
+            'normalize': {'len_cutoff': 50},
+            'deduplicate': {'gram_len': 5, 'signature_len': 128, 'band_size': 16,
+                            'similarity_threshold': 0.8, 'shingle_mode': 'str'},
+            'segment': {'omit_duplicates': True, 'engine': 'rule'},
+            'tokenize': {'vocab_path': str(ROOT/'data'/'vocab_5.json'), 'engine': 'bpe'},
+        }
+
+        # reference outputs without cache
+        run_pipeline({**config, 'output': f'{tmp_dir}/cold.jsonl',
+                      'taps': {stage: f'{tmp_dir}/cold_{stage}.jsonl' for stage in TAPPED}})
+
+        # fill the cache, then warm runs without and with each tap
+        config['cache_dir'] = f'{tmp_dir}/cache'
+        runs = {'fill': {}, 'warm': {}}
+        runs.update({f'warm, tap {stage}': {stage: f'{tmp_dir}/warm_{stage}.jsonl'} for stage in TAPPED})
+        failures = []
+        for name, taps in runs.items():
+            run_pipeline({**config, 'output': f'{tmp_dir}/warm.jsonl', 'taps': taps})
+            same = filecmp.cmp(f'{tmp_dir}/cold.jsonl', f'{tmp_dir}/warm.jsonl', shallow=False)
+            for stage, path in taps.items():
+                same &= filecmp.cmp(f'{tmp_dir}/cold_{stage}.jsonl', path, shallow=False)
+            print(f"{name:24s} {'same' if same else 'DIFFERENT'}")
+            if not same:
+                failures.append(name)
+
+    if failures:
+        sys.exit(f"outputs differ from the cold run: {', '.join(failures)}")
+    print('all cached runs match the cold run')
+
+    # fill                     same
+    # warm                     same
+    # warm, tap normalize      same
+    # warm, tap deduplicate    same
+    # warm, tap segment        same
+    # all cached runs match the cold run
+    #
+    # Before the start of a shard moved back to a cached step, the runs with a
+    # tap on normalize or segment failed with FileNotFoundError for the never
+    # cached outputs of the 'read' and 'deduplicate' steps.
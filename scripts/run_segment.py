@@ -16,4 +16,4 @@ from segment import segment_jsonl
 if __name__ == "__main__":
     inpath = str(ROOT/'data'/'deduplicate_data.jsonl')
     outpath = str(ROOT/'data'/'segment_data.jsonl')
-    segment_jsonl(inpath, outpath, processes=10, omit_duplicates=True)
\ No newline at end of file
+    segment_jsonl(inpath, outpath, processes=10, omit_duplicates=True, preload=True)
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""
+Script to evaluate the rule-based sentence segmenter. 
+
+Measures the agreement of the sentence boundaries of the rule-based engine with 
+those of spacy (stored in segment_data_5.jsonl), and the throughput of both 
+engines. Uses the functionality of segment.py.
+"""
+
+# Standard library
+import json
+import sys
+import time
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from segment import Segmenter
+
+
+def get_boundaries(text: str, sentences: list[str]) -> set[int]:
+    """Returns start offsets in text of all but the first sentence. 
+    
+    Sentences without any alphanumeric characters (e.g. spacy often returns a 
+    lone '•' as a sentence) are merged with the following sentence."""
+    boundaries = set()
+    pos = 0
+    merge_next = False
+    for sentence in sentences:
+        start = text.find(sentence.strip(), pos)
+        if start > 0 and not merge_next:
+            boundaries.add(start)
+        pos = max(pos, start)
+        merge_next = not any(c.isalnum() for c in sentence)
+    return boundaries
+
+def get_throughput(segmenter: Segmenter, texts: list[str]) -> float:
+    """Returns number of characters segmented per second."""
+    start = time.perf_counter()
+    segmenter.segment_batch(texts)
+    return sum(len(text) for text in texts) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    inpath = str(ROOT/'data'/'deduplicate_data_5.jsonl')
+    refpath = str(ROOT/'data'/'segment_data_5.jsonl')
+
+    # sections and spacy reference segmentation
+    texts, references = [], []
+    with open(inpath, 'r') as infile, open(refpath, 'r') as reffile:
+        for line, refline in zip(infile, reffile):
+            text_list = [text for text in json.loads(line)['text_list'] 
+                         if text != "<DUPLICATE_REMOVED>"]
+            texts.extend(text_list)
+            references.extend(json.loads(refline)['text_list'])
+
+    ########################  Agreement with spacy  ##########################
+
+    segmenter = Segmenter(engine='rule')
+    n_true, n_pred, n_both, n_exact = 0, 0, 0, 0
+    for text, reference in zip(texts, references):
+        true = get_boundaries(text, reference)
+        pred = get_boundaries(text, segmenter.segment(text))
+        n_true += len(true)
+        n_pred += len(pred)
+        n_both += len(true & pred)
+        n_exact += true == pred
+
+    precision = n_both / n_pred
+    recall = n_both / n_true
+    print(f'sections: {len(texts)}, spacy boundaries: {n_true}')
+    print(f'boundary precision: {precision:.3f}')
+    print(f'boundary recall:    {recall:.3f}')
+    print(f'boundary F1:        {2 * precision * recall / (precision + recall):.3f}')
+    print(f'identical sections: {n_exact / len(texts):.3f}')
+
+    # sections: 152, spacy boundaries: 2471
+    # boundary precision: 0.841
+    # boundary recall:    0.890
+    # boundary F1:        0.865
+    # identical sections: 0.526
+    #
+    # Most disagreements are by design: the rule engine makes every list item 
+    # a sentence and splits before '### headings', while spacy often merges 
+    # list items and headings with neighbouring sentences.
+
+    ##############################  Throughput  ##############################
+
+    print(f'rule throughput:  {get_throughput(segmenter, texts):12,.0f} chars/s')
+    for mode in ('parser', 'senter'):
+        segmenter = Segmenter(engine='spacy', mode=mode)
+        print(f'{mode} throughput: {get_throughput(segmenter, texts):12,.0f} chars/s')
+
+    # rule throughput:    12,276,831 chars/s  (single process)
@@ -0,0 +1,44 @@
+"""
+Script to run a stage sharded across several machines. 
+
+Uses the functionality of workqueue.py, configured by the 'workqueue' section 
+of config/config.yaml. The first argument selects the role of the script:
+  - create: split the input into shards and create the job (run once)
+  - node: process shards until the job is done (run on each machine)
+  - local N: run N nodes on this machine
+  - merge: concatenate the outputs of the shards (run once, at the end)
+"""
+
+# Standard library
+import sys
+from pathlib import Path
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from utils import load_yaml
+from workqueue import create_job, merge_outputs, run_local, run_node
+
+if __name__ == "__main__":
+    config = load_yaml(str(ROOT/'config'/'config.yaml'))['workqueue']
+    job_dir = str(ROOT/config['job_dir'])
+    role = sys.argv[1] if len(sys.argv) > 1 else 'node'
+
+    if role == 'create':
+        create_job(job_dir, 
+                   config['stage'], 
+                   str(ROOT/config['input']), 
+                   config['output'], 
+                   config['num_shards'], 
+                   config['params'], 
+                   config['max_attempts'])
+    elif role == 'node':
+        run_node(job_dir, 
+                 lease_seconds=config['lease_seconds'], 
+                 poll_seconds=config['poll_seconds'])
+    elif role == 'local':
+        run_local(job_dir, int(sys.argv[2]), lease_seconds=config['lease_seconds'])
+    elif role == 'merge':
+        merge_outputs(job_dir, str(ROOT/config['merged_output']))
+    else:
+        raise ValueError(f"role must be 'create', 'node', 'local' or 'merge' but got {role}")
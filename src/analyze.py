@@ -4,21 +4,23 @@ Core functionality to analyze character frequency in text.
 Contains:
   - Analyzer: class for analyzing character frequency in text.
   - analyze_jsonl: function for analyzing character frequencies of text stored
-    in jsonl file. Can utilize multiple processors.
+    in jsonl file (or binary record file, see records.py). Can utilize 
+    multiple processors.
 """
 
 # Standard library
-import json
 import sys
 from collections import Counter
-from multiprocessing import Pool, current_process
+from multiprocessing import current_process
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, Optional
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from records import BATCH_BYTES, batch_records, count_records, load_record, read_records
+from workerpool import WorkerPool, get_pool
 
 class Analyzer:
     """Class for analyzing character frequency in text."""
@@ -35,11 +37,14 @@ class Analyzer:
 
 # Multiprocessing functions
 
-def get_iterable(file, total_lines: int, 
-                 chars: list[str]) -> Iterator[int, str, int, list[str]]:
-    """Generator of worker() arguments."""
-    for page_num, line in enumerate(file, 1):
-        yield (page_num, line, total_lines, chars)
+def get_iterable(records: Iterator[str | bytes], 
+                 total_lines: int, 
+                 chars: list[str], 
+                 batch_bytes: int) -> Iterator[tuple[int, list[str | bytes], int, list[str]]]:
+    """Generator of worker() arguments: batches of about batch_bytes of 
+    records (see batch_records), with the page number of their first record."""
+    for first_page_num, batch in batch_records(records, batch_bytes):
+        yield (first_page_num, batch, total_lines, chars)
 
 def worker_init() -> None:
     """Initializes worker."""
@@ -48,34 +53,44 @@ def worker_init() -> None:
     process = current_process()
     print(f'Initialized {process.name}')
 
-def worker(page_num: int, 
-           line: str, 
+def worker(first_page_num: int, 
+           records: list[str | bytes], 
            total_lines: int, 
            chars: list[str]) -> Counter:
-    """Analyzes text in jsonl entry given by line."""
-    # read from line
-    entry = json.loads(line)
-    url = entry['url']
-    text_list = entry['text_list']
-
-    # log
-    analyzer.logger.info(f"Analyzing page {page_num} / {total_lines} : {url}")
-
-    # analyze
+    """Analyzes text in the entries given by records."""
     counter = Counter()
-    for text in text_list:
-        counter.update(analyzer.analyze(text, chars))
+    for page_num, record in enumerate(records, first_page_num):
+        # read from record
+        entry = load_record(record)
+        url = entry['url']
+        text_list = entry['text_list']
+
+        # log
+        analyzer.logger.info(f"Analyzing page {page_num} / {total_lines} : {url}")
+
+        # analyze
+        for text in text_list:
+            counter.update(analyzer.analyze(text, chars))
     
     return counter
 
+def worker_star(args: tuple[int, list[str | bytes], int, list[str]]) -> Counter:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
+
 
 
 # Main entry points
 
 def analyze_jsonl(inpath_list: list[str] | str, 
                   chars: list[str], 
-                  processes: int) -> Counter:
-    """Analyze text stored in .jsonl file(s), returning Counter for chars."""
+                  processes: int, 
+                  pool: Optional[WorkerPool]=None, 
+                  batch_bytes: int=BATCH_BYTES) -> Counter:
+    """Analyze text stored in .jsonl file(s), returning Counter for chars. 
+    Each worker task analyzes a batch of about batch_bytes of input records. 
+    The same workers process all input files: those of the warm WorkerPool 
+    pool if given, and otherwise processes new ones."""
     analyzer = Analyzer()
     analyzer.logger.info(f"Started analyzing {inpath_list} for {chars}")
 
@@ -91,16 +106,14 @@ def analyze_jsonl(inpath_list: list[str] | str,
     counter = Counter()
 
     # read files
-    for inpath in inpath_list:
-        with open(inpath, 'r') as infile:
+    with get_pool(pool, processes, worker_init) as stage_pool:
+        for inpath in inpath_list:
             analyzer.logger.info(f"Started analyzing {inpath} for {chars}")
-            total_lines = sum(1 for _ in infile)
-            infile.seek(0)
+            total_lines = count_records(inpath)
 
-            with Pool(processes=processes, initializer=worker_init) as pool:
-                iterable = get_iterable(infile, total_lines, chars)
-                for article_counter in pool.starmap(worker, iterable):
-                    counter.update(article_counter)
+            iterable = get_iterable(read_records(inpath), total_lines, chars, batch_bytes)
+            for batch_counter in stage_pool.imap(worker_star, iterable):
+                counter.update(batch_counter)
             analyzer.logger.info(f"Finished analyzing {inpath} for {chars}")
         
     analyzer.logger.info(f"Finished analyzing {inpath_list} for {chars}\n\n")
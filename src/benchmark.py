@@ -0,0 +1,595 @@
+"""
+Core functionality for benchmarking the stages of the pipeline on a synthetic
+corpus.
+
+The corpus is generated offline and reproducibly from a seed, so that results
+of different runs (and machines) can be compared. Each article is the html of
+a Wikipedia-like page in the structure expected by Parser: a title, an
+infobox before the first paragraph, an introduction, sections with h2 headings
+holding paragraphs with links, references, math, lists, sub-headings,
+blockquotes and unwanted tables/figures, and end sections (See also,
+References) whose content is skipped. The words are drawn with Zipf-like
+frequencies from a vocabulary of synthetic words.
+
+Some sections are near-duplicates of a section of an earlier article, at
+controlled Jaccard similarities of their word n-grams (the shingles of the
+deduplicator in 'word' mode): the copy keeps a prefix of the words of the
+original and replaces the rest, where the length of the prefix is chosen so
+that the Jaccard similarity of the n-gram sets is the target level. The exact
+similarity of each planted pair is recorded, so the benchmark can also report
+which near-duplicates the deduplicator finds.
+
+The stages are run one after another, each on the output of the previous one,
+and each in a fresh process, so that the peak resident set size (RSS) of a
+stage is not inflated by the previous ones. Only the calls of the stage
+(Parser.parse, Normalizer.normalize, MinHash and LSH of the Deduplicator,
+Segmenter.segment_batch, Vocab.increase_vocab and Tokenizer.tokenize) are
+timed, not reading their input or writing their output. Results are returned
+(and written by scripts/run_benchmark.py) as json, with records per second
+and peak RSS in MB of each stage, and can be compared with a baseline to catch
+performance regressions.
+
+Contains:
+  - CorpusGenerator: class for generating synthetic Wikipedia-like articles.
+  - generate_corpus: function writing a synthetic corpus to a jsonl file.
+  - run_benchmark: function generating a corpus and timing all stages on it.
+  - compare_results: function listing regressions with respect to a baseline.
+"""
+
+# Standard library
+import platform
+import random
+import resource
+import sys
+import time
+from collections import Counter
+from itertools import accumulate, chain
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Optional
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from bpe_freqdict import FreqDictCreator, write_freq_dict
+from bpe_tokenize import Tokenizer
+from bpe_vocab import Vocab
+from deduplicate import Deduplicator
+from normalize import Normalizer
+from parse import Parser
+from records import RecordWriter, load_record, read_records
+from segment import Segmenter
+
+STAGES = ('parse', 'normalize', 'deduplicate', 'segment', 'vocab', 'tokenize')
+
+HEAD = ('<!DOCTYPE html><html class="client-nojs" lang="en" dir="ltr"><head>'
+        '<meta charset="UTF-8"><title>{title} - Wikipedia</title>'
+        '<style>.mw-parser-output .hatnote{{font-style:italic}}'
+        '.mw-parser-output .reflist{{margin-bottom:0.5em}}</style>'
+        '<script>document.documentElement.className="client-js";</script>'
+        '</head><body class="skin-vector mediawiki ltr sitedir-ltr">'
+        '<div id="content" class="mw-body" role="main">')
+TAIL = '</div></div></div></body></html>'
+
+
+class CorpusGenerator:
+    """Class for generating synthetic Wikipedia-like articles, with html in
+    the structure expected by Parser and near-duplicate sections."""
+    CONSONANTS = 'bcdfghklmnprstvwz'
+    VOWELS = 'aeiou'
+    ABBREVIATIONS = ['e.g.', 'i.e.', 'Dr.', 'St.', 'approx.', 'U.S.']
+
+    def __init__(self, 
+                 seed: int=0, 
+                 n_words: int=20000, 
+                 dup_rate: float=0.2, 
+                 jaccard_levels: tuple[float, ...]=(1.0, 0.9, 0.7, 0.5), 
+                 gram_len: int=5, 
+                 max_sources: int=1000) -> None:
+        self.rng = random.Random(seed)
+        self.dup_rate = dup_rate
+        self.jaccard_levels = jaccard_levels
+        self.gram_len = gram_len
+        self.max_sources = max_sources
+
+        # vocabulary of synthetic words with Zipf-like frequencies
+        syllables = [c + v for c in self.CONSONANTS for v in self.VOWELS]
+        self.words = [''.join(self.rng.choices(syllables, k=self.rng.randint(1, 4)))
+                      for _ in range(n_words)]
+        self.cum_weights = list(accumulate(1 / rank for rank in range(1, n_words + 1)))
+
+        # plain sections of earlier articles, which can be copied as
+        # near-duplicates: (url, index in text_list, heading, paragraphs)
+        self.sources = []
+        self.pairs = []  # planted near-duplicate pairs
+        self.titles = set()
+
+    def article(self) -> dict[str, str]:
+        """Returns next article {'url': url, 'text': html}."""
+        title = self.title()
+        url = 'https://en.wikipedia.org/wiki/' + title.replace(' ', '_')
+
+        # introduction, starting with the title in bold
+        intro = [self.paragraph() for _ in range(self.rng.randint(1, 3))]
+        blocks = [f'<p><b>{title}</b> {self.render_text(intro[0])}\n</p>']
+        blocks += [f'<p>{self.render_text(tokens)}\n</p>' for tokens in intro[1:]]
+
+        # sections, the i-th of which is item i + 1 of the parsed text_list. 
+        # Plain sections (only paragraphs) can be copied as near-duplicates, 
+        # and a near-duplicate, if any, is the last section
+        n_sections = self.rng.randint(2, 6)
+        has_duplicate = bool(self.sources) and self.rng.random() < self.dup_rate
+        for i in range(n_sections + has_duplicate):
+            if i == n_sections:
+                heading, paragraphs = self.near_duplicate(url, i + 1)
+                plain = True
+            else:
+                heading = self.heading()
+                paragraphs = [self.paragraph() for _ in range(self.rng.randint(1, 4))]
+                plain = self.rng.random() < 0.5
+                if plain:
+                    self.add_source(url, i + 1, heading, paragraphs)
+            blocks.append(self.render_heading(heading))
+            for tokens in paragraphs:
+                blocks.append(f'<p>{self.render_text(tokens)}\n</p>')
+                if not plain and self.rng.random() < 0.3:
+                    blocks.append(self.extra_block())
+
+        html = ''.join([
+            HEAD.format(title=title),
+            f'<h1 id="firstHeading" class="firstHeading mw-first-heading">'
+            f'<span class="mw-page-title-main">{title}</span></h1>',
+            '<div id="mw-content-text" class="mw-body-content">'
+            '<div class="mw-content-ltr mw-parser-output" lang="en" dir="ltr">',
+            f'<div class="shortdescription nomobile noexcerpt noprint searchaux" '
+            f'style="display:none">{self.phrase(4)}</div>',
+            self.infobox(title),
+            *blocks,
+            self.end_sections(),
+            TAIL])
+        return {'url': url, 'text': html}
+
+    ###########################  Text generation  ###########################
+
+    def phrase(self, n: int) -> str:
+        """Returns n random words."""
+        return ' '.join(self.rng.choices(self.words, cum_weights=self.cum_weights, k=n))
+
+    def title(self) -> str:
+        """Returns new unique title of 1-3 capitalized words."""
+        while True:
+            title = self.phrase(self.rng.randint(1, 3)).title()
+            if title not in self.titles:
+                self.titles.add(title)
+                return title
+
+    def heading(self) -> list[str]:
+        """Returns tokens of a section heading."""
+        return self.phrase(self.rng.randint(1, 3)).title().split()
+
+    def sentence(self) -> list[str]:
+        """Returns tokens of a sentence of 5-25 words, sometimes with an
+        abbreviation, a year or a comma."""
+        tokens = self.rng.choices(self.words, cum_weights=self.cum_weights,
+                                  k=self.rng.randint(5, 25))
+        r = self.rng.random()
+        if r < 0.1:
+            tokens.insert(self.rng.randrange(1, len(tokens)), self.rng.choice(self.ABBREVIATIONS))
+        elif r < 0.2:
+            tokens.insert(self.rng.randrange(1, len(tokens)), f'({self.rng.randint(1000, 2024)})')
+        if self.rng.random() < 0.3:
+            tokens[self.rng.randrange(1, len(tokens) - 1)] += ','
+        tokens[0] = tokens[0].capitalize()
+        tokens[-1] += '.'
+        return tokens
+
+    def paragraph(self) -> list[str]:
+        """Returns tokens of a paragraph of 2-6 sentences."""
+        return [token for _ in range(self.rng.randint(2, 6)) for token in self.sentence()]
+
+    ##############################  Html blocks  #############################
+
+    def render_text(self, tokens: list[str]) -> str:
+        """Returns html of tokens, with links, bold words and references,
+        which don't change the text extracted by Parser."""
+        parts = []
+        for token in tokens:
+            r = self.rng.random()
+            if r < 0.05:
+                token = f'<a href="/wiki/{token}" title="{token}">{token}</a>'
+            elif r < 0.06:
+                token = f'<b>{token}</b>'
+            elif r < 0.1 and token.endswith('.'):
+                n = self.rng.randint(1, 99)
+                token += (f'<sup id="cite_ref-{n}" class="reference">'
+                          f'<a href="#cite_note-{n}">[{n}]</a></sup>')
+            parts.append(token)
+        return ' '.join(parts)
+
+    def render_heading(self, heading: list[str]) -> str:
+        """Returns html of a level 2 section heading."""
+        title = ' '.join(heading)
+        return (f'<div class="mw-heading mw-heading2"><h2 id="{title.replace(" ", "_")}">'
+                f'{title}</h2><span class="mw-editsection">[edit]</span></div>')
+
+    def extra_block(self) -> str:
+        """Returns html of a random block besides paragraphs: a list, a
+        sub-heading, math, a blockquote, a description list, or content
+        removed by Parser (tables, figures, hatnotes)."""
+        kind = self.rng.choice(['ul', 'ol', 'h3', 'math', 'blockquote', 'dl',
+                                'table', 'figure', 'hatnote'])
+        if kind in ('ul', 'ol'):
+            items = ''.join(f'<li>{self.phrase(self.rng.randint(2, 8))}</li>'
+                            for _ in range(self.rng.randint(2, 6)))
+            return f'<{kind}>{items}</{kind}>'
+        if kind == 'h3':
+            title = self.phrase(2).title()
+            return (f'<div class="mw-heading mw-heading3"><h3 id="{title.replace(" ", "_")}">'
+                    f'{title}</h3></div>')
+        if kind == 'math':
+            latex = f'x^{{{self.rng.randint(2, 9)}}}+{self.rng.choice("abcyz")}'
+            return (f'<p>{self.phrase(6)} <span class="mwe-math-element">'
+                    f'<span class="mwe-math-mathml-inline mwe-math-mathml-a11y" style="display: none;">'
+                    f'<math xmlns="http://www.w3.org/1998/Math/MathML"><semantics><mrow><mi>x</mi></mrow>'
+                    f'<annotation encoding="application/x-tex">{{\\displaystyle {latex}}}</annotation>'
+                    f'</semantics></math></span></span> {self.phrase(6)}.\n</p>')
+        if kind == 'blockquote':
+            return f'<blockquote><p>{self.render_text(self.sentence())}</p></blockquote>'
+        if kind == 'dl':
+            return f'<dl><dd>{self.phrase(8)}</dd></dl>'
+        if kind == 'table':
+            rows = ''.join(f'<tr><td>{self.phrase(2)}</td><td>{self.rng.randint(1, 999)}</td></tr>'
+                           for _ in range(self.rng.randint(2, 8)))
+            return f'<table class="wikitable"><tbody>{rows}</tbody></table>'
+        if kind == 'figure':
+            return (f'<figure class="mw-default-size"><a href="/wiki/File:X.jpg">'
+                    f'<img src="//upload.wikimedia.org/X.jpg"></a>'
+                    f'<figcaption>{self.phrase(5)}</figcaption></figure>')
+        return (f'<div role="note" class="hatnote navigation-not-searchable">Main article: '
+                f'<a href="/wiki/X">{self.phrase(2)}</a></div>')
+
+    def infobox(self, title: str) -> str:
+        """Returns html of an infobox (skipped by Parser, since it comes
+        before the first paragraph)."""
+        rows = ''.join(f'<tr><th scope="row" class="infobox-label">{self.phrase(1)}</th>'
+                       f'<td class="infobox-data">{self.phrase(3)}</td></tr>'
+                       for _ in range(self.rng.randint(3, 10)))
+        return (f'<table class="infobox vcard"><tbody><tr><th colspan="2" '
+                f'class="infobox-above">{title}</th></tr>{rows}</tbody></table>')
+
+    def end_sections(self) -> str:
+        """Returns html of the See also and References sections (where
+        Parser stops), and a navbox."""
+        see_also = ''.join(f'<li><a href="/wiki/X">{self.phrase(2)}</a></li>'
+                           for _ in range(self.rng.randint(2, 6)))
+        references = ''.join(f'<li id="cite_note-{n}"><span class="reference-text">'
+                             f'{self.phrase(8)}. Retrieved {self.rng.randint(2000, 2024)}.</span></li>'
+                             for n in range(1, self.rng.randint(5, 30)))
+        return (f'<div class="mw-heading mw-heading2"><h2 id="See_also">See also</h2></div>'
+                f'<ul>{see_also}</ul>'
+                f'<div class="mw-heading mw-heading2"><h2 id="References">References</h2></div>'
+                f'<div class="reflist"><ol class="references">{references}</ol></div>'
+                f'<div role="navigation" class="navbox"><table class="nowraplinks">'
+                f'<tr><td>{self.phrase(30)}</td></tr></table></div>')
+
+    ############################  Near-duplicates  ###########################
+
+    def add_source(self, 
+                   url: str, 
+                   idx: int, 
+                   heading: list[str], 
+                   paragraphs: list[list[str]]) -> None:
+        """Adds plain section as a candidate for near-duplicates, keeping at
+        most max_sources of them (replacing a random one once full)."""
+        source = (url, idx, heading, paragraphs)
+        if len(self.sources) < self.max_sources:
+            self.sources.append(source)
+        else:
+            self.sources[self.rng.randrange(self.max_sources)] = source
+
+    def near_duplicate(self, url: str, idx: int) -> tuple[list[str], list[list[str]]]:
+        """Returns heading and paragraphs of a near-duplicate of a random
+        source section, as section idx of article url, at the next Jaccard
+        level.
+
+        The tokens of the parsed section are '##', the heading and the
+        paragraphs. With n tokens, a section has N = n - gram_len + 1 word
+        n-grams. If the copy keeps the first k tokens and replaces the rest,
+        both share s = k - gram_len + 1 n-grams, with Jaccard similarity
+        s / (2N - s), so keeping s = 2NJ / (1 + J) n-grams gives similarity J.
+        """
+        source_url, source_idx, heading, paragraphs = self.rng.choice(self.sources)
+        target = self.jaccard_levels[len(self.pairs) % len(self.jaccard_levels)]
+        tokens = ['##', *heading, *chain(*paragraphs)]
+        n_grams = max(len(tokens) - self.gram_len + 1, 1)
+        shared = round(2 * n_grams * target / (1 + target))
+        keep = max(1, min(len(tokens), shared + self.gram_len - 1)) if shared else 1
+        tokens = tokens[:keep] + self.phrase(len(tokens) - keep).split()
+
+        # restore heading and paragraph lengths
+        copy_heading = tokens[1:1 + len(heading)]
+        starts = list(accumulate(map(len, paragraphs), initial=1 + len(heading)))
+        copy_paragraphs = [tokens[start:end] for start, end in zip(starts, starts[1:])]
+
+        self.pairs.append({
+            'jaccard_level': target,
+            'jaccard': shingle_jaccard(['##', *heading, *chain(*paragraphs)], tokens, self.gram_len),
+            'source': [source_url, source_idx],
+            'copy': [url, idx],
+        })
+        return copy_heading, copy_paragraphs
+
+
+# Corpus and benchmark
+
+def shingle_jaccard(tokens1: list[str], tokens2: list[str], gram_len: int) -> float:
+    """Returns Jaccard similarity of the sets of word n-grams of two token
+    lists."""
+    grams1 = {tuple(tokens1[i:i + gram_len]) for i in range(max(len(tokens1) - gram_len + 1, 1))}
+    grams2 = {tuple(tokens2[i:i + gram_len]) for i in range(max(len(tokens2) - gram_len + 1, 1))}
+    return len(grams1 & grams2) / len(grams1 | grams2)
+
+def generate_corpus(path: str, 
+                    n_articles: int, 
+                    seed: int=0, 
+                    dup_rate: float=0.2, 
+                    jaccard_levels: tuple[float, ...]=(1.0, 0.9, 0.7, 0.5), 
+                    gram_len: int=5) -> list[dict[str, Any]]:
+    """Writes n_articles synthetic articles {'url': url, 'text': html} to
+    jsonl file (see CorpusGenerator), and returns the planted near-duplicate
+    pairs, with the [url, index in text_list] of source and copy."""
+    generator = CorpusGenerator(seed, dup_rate=dup_rate,
+                                jaccard_levels=tuple(jaccard_levels), gram_len=gram_len)
+    with RecordWriter(path) as writer:
+        for _ in range(n_articles):
+            writer.write(generator.article())
+    return generator.pairs
+
+def run_benchmark(work_dir: str, 
+                  n_articles: int, 
+                  seed: int=0, 
+                  dup_rate: float=0.2, 
+                  jaccard_levels: tuple[float, ...]=(1.0, 0.9, 0.7, 0.5), 
+                  params: Optional[dict[str, dict[str, Any]]]=None, 
+                  stages: tuple[str, ...]=STAGES) -> dict[str, Any]:
+    """Generates a synthetic corpus of n_articles in work_dir and runs the
+    stages on it, each on the output of the previous one, in a fresh process.
+    params holds the keyword arguments of each stage (see the bench_*
+    functions). Returns the results: for each stage the number of records
+    (articles, or merges for the vocab), the seconds, records per second and
+    peak RSS in MB, and for the deduplicator the planted near-duplicates
+    found at each Jaccard level."""
+    params = params or {}
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError(f'stages must be in {STAGES} but got {stage}')
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    gram_len = params.get('deduplicate', {}).get('gram_len', 5)
+
+    corpus_path = str(work_dir/'corpus.jsonl')
+    start = time.perf_counter()
+    pairs = generate_corpus(corpus_path, n_articles, seed, dup_rate, jaccard_levels, gram_len)
+    results = {
+        'corpus': {
+            'articles': n_articles,
+            'seed': seed,
+            'bytes': Path(corpus_path).stat().st_size,
+            'near_duplicates': len(pairs),
+            'seconds': time.perf_counter() - start,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+        },
+        'stages': {},
+    }
+
+    # each stage reads the output of the previous one
+    inpath = corpus_path
+    context = get_context('spawn')
+    for stage in stages:
+        outpath = str(work_dir/f'{stage}.jsonl')
+        with context.Pool(1) as pool:
+            result = pool.apply(run_stage, (stage, inpath, outpath, params.get(stage, {})))
+            pool.close()
+            pool.join()
+        if stage == 'deduplicate':
+            result['near_duplicates'] = get_found(pairs, result.pop('removed'))
+        results['stages'][stage] = result
+        if stage != 'vocab':
+            inpath = outpath
+
+    return results
+
+def compare_results(results: dict[str, Any], 
+                    baseline: dict[str, Any], 
+                    tolerance: float=0.2) -> list[str]:
+    """Returns list of regressions of results with respect to baseline:
+    stages whose records per second dropped, or whose peak RSS grew, by more
+    than tolerance (relative)."""
+    regressions = []
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        base = baseline['stages'][stage]
+        if result['records_per_sec'] < (1 - tolerance) * base['records_per_sec']:
+            regressions.append(f"{stage}: {result['records_per_sec']:.1f} records/s "
+                               f"(baseline {base['records_per_sec']:.1f})")
+        if result['peak_rss_mb'] > (1 + tolerance) * base['peak_rss_mb']:
+            regressions.append(f"{stage}: peak RSS {result['peak_rss_mb']:.1f} MB "
+                               f"(baseline {base['peak_rss_mb']:.1f} MB)")
+    return regressions
+
+
+# Stage benchmarks, each run in its own process by run_stage
+
+def run_stage(stage: str, inpath: str, outpath: str, params: dict[str, Any]) -> dict[str, Any]:
+    """Runs benchmark of stage and returns its result, with the peak RSS of
+    the process."""
+    records, seconds, extra = STAGE_BENCHMARKS[stage](inpath, outpath, **params)
+    return {
+        'records': records,
+        'seconds': seconds,
+        'records_per_sec': records / seconds if seconds else 0.0,
+        'peak_rss_mb': get_peak_rss_mb(),
+        **extra,
+    }
+
+def bench_parse(inpath: str, outpath: str) -> tuple[int, float, dict]:
+    """Times Parser.parse on the html of all articles."""
+    parser = Parser()
+    entries = [load_record(record) for record in read_records(inpath)]
+    start = time.perf_counter()
+    text_lists = [parser.parse(entry['text']) for entry in entries]
+    seconds = time.perf_counter() - start
+    write_entries(outpath, entries, text_lists)
+    return len(entries), seconds, {}
+
+def bench_normalize(inpath: str, outpath: str, len_cutoff: int=50) -> tuple[int, float, dict]:
+    """Times Normalizer.normalize on all texts (dropping texts shorter than
+    len_cutoff)."""
+    normalizer = Normalizer()
+    entries = [load_record(record) for record in read_records(inpath)]
+    start = time.perf_counter()
+    text_lists = []
+    for entry in entries:
+        texts = [normalizer.normalize(text) for text in entry['text_list']]
+        text_lists.append([text for text in texts if len(text) >= len_cutoff])
+    seconds = time.perf_counter() - start
+    write_entries(outpath, entries, text_lists)
+    return len(entries), seconds, {}
+
+def bench_deduplicate(inpath: str, outpath: str, **params) -> tuple[int, float, dict]:
+    """Times MinHash signatures of all texts and finding the duplicates with
+    LSH (with the Deduplicator parameters params). With memory_budget_mb, 
+    times the whole deduplication with external memory, from and to disk."""
+    params = {'gram_len': 5, 'signature_len': 128, 'band_size': 16,
+              'similarity_threshold': 0.8, 'shingle_mode': 'word', **params}
+    if params.get('memory_budget_mb') is not None:
+        deduplicator = Deduplicator(inpath, outpath, **params)
+        start = time.perf_counter()
+        deduplicator.deduplicate()
+        seconds = time.perf_counter() - start
+        n_entries, removed = 0, []
+        for record in read_records(outpath):
+            entry = load_record(record)
+            n_entries += 1
+            removed.extend([entry['url'], i] for i, text in enumerate(entry['text_list'])
+                           if text == '<DUPLICATE_REMOVED>')
+        return n_entries, seconds, {'removed': removed}
+
+    deduplicator = Deduplicator(None, None, **params)
+    entries = [load_record(record) for record in read_records(inpath)]
+    start = time.perf_counter()
+    for entry in entries:
+        deduplicator.min_hashes[entry['url']] = [deduplicator.min_hash(text)
+                                                 for text in entry['text_list']]
+    deduplicator.find_duplicates()
+    seconds = time.perf_counter() - start
+    for entry in entries:
+        deduplicator.remove_duplicates(entry['url'], entry['text_list'])
+    write_entries(outpath, entries, [entry['text_list'] for entry in entries])
+    return len(entries), seconds, {'removed': sorted(deduplicator.texts_to_remove_set)}
+
+def bench_segment(inpath: str, 
+                  outpath: str, 
+                  engine: str='rule', 
+                  mode: str='parser', 
+                  batch_size: int=64) -> tuple[int, float, dict]:
+    """Times Segmenter.segment_batch on the (not removed) texts of every
+    article."""
+    segmenter = Segmenter(engine, mode, batch_size)
+    entries = [load_record(record) for record in read_records(inpath)]
+    start = time.perf_counter()
+    text_lists = [segmenter.segment_batch([text for text in entry['text_list']
+                                           if text != "<DUPLICATE_REMOVED>"])
+                  for entry in entries]
+    seconds = time.perf_counter() - start
+    write_entries(outpath, entries, text_lists)
+    return len(entries), seconds, {}
+
+def bench_vocab(inpath: str, 
+                outpath: str, 
+                vocab_size: int=2000, 
+                pretokenizer: str='space') -> tuple[int, float, dict]:
+    """Times Vocab.increase_vocab up to vocab_size on the word frequency dict
+    of the segmented articles (created before timing). Records are merges.
+    The vocab is saved next to outpath, as vocab.json."""
+    freq_dict_creator = FreqDictCreator(pretokenizer)
+    freq_dict = Counter()
+    for record in read_records(inpath):
+        for section in load_record(record)['text_list']:
+            for sentence in section:
+                freq_dict.update(freq_dict_creator.create_freq_dict(sentence))
+    freq_dict_path = str(Path(outpath).parent/'freq_dict.json')
+    write_freq_dict(freq_dict.items(), freq_dict_path)
+
+    vocab = Vocab(freq_dict_path, get_vocab_path(outpath), pretokenizer=pretokenizer)
+    start = time.perf_counter()
+    vocab.increase_vocab(vocab_size)
+    seconds = time.perf_counter() - start
+    return len(vocab.merges), seconds, {'unit': 'merges', 'words': len(freq_dict)}
+
+def bench_tokenize(inpath: str, 
+                   outpath: str, 
+                   engine: str='bpe', 
+                   pretokenizer: str='space') -> tuple[int, float, dict]:
+    """Times Tokenizer.tokenize on all sentences, with the vocab created by
+    bench_vocab."""
+    tokenizer = Tokenizer(get_vocab_path(outpath), engine, pretokenizer=pretokenizer)
+    entries = [load_record(record) for record in read_records(inpath)]
+    start = time.perf_counter()
+    token_lists = [[[tokenizer.tokenize(sentence) for sentence in section]
+                    for section in entry['text_list']]
+                   for entry in entries]
+    seconds = time.perf_counter() - start
+    write_entries(outpath, entries, token_lists)
+    return len(entries), seconds, {}
+
+STAGE_BENCHMARKS = {
+    'parse': bench_parse,
+    'normalize': bench_normalize,
+    'deduplicate': bench_deduplicate,
+    'segment': bench_segment,
+    'vocab': bench_vocab,
+    'tokenize': bench_tokenize,
+}
+
+
+# Helper functions
+
+def get_peak_rss_mb() -> float:
+    """Returns peak resident set size of the current process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def get_vocab_path(outpath: str) -> str:
+    """Returns path of the vocab created by bench_vocab, in the directory of
+    the stage outputs."""
+    return str(Path(outpath).parent/'vocab.json')
+
+def write_entries(outpath: str, entries: list[dict], text_lists: list[list]) -> None:
+    """Writes entries {'url': url, 'text_list': text_list} to jsonl file."""
+    with RecordWriter(outpath) as writer:
+        for entry, text_list in zip(entries, text_lists):
+            writer.write({'url': entry['url'], 'text_list': text_list})
+
+def get_found(pairs: list[dict[str, Any]], 
+              removed: list[list]) -> dict[str, dict[str, int]]:
+    """Returns {jaccard level: {'planted': n, 'found': n}} of the planted
+    near-duplicate pairs, where a pair is found if one of its texts was
+    removed, and the number of removed texts not in any planted pair."""
+    removed = {tuple(text) for text in removed}
+    found = {}
+    planted_texts = set()
+    for pair in pairs:
+        source, copy = tuple(pair['source']), tuple(pair['copy'])
+        planted_texts.update((source, copy))
+        level = found.setdefault(str(pair['jaccard_level']), {'planted': 0, 'found': 0})
+        level['planted'] += 1
+        level['found'] += source in removed or copy in removed
+    found['other_removed'] = len(removed - planted_texts)
+    return found
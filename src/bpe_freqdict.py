@@ -6,94 +6,313 @@ This consitutes part 1/3 of the byte pair encoding (BPE) tokenization pipeline:
   2. Create vocab
   3. Tokenize text
 
+Workers count the words of chunks of many articles at once, so only one
+partial Counter per chunk is sent back to the parent. If the number of
+distinct words held by the parent exceeds max_words, the counts are spilled to
+disk as a run sorted by word, which also stores the position of each word's
+first occurrence, and the runs are combined with a k-way merge at the end.
+The merged words are then put back in order of first occurrence by an
+external sort on that position, so the freq dict (and a vocab trained on it,
+which breaks ties by word order) doesn't depend on spilling. Alternatively, max_words can be derived from a memory budget
+memory_budget_mb (at ~WORD_BYTES per distinct word held in the Counter), so
+that the peak memory does not grow with the size of the corpus. The merged
+counts can be pruned to words with a minimal frequency and/or to the top_k
+most frequent words.
+
+The freq dict is saved either as a single json object {word: freq}, or as a
+tsv file with one line "word<TAB>freq" per word (tabs, newlines and backslashes
+in words escaped), which can be read line by line. Words are saved in order of
+first occurrence in the corpus, whether or not counts were spilled to disk.
+
 Contains:
   - FreqDictCreator: class for creating BPE word frequency dictionary.
   - create_freq_dict_from_jsonl: function for creating word frequency dict from
     text stored in jsonl file. Can utilize multiple processors.
+  - read_freq_dict: function reading (word, freq) pairs from freq dict file.
+  - write_freq_dict: function writing (word, freq) pairs to freq dict file.
 """
 
 # Standard library
+import heapq
 import json
+import os
+import re
 import sys
+import tempfile
 from collections import Counter
-from multiprocessing import Pool, current_process
+from itertools import islice
+from multiprocessing import current_process
 from pathlib import Path
-from typing import Iterator
+from typing import Iterable, Iterator, Optional
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from bpe_pretokenize import PreTokenizer
+from records import count_records, load_record, read_records
+from workerpool import WorkerPool, get_pool
+
+ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+UNESCAPES = {escaped[1]: char for char, escaped in ESCAPES.items()}
+ESCAPE_TABLE = str.maketrans(ESCAPES)
+UNESCAPE_RE = re.compile(r'\\(.)')
+
+# approximate bytes per distinct word in a Counter (str, int and dict slot)
+WORD_BYTES = 128
 
 
 class FreqDictCreator:
     """Class for creating BPE word frequency dictionary."""
-    def __init__(self) -> None:
+    def __init__(self, pretokenizer: str='space') -> None:
+        self.pretokenizer = PreTokenizer(pretokenizer)
+
         # Logger 
         self.logger = Logger('freqdict')
 
     def create_freq_dict(self, text: str) -> Counter[str, int]:
-        """Creates word frequency dictionary from text."""
-        return Counter(text.split(sep=" "))
+        """Creates word (i.e. pre-token) frequency dictionary from text."""
+        return Counter(self.pretokenizer.split(text))
 
 
 # Multiprocessing functions
 
-def get_iterable(file, total_lines: int) -> Iterator[int, str, int]:
-    """Generator of worker() arguments."""
-    for page_num, line in enumerate(file, 1):
-        yield (page_num, line, total_lines)
+def get_iterable(records: Iterator[str | bytes], 
+                 total_lines: int, 
+                 chunk_lines: int) -> Iterator[tuple[int, list[str | bytes], int]]:
+    """Generator of worker() arguments: chunks of chunk_lines records, with
+    the page number of their first record."""
+    chunk = []
+    first_page_num = 1
+    for page_num, record in enumerate(records, 1):
+        chunk.append(record)
+        if len(chunk) == chunk_lines:
+            yield (first_page_num, chunk, total_lines)
+            chunk = []
+            first_page_num = page_num + 1
+    if chunk:
+        yield (first_page_num, chunk, total_lines)
 
-def worker_init() -> None:
+def worker_init(pretokenizer: str) -> None:
     """Initializes worker."""
     global freq_dict_creator
-    freq_dict_creator = FreqDictCreator()
+    freq_dict_creator = FreqDictCreator(pretokenizer)
     process = current_process()
     print(f'Initialized {process.name}')
 
-def worker(page_num: int, line: str, total_lines: int) -> Counter[str, int]:
-    """Creates BPE word freq dict for texts in jsonl entry given by line."""
-    # read from line
-    entry = json.loads(line)
-    url = entry['url']
-    text_list = entry['text_list']
+def worker(first_page_num: int, 
+           records: list[str | bytes], 
+           total_lines: int) -> Counter[str, int]:
+    """Creates BPE word freq dict for texts in the entries given by
+    records."""
+    freq_dict = Counter()
+    for page_num, record in enumerate(records, first_page_num):
+        # read from record
+        entry = load_record(record)
+        url = entry['url']
+        text_list = entry['text_list']
 
-    # log
-    freq_dict_creator.logger.info(f"Getting freq dict from page {page_num} / {total_lines}: {url}")
+        # log
+        freq_dict_creator.logger.info(f"Getting freq dict from page {page_num} / {total_lines}: {url}")
 
-    # Get freq dict
-    freq_dict = Counter()
-    for section in text_list:
-        for sentence in section:
-            freq_dict.update(freq_dict_creator.create_freq_dict(sentence))
+        # Get freq dict
+        for section in text_list:
+            for sentence in section:
+                freq_dict.update(freq_dict_creator.create_freq_dict(sentence))
 
     return freq_dict
 
+def worker_star(args: tuple[int, list[str | bytes], int]) -> Counter[str, int]:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
+
+
+# Spilling and merging of counts
+
+def write_run(freq_dict: Counter[str, int], offset: int, spill_dir: str) -> str:
+    """Writes counts sorted by word to a new run file in spill_dir, with the
+    position of each word (offset plus its index in freq_dict, which is in
+    order of first occurrence), and returns its path."""
+    return write_entries(sorted((word, freq, offset + i) 
+                                for i, (word, freq) in enumerate(freq_dict.items())), 
+                         spill_dir)
+
+def write_entries(entries: Iterable[tuple[str, int, int]], spill_dir: str) -> str:
+    """Writes (word, freq, pos) entries as tsv lines to a new run file in
+    spill_dir, and returns its path."""
+    fd, path = tempfile.mkstemp(suffix='.tsv', dir=spill_dir)
+    with os.fdopen(fd, 'w') as file:
+        for word, freq, pos in entries:
+            file.write(f'{escape_word(word)}\t{freq}\t{pos}\n')
+    return path
+
+def read_run(file) -> Iterator[tuple[str, int, int]]:
+    """Generator of (word, freq, pos) from open run file."""
+    for line in file:
+        word, freq, pos = line[:-1].rsplit('\t', 2)
+        yield unescape_word(word), int(freq), int(pos)
+
+def merge_runs(paths: list[str]) -> Iterator[tuple[str, int, int]]:
+    """Generator of (word, freq, pos), sorted by word, from k-way merge of run
+    files, summing the counts of equal words and keeping their first 
+    position."""
+    files = [open(path, 'r') for path in paths]
+    try:
+        word, freq, pos = None, 0, 0
+        for next_word, next_freq, next_pos in heapq.merge(*(read_run(f) for f in files)):
+            if next_word == word:
+                freq += next_freq
+                pos = min(pos, next_pos)
+                continue
+            if word is not None:
+                yield word, freq, pos
+            word, freq, pos = next_word, next_freq, next_pos
+        if word is not None:
+            yield word, freq, pos
+    finally:
+        for file in files:
+            file.close()
+
+def restore_order(items: Iterator[tuple[str, int, int]], 
+                  max_words: int, 
+                  spill_dir: str) -> Iterator[tuple[str, int]]:
+    """Generator of (word, freq) in order of pos, from (word, freq, pos) 
+    sorted by word: sorts chunks of max_words items by pos into runs, which
+    are combined with a k-way merge."""
+    paths = []
+    while chunk := list(islice(items, max_words)):
+        paths.append(write_entries(sorted(chunk, key=lambda item: item[2]), spill_dir))
+
+    files = [open(path, 'r') for path in paths]
+    try:
+        for word, freq, _ in heapq.merge(*(read_run(f) for f in files), 
+                                         key=lambda item: item[2]):
+            yield word, freq
+    finally:
+        for file in files:
+            file.close()
+
+def prune(items: Iterable[tuple[str, int]], 
+          min_freq: int=1, 
+          top_k: Optional[int]=None) -> Iterable[tuple[str, int]]:
+    """Keeps words with freq >= min_freq and, if top_k is given, only the top_k
+    most frequent of them (ties in favour of earlier words), in their original
+    order."""
+    if min_freq > 1:
+        items = ((word, freq) for word, freq in items if freq >= min_freq)
+    if top_k is not None:
+        top = heapq.nlargest(top_k, enumerate(items), key=lambda item: item[1][1])
+        items = [item for _, item in sorted(top)]
+    return items
+
+
+# Reading and writing freq dicts
+
+def escape_word(word: str) -> str:
+    """Escapes backslashes, tabs and newlines in word for tsv output."""
+    return word.translate(ESCAPE_TABLE)
+
+def unescape_word(word: str) -> str:
+    """Reverses escape_word."""
+    if '\\' not in word:
+        return word
+    return UNESCAPE_RE.sub(lambda m: UNESCAPES[m.group(1)], word)
+
+def write_tsv(items: Iterable[tuple[str, int]], file) -> None:
+    """Writes (word, freq) pairs to open file as tsv lines."""
+    for word, freq in items:
+        file.write(f'{escape_word(word)}\t{freq}\n')
+
+def read_tsv(file) -> Iterator[tuple[str, int]]:
+    """Generator of (word, freq) pairs from open tsv file."""
+    for line in file:
+        word, freq = line[:-1].rsplit('\t', 1)
+        yield unescape_word(word), int(freq)
+
+def write_freq_dict(items: Iterable[tuple[str, int]], 
+                    freq_dict_path: str, 
+                    output_format: str='json') -> None:
+    """Writes (word, freq) pairs to file, as a json object or as tsv."""
+    with open(freq_dict_path, 'w') as file:
+        if output_format == 'tsv':
+            write_tsv(items, file)
+        elif output_format == 'json':
+            file.write('{')
+            for i, (word, freq) in enumerate(items):
+                file.write(f'{", " if i else ""}{json.dumps(word)}: {freq}')
+            file.write('}')
+        else:
+            raise ValueError(f"output_format must be 'json' or 'tsv' but got {output_format}")
+
+def read_freq_dict(freq_dict_path: str) -> Iterator[tuple[str, int]]:
+    """Generator of (word, freq) pairs from freq dict file: tsv if the file
+    has suffix .tsv, otherwise a json object."""
+    with open(freq_dict_path, 'r') as file:
+        if Path(freq_dict_path).suffix == '.tsv':
+            yield from read_tsv(file)
+        else:
+            yield from json.load(file).items()
 
 
 # Main entry point
 
 def create_freq_dict_from_jsonl(corpus_path: str, 
                                 freq_dict_path: str, 
-                                processes: int) -> None:
-    """Create word frequency dict for text in jsonl file"""
+                                processes: int, 
+                                chunk_lines: int=256, 
+                                max_words: Optional[int]=None, 
+                                memory_budget_mb: Optional[float]=None, 
+                                min_freq: int=1, 
+                                top_k: Optional[int]=None, 
+                                output_format: str='json', 
+                                pretokenizer: str='space', 
+                                pool: Optional[WorkerPool]=None) -> None:
+    """Create word frequency dict for text in jsonl file (or binary record
+    file, see records.py), counting the pre-tokens given by pretokenizer (see
+    PreTokenizer).
+
+    Each worker task counts chunk_lines articles. If max_words is given, counts
+    are spilled to runs on disk whenever more than max_words distinct
+    words are held in memory. If memory_budget_mb is given, max_words is at
+    most the number of words fitting in the budget (see WORD_BYTES). Words 
+    with freq < min_freq are dropped, and if top_k is given only the top_k 
+    most frequent words are kept. If a warm WorkerPool is given, its workers 
+    are used instead of processes new ones."""
 
-    freq_dict_creator = FreqDictCreator()
+    if memory_budget_mb is not None:
+        if memory_budget_mb <= 0:
+            raise ValueError(f'memory_budget_mb must be positive but got {memory_budget_mb}')
+        budget_words = max(1, int(memory_budget_mb * 2**20) // WORD_BYTES)
+        max_words = budget_words if max_words is None else min(max_words, budget_words)
+
+    freq_dict_creator = FreqDictCreator(pretokenizer)
     freq_dict_creator.logger.info(f"Started creating word frequency dict from corpus {corpus_path}")
 
-    # Construct freq dict
-    total_freq_dict = Counter()
-    with open(corpus_path, 'r') as file:
-        total_lines = sum(1 for _ in file)
-        file.seek(0)
+    with tempfile.TemporaryDirectory(dir=Path(freq_dict_path).parent) as spill_dir:
+        # Construct freq dict
+        total_freq_dict = Counter()
+        runs = []
+        offset = 0  # position of the first word of the next run
+        total_lines = count_records(corpus_path)
 
-        with Pool(processes=processes, initializer=worker_init) as pool:
-            iterable = get_iterable(file, total_lines)
-            for freq_dict in pool.starmap(worker, iterable):
+        with get_pool(pool, processes, worker_init, (pretokenizer,)) as stage_pool:
+            iterable = get_iterable(read_records(corpus_path), total_lines, chunk_lines)
+            for freq_dict in stage_pool.imap(worker_star, iterable):
                 total_freq_dict.update(freq_dict)
+                if max_words is not None and len(total_freq_dict) > max_words:
+                    runs.append(write_run(total_freq_dict, offset, spill_dir))
+                    offset += len(total_freq_dict)
+                    total_freq_dict = Counter()
 
-    # Write freq dict to file
-    with open(freq_dict_path, 'w') as file:
-        json.dump(total_freq_dict, file)
+        if runs:
+            runs.append(write_run(total_freq_dict, offset, spill_dir))
+            total_freq_dict = None
+            freq_dict_creator.logger.info(f"Merging {len(runs)} runs spilled to disk")
+            items = restore_order(merge_runs(runs), max_words, spill_dir)
+        else:
+            items = total_freq_dict.items()
+
+        # Write freq dict to file
+        write_freq_dict(prune(items, min_freq, top_k), freq_dict_path, output_format)
 
     freq_dict_creator.logger.info(f"Finished creating word frequency dict from corpus {corpus_path}")
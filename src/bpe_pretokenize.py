@@ -0,0 +1,54 @@
+"""
+Core functionality for BPE pre-tokenization.
+
+Before BPE is applied, text is split into pre-tokens, and merges never cross
+the boundary between two pre-tokens. The same pre-tokenizer has to be used
+when creating the word frequency dict, the vocab, and when tokenizing text, so
+all three parts of the BPE tokenization pipeline use PreTokenizer:
+  1. Create word frequency dict: counts the pre-tokens of the corpus
+  2. Create vocab: adds the separator of the pre-tokens to the initial vocab
+  3. Tokenize text: applies the merges to each pre-token
+
+Two modes are available:
+  - 'space': split at spaces. The spaces are separators which are not part
+    of any pre-token, so "word", "word," and "word." are different pre-tokens.
+  - 'regex': split with a compiled regex, by default a GPT-2 style pattern
+    which separates letters, digits, punctuation and whitespace, and attaches
+    a single leading space to the pre-token following it. No characters are
+    dropped, i.e. the pre-tokens concatenate to the text, and "word", "word,"
+    and "word." all contain the pre-token "word". This shrinks the set of
+    distinct pre-tokens considerably.
+
+Contains:
+  - PreTokenizer: class for splitting text into pre-tokens.
+"""
+
+# Standard library
+import re
+from typing import Optional
+
+# GPT-2 pre-tokenization pattern, with the unicode classes \p{L} (letters) and
+# \p{N} (numbers) replaced by [^\W\d_] and \d, which the re module supports
+GPT2_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+"""
+
+
+class PreTokenizer:
+    """Class for splitting text into pre-tokens."""
+    MODES = ('space', 'regex')
+
+    def __init__(self, mode: str='space', pattern: Optional[str]=None) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f'mode must be one of {self.MODES} but got {mode}')
+        self.mode = mode
+        if mode == 'regex':
+            self.regex = re.compile(pattern or GPT2_PATTERN)
+            self.separator = ''
+        else:
+            self.separator = ' '
+
+    def split(self, text: str) -> list[str]:
+        """Split text into pre-tokens. The text is the pre-tokens joined by
+        self.separator."""
+        if self.mode == 'regex':
+            return self.regex.findall(text)
+        return text.split(' ')
@@ -6,36 +6,127 @@ This consitutes part 3/3 of the byte pair encoding (BPE) tokenization pipeline:
   2. Create vocab
   3. Tokenize text
 
+Two tokenization engines are available:
+  - 'greedy': at each position take the longest token in the vocab. The vocab 
+    is compiled into a trie when it is loaded, so that the longest match is 
+    found by walking the trie one character at a time. Characters which are 
+    not in the vocab become tokens of their own.
+  - 'bpe': split text into pre-tokens (with the same PreTokenizer as when 
+    creating the word frequency dict) and apply the BPE merges to each 
+    pre-token in the order of their rank, which reproduces the segmentation 
+    found while training the vocab. Tokenized pre-tokens are memoized in an 
+    LRU cache, so frequent words are only tokenized once.
+
+Each token is mapped to an integer id, namely its index in the vocab file 
+(characters which are not in the vocab get the id len(vocab)). Besides jsonl 
+files of tokens, tokenize_jsonl can write the token ids in binary form: flat 
+arrays of uint16 (or uint32 for vocabs with more than 65535 tokens) in .bin 
+shards, with offset arrays marking the boundaries of sentences, sections and 
+documents. These can be read with zero copies via numpy.memmap, see 
+TokenShardReader.
+
 Contains:
   - Tokenizer: class for BPE tokenization.
+  - TokenShardWriter: class for writing token ids to binary shards.
+  - TokenShardReader: class for reading token ids from binary shards.
   - tokenize_jsonl: function for BPE tokenization of text stored in jsonl file. 
     Can utilize multiple processors.
+  - get_id_dtype: function returning the numpy dtype of token ids.
 """
 
 # Standard library
 import json
 import sys
-from multiprocessing import Pool, current_process
+from functools import lru_cache
+from multiprocessing import current_process
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, Optional
+
+# Third-party
+import numpy as np
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from records import BATCH_BYTES, batch_records, count_records, load_record, read_records
+from workerpool import WorkerPool, get_pool
+from bpe_pretokenize import PreTokenizer
+from bpe_vocab import apply_merges, get_merges_path
 
 
 class Tokenizer:
-    """Class for BPE tokenization."""
-    def __init__(self, vocab_path: str) -> None:
+    """Class for BPE tokenization.
+
+    With the 'greedy' engine, a character which is not in the vocab becomes a
+    single-character token of its own (with the id len(vocab)). The original
+    greedy tokenizer, kept as tokenize_greedy_naive, loops forever on such a
+    character instead."""
+    ENGINES = ('greedy', 'bpe')
+
+    def __init__(self, 
+                 vocab_path: str, 
+                 engine: str='greedy', 
+                 merges_path: Optional[str]=None, 
+                 cache_size: int=2**16, 
+                 pretokenizer: str='space') -> None:
+        if engine not in self.ENGINES:
+            raise ValueError(f'engine must be one of {self.ENGINES} but got {engine}')
         self.vocab_path = vocab_path
+        self.engine = engine
+        self.merges_path = merges_path or get_merges_path(vocab_path)
+        self.pretokenizer = PreTokenizer(pretokenizer)
         self.load_vocab()
+        if engine == 'bpe':
+            self.load_merges()
+            self.bpe_word_cached = lru_cache(maxsize=cache_size)(self.bpe_word)
+            self.bpe_word_ids_cached = lru_cache(maxsize=cache_size)(self.bpe_word_ids)
         
         # Logger 
         self.logger = Logger('tokenize')
 
     def tokenize(self, text: str) -> list[str]:
         """Tokenize text."""
+        if self.engine == 'bpe':
+            return self.tokenize_bpe(text)
+        return self.tokenize_greedy(text)
+
+    def tokenize_greedy(self, text: str) -> list[str]:
+        """Tokenize text by taking the longest token at each position, found 
+        by walking self.trie. 
+        
+        Characters which are not in the vocab become single-character tokens
+        of their own, whereas tokenize_greedy_naive loops forever on them, so
+        the two only agree on text made of characters in the vocab."""
+        tokenized = []
+        trie = self.trie
+        n = len(text)
+
+        start = 0
+        while start < n:
+            # walk trie as long as the characters extend the current token
+            node = trie
+            end = start
+            while end < n:
+                node = node.get(text[end])
+                if node is None:
+                    break
+                end += 1
+
+            # unknown character
+            if end == start:
+                end += 1
+
+            tokenized.append(text[start:end])
+            start = end
+
+        return tokenized
+
+    def tokenize_greedy_naive(self, text: str) -> list[str]:
+        """Tokenize text by taking the longest token at each position, found 
+        by probing self.vocab with ever longer strings. Kept only as a 
+        reference for tokenize_greedy, which is used instead: it is slow, and
+        loops forever on characters which are not in the vocab."""
         # tokenized text list
         tokenized = []
 
@@ -61,14 +152,270 @@ class Tokenizer:
                 
         return tokenized
 
+    def tokenize_bpe(self, text: str) -> list[str]:
+        """Tokenize text by applying BPE merges to each pre-token (see 
+        PreTokenizer). Separators between pre-tokens become tokens of their 
+        own."""
+        tokenized = []
+        separator = self.pretokenizer.separator
+        for i, word in enumerate(self.pretokenizer.split(text)):
+            if i > 0 and separator:
+                tokenized.append(separator)
+            if word:
+                tokenized.extend(self.bpe_word_cached(word))
+        return tokenized
+
+    def tokenize_sections(self, 
+                          text_list: list[list[str]], 
+                          output_format: str='jsonl') -> str | tuple:
+        """Tokenize the sentences of a list of sections. 
+        
+        For output_format 'jsonl', returns the tokens as a json string, since 
+        a single string is much cheaper to send back to a parent process than 
+        nested lists of strings. For output_format 'bin', returns the token ids 
+        as a flat array, along with the number of tokens per sentence and 
+        sentences per section."""
+        if output_format == 'bin':
+            ids, offsets = self.encode_batch([sent for text in text_list for sent in text])
+            sentence_lens = np.diff(offsets)
+            section_lens = np.array([len(text) for text in text_list], dtype=np.int64)
+            return ids, sentence_lens, section_lens
+
+        tokenized_text_list = [[self.tokenize(sent) for sent in text]
+                               for text in text_list]
+        return json.dumps(tokenized_text_list)
+
+    def bpe_word(self, word: str) -> tuple[str, ...]:
+        """Tokenize a single pre-token by applying BPE merges in rank order 
+        (see apply_merges)."""
+        return tuple(apply_merges(list(word), self.merge_ranks))
+
+    def bpe_word_ids(self, word: str) -> tuple[int, ...]:
+        """Tokenize a single pre-token with bpe_word and return its token ids."""
+        token_ids = self.token_ids
+        return tuple(token_ids.get(token, self.unk_id) for token in self.bpe_word(word))
+
+    def encode(self, text: str) -> list[int]:
+        """Tokenize text and return list of token ids."""
+        token_ids = self.token_ids
+        return [token_ids.get(token, self.unk_id) for token in self.tokenize(text)]
+
+    def encode_batch(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Tokenize list of texts and return (ids, offsets): the token ids of 
+        all texts as one flat array of dtype self.id_dtype, and the offsets of 
+        the texts in it, i.e. the ids of text i are ids[offsets[i]:offsets[i+1]].
+
+        For the 'bpe' engine each distinct pre-token of the batch is looked up 
+        only once, in the LRU cache of tokenized pre-tokens shared by all 
+        batches."""
+        ids = []
+        offsets = [0]
+        if self.engine == 'bpe':
+            separator = self.pretokenizer.separator
+            separator_ids = [self.token_ids.get(separator, self.unk_id)] if separator else []
+            batch_ids = {}  # {pre-token: token ids}
+            for text in texts:
+                for i, word in enumerate(self.pretokenizer.split(text)):
+                    if i > 0:
+                        ids.extend(separator_ids)
+                    if word:
+                        word_ids = batch_ids.get(word)
+                        if word_ids is None:
+                            word_ids = batch_ids[word] = self.bpe_word_ids_cached(word)
+                        ids.extend(word_ids)
+                offsets.append(len(ids))
+        else:
+            for text in texts:
+                ids.extend(self.encode(text))
+                offsets.append(len(ids))
+        return np.array(ids, dtype=self.id_dtype), np.array(offsets, dtype=np.int64)
+
+    def decode(self, ids: list[int]) -> str:
+        """Return text given by list of token ids."""
+        return ''.join(self.id_tokens[i] for i in ids)
+
     def load_vocab(self) -> None:
-        """Loads vocab from file at self.vocab_path into set self.vocab."""
+        """Loads vocab from file at self.vocab_path into set self.vocab, and 
+        creates the token <-> id mappings self.token_ids and self.id_tokens. 
+        The id of a token is its index in the vocab file."""
         with open(self.vocab_path, 'r') as f:
-            self.vocab = set(json.load(f))
+            self.id_tokens = json.load(f)
+        self.vocab = set(self.id_tokens)
+        self.token_ids = {token: i for i, token in enumerate(self.id_tokens)}
+        self.unk_id = len(self.id_tokens)
+        self.id_dtype = get_id_dtype(self.unk_id + 1)  # ids go up to unk_id
+        self.build_trie()
+
+    def build_trie(self) -> None:
+        """Compiles self.vocab into trie self.trie of nested dicts 
+        {char: child node}. 
+        
+        A token is only inserted if all of its prefixes are tokens too, since 
+        the greedy tokenizer stops extending a token as soon as the extension 
+        is not in the vocab. Hence every node of the trie is a token."""
+        self.trie = {}
+        for token in sorted(self.vocab, key=len):
+            node = self.trie
+            for char in token[:-1]:
+                node = node.get(char)
+                if node is None:
+                    break
+            else:
+                node.setdefault(token[-1], {})
+
+    def load_merges(self) -> None:
+        """Loads merges from file at self.merges_path into dict 
+        self.merge_ranks = {pair: rank}."""
+        with open(self.merges_path, 'r') as f:
+            merges = json.load(f)
+        self.merge_ranks = {}
+        for rank, (t1, t2) in enumerate(merges):
+            self.merge_ranks.setdefault((t1, t2), rank)
+
+class TokenShardWriter:
+    """Class for writing token ids to binary shards.
+
+    Writes documents (lists of sections, which are lists of sentences, which 
+    are arrays of token ids) to the files:
+      - {prefix}_{k:05d}.bin: token ids of shard k, as raw uint16 or uint32
+      - {prefix}_{k:05d}.sentences.npy: token offsets of the sentences
+      - {prefix}_{k:05d}.sections.npy: sentence offsets of the sections
+      - {prefix}_{k:05d}.documents.npy: section offsets of the documents
+      - {prefix}.json: manifest with dtype, vocab size, and the urls and sizes 
+        of the shards
+    Each offset array has one more element than there are items, i.e. the 
+    tokens of sentence i of a shard are tokens[sentences[i]:sentences[i+1]]. 
+    A new shard is started once the current one holds shard_tokens tokens."""
+    def __init__(self, 
+                 prefix: str, 
+                 vocab_size: int, 
+                 shard_tokens: int=2**28) -> None:
+        self.prefix = prefix
+        self.vocab_size = vocab_size
+        self.dtype = get_id_dtype(vocab_size)
+        self.shard_tokens = shard_tokens
+        self.shards = []
+        self.file = None
+
+    def __enter__(self) -> 'TokenShardWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def open_shard(self) -> None:
+        """Starts a new shard."""
+        self.name = f'{Path(self.prefix).name}_{len(self.shards):05d}'
+        self.file = open(f'{self.prefix}_{len(self.shards):05d}.bin', 'wb')
+        self.n_tokens = 0
+        self.sentences = [0]
+        self.sections = [0]
+        self.documents = [0]
+        self.urls = []
+
+    def close_shard(self) -> None:
+        """Finishes the current shard, writing its offset arrays."""
+        self.file.close()
+        path = f'{self.prefix}_{len(self.shards):05d}'
+        np.save(f'{path}.sentences.npy', np.array(self.sentences, dtype=np.int64))
+        np.save(f'{path}.sections.npy', np.array(self.sections, dtype=np.int64))
+        np.save(f'{path}.documents.npy', np.array(self.documents, dtype=np.int64))
+        self.shards.append({'name': self.name, 
+                            'n_tokens': self.n_tokens, 
+                            'urls': self.urls})
+        self.file = None
+
+    def write(self, 
+              url: str, 
+              ids: np.ndarray, 
+              sentence_lens: np.ndarray, 
+              section_lens: np.ndarray) -> None:
+        """Writes a document, given as a flat array of token ids, the number of 
+        tokens of each sentence, and the number of sentences of each section."""
+        if self.file is None:
+            self.open_shard()
+
+        self.file.write(np.asarray(ids, dtype=self.dtype).tobytes())
+        self.sentences.extend((self.n_tokens + np.cumsum(sentence_lens)).tolist())
+        self.sections.extend((self.sentences_count() - len(sentence_lens)
+                              + np.cumsum(section_lens)).tolist())
+        self.documents.append(len(self.sections) - 1)
+        self.urls.append(url)
+        self.n_tokens += len(ids)
+
+        if self.n_tokens >= self.shard_tokens:
+            self.close_shard()
+
+    def sentences_count(self) -> int:
+        """Number of sentences in current shard."""
+        return len(self.sentences) - 1
+
+    def close(self) -> None:
+        """Finishes the last shard and writes the manifest."""
+        if self.file is not None:
+            self.close_shard()
+        manifest = {'dtype': np.dtype(self.dtype).name, 
+                    'vocab_size': self.vocab_size, 
+                    'shards': self.shards}
+        with open(f'{self.prefix}.json', 'w') as f:
+            json.dump(manifest, f)
+
+
+class TokenShardReader:
+    """Class for reading token ids from binary shards written by 
+    TokenShardWriter. Token ids and offset arrays are memory-mapped, so 
+    reading them doesn't copy any data."""
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        with open(f'{prefix}.json', 'r') as f:
+            self.manifest = json.load(f)
+        self.dtype = np.dtype(self.manifest['dtype'])
+
+        directory = Path(prefix).parent
+        self.shards = []
+        for shard in self.manifest['shards']:
+            path = str(directory/shard['name'])
+            self.shards.append({
+                'tokens': np.memmap(f'{path}.bin', dtype=self.dtype, mode='r'),
+                'sentences': np.load(f'{path}.sentences.npy', mmap_mode='r'),
+                'sections': np.load(f'{path}.sections.npy', mmap_mode='r'),
+                'documents': np.load(f'{path}.documents.npy', mmap_mode='r'),
+                'urls': shard['urls'],
+            })
+
+    def __len__(self) -> int:
+        """Number of documents."""
+        return sum(len(shard['urls']) for shard in self.shards)
+
+    def __iter__(self) -> Iterator[tuple[str, list[list[np.ndarray]]]]:
+        """Iterates over (url, document) pairs, see document()."""
+        for shard in self.shards:
+            for doc_idx, url in enumerate(shard['urls']):
+                yield url, self.document(shard, doc_idx)
+
+    def document(self, 
+                 shard: dict, 
+                 doc_idx: int) -> list[list[np.ndarray]]:
+        """Returns document doc_idx of shard as list of sections, each a list 
+        of sentences, each an array (view) of token ids."""
+        tokens = shard['tokens']
+        sentences = shard['sentences']
+        sections = shard['sections']
+        documents = shard['documents']
+
+        document = []
+        for sec in range(documents[doc_idx], documents[doc_idx + 1]):
+            document.append([tokens[sentences[sent]:sentences[sent + 1]] 
+                             for sent in range(sections[sec], sections[sec + 1])])
+        return document
+
 
 # Multiprocessing functions
 
-def worker_init(vocab_path: str) -> None:
+def worker_init(vocab_path: str, 
+                engine: str, 
+                merges_path: Optional[str], 
+                pretokenizer: str) -> None:
     """Initializes worker."""
     # Print current process
     process = current_process()
@@ -76,30 +423,45 @@ def worker_init(vocab_path: str) -> None:
 
     # Create tokenizer for this process
     global tokenizer
-    tokenizer = Tokenizer(vocab_path)
+    tokenizer = Tokenizer(vocab_path, engine, merges_path, 
+                          pretokenizer=pretokenizer)
     
-def get_iterable(file, total_lines: int) -> Iterator[int, str, int]:
-    """Generator of worker() arguments."""
-    for page_num, line in enumerate(file, 1):
-        yield (page_num, line, total_lines)
+def get_iterable(records: Iterator[str | bytes], 
+                 total_lines: int, 
+                 output_format: str, 
+                 batch_bytes: int) -> Iterator[tuple[int, list[str | bytes], int, str]]:
+    """Generator of worker() arguments: batches of about batch_bytes of 
+    records (see batch_records), with the page number of their first record."""
+    for first_page_num, batch in batch_records(records, batch_bytes):
+        yield (first_page_num, batch, total_lines, output_format)
 
-def worker(page_num: int, 
-           line: str, 
-           total_lines: int) -> tuple[str, list[list[list[str]]]]:
-    """Tokenizes texts in jsonl entry given by line."""    
-    # read from line
-    entry = json.loads(line)
-    url = entry['url']
-    text_list = entry['text_list']
+def worker(first_page_num: int, 
+           records: list[str | bytes], 
+           total_lines: int, 
+           output_format: str) -> list[tuple[str, str | tuple]]:
+    """Tokenizes texts in the entries given by records, returning the tokens 
+    of each entry as a json string. 
+    
+    For output_format 'bin', returns the token ids of each entry as a flat 
+    array, along with the number of tokens per sentence and sentences per 
+    section."""
+    results = []
+    for page_num, record in enumerate(records, first_page_num):
+        # read from record
+        entry = load_record(record)
+        url = entry['url']
+        text_list = entry['text_list']
 
-    # log
-    tokenizer.logger.info(f"Tokenizing page {page_num} / {total_lines}: {url}")
+        # log
+        tokenizer.logger.info(f"Tokenizing page {page_num} / {total_lines}: {url}")
 
-    # tokenize
-    tokenized_text_list = [[tokenizer.tokenize(sent) for sent in text]
-                           for text in text_list]
+        # tokenize
+        results.append((url, tokenizer.tokenize_sections(text_list, output_format)))
+    return results
 
-    return url, tokenized_text_list
+def worker_star(args: tuple[int, list[str | bytes], int, str]) -> list[tuple[str, str | tuple]]:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
 
 
 
@@ -108,28 +470,57 @@ def worker(page_num: int,
 def tokenize_jsonl(inpath: str, 
                    outpath: str, 
                    vocab_path, 
-                   processes: int) -> None:
-    """Tokenize text stored in .jsonl file."""
+                   processes: int,
+                   engine: str='greedy',
+                   merges_path: Optional[str]=None,
+                   output_format: str='jsonl',
+                   shard_tokens: int=2**28, 
+                   pretokenizer: str='space', 
+                   pool: Optional[WorkerPool]=None, 
+                   batch_bytes: int=BATCH_BYTES) -> None:
+    """Tokenize text stored in .jsonl file.
+    
+    For output_format 'jsonl', writes the tokens of each entry to outpath. For 
+    output_format 'bin', writes the token ids to binary shards with prefix 
+    outpath (see TokenShardWriter). The 'bpe' engine splits text with the 
+    pretokenizer the vocab was created with (see PreTokenizer). The input can
+    also be a binary record file (see records.py). Each worker task tokenizes
+    a batch of about batch_bytes of input records. If a warm WorkerPool is 
+    given, its workers are used instead of processes new ones."""
+    if output_format not in ('jsonl', 'bin'):
+        raise ValueError(f"output_format must be 'jsonl' or 'bin' but got {output_format}")
 
-    tokenizer = Tokenizer(vocab_path)
+    tokenizer = Tokenizer(vocab_path, engine, merges_path, 
+                          pretokenizer=pretokenizer)
     tokenizer.logger.info(f"Started tokenizing {inpath}")
 
-    with open(inpath, 'r') as infile, open(outpath, 'w') as outfile:
-        total_lines = sum(1 for _ in infile)
-        infile.seek(0)
-
-        with Pool(processes=processes, 
-                  initializer=worker_init, 
-                  initargs=(vocab_path,)) as pool:
-            # create iterable of arguments for worker
-            iterable = get_iterable(infile, total_lines, )
-
-            # Loop over iterable. Each set of args from iterable gets passed
-            # to first available processor. The processor computes worker(*args)
-            # and the result gets unpacked 
-            for url, text_list in pool.starmap(worker, iterable):
-                entry = {'url': url, 'text_list': text_list}
-                json.dump(entry, outfile)
-                outfile.write('\n')
-
-        tokenizer.logger.info(f"Finished tokenizing {inpath}")
+    total_lines = count_records(inpath)
+
+    if output_format == 'bin':
+        # ids go up to unk_id = len(vocab)
+        writer = TokenShardWriter(outpath, tokenizer.unk_id + 1, shard_tokens)
+    else:
+        writer = open(outpath, 'w')
+
+    with writer, get_pool(pool, processes, worker_init, 
+                          (vocab_path, engine, merges_path, pretokenizer)) as stage_pool:
+        # create iterable of arguments for worker
+        iterable = get_iterable(read_records(inpath), total_lines, output_format, batch_bytes)
+
+        # Loop over iterable. Each batch of records from iterable gets passed
+        # to first available processor. The processor computes worker(*args)
+        # and the results of the batch get unpacked in order
+        for results in stage_pool.imap(worker_star, iterable):
+            for url, text_list in results:
+                if output_format == 'bin':
+                    writer.write(url, *text_list)
+                else:
+                    # same as json.dump({'url': url, 'text_list': text_list})
+                    writer.write(f'{{"url": {json.dumps(url)}, "text_list": {text_list}}}\n')
+
+    tokenizer.logger.info(f"Finished tokenizing {inpath}")
+
+
+def get_id_dtype(vocab_size: int) -> type:
+    """Return smallest numpy dtype for token ids < vocab_size."""
+    return np.uint16 if vocab_size <= 2**16 else np.uint32
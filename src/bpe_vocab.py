@@ -6,15 +6,57 @@ This consitutes part 2/3 of the byte pair encoding (BPE) tokenization pipeline:
   2. Create vocab
   3. Tokenize text
 
+The words of the word frequency dict are stored compactly as integer symbol 
+ids (one per token) in a flat buffer with per-word offsets (WordShard), rather 
+than as lists of strings; merged tokens are interned as new symbol ids.
+
+By default the vocab is trained incrementally: pair counts and a pair -> words 
+index are built once, each merge only updates the words which contain the 
+merged pair, and the most frequent pair is taken from a lazy max-heap. Ties 
+are broken exactly like the naive trainer (which recounts all pairs for every 
+merge), i.e. in favour of the pair occurring first in the word frequency dict, 
+so both trainers produce the same merges.
+
+The incremental trainer can also run on several processes: the words are split 
+into contiguous shards, each held by a worker process as a WordShard. Workers 
+count the pairs of their shard and, for each merge, update the words of their 
+shard and send the pair frequency deltas back to the parent, which reduces 
+them and picks the next pair.
+
+The vocab is saved as a json list of tokens (the initial characters, followed 
+by the merged tokens in the order they were added), together with a json list 
+of the merges, i.e. the merged pairs of tokens ordered by rank.
+
+Long training runs can be checkpointed every n merges: the checkpoint holds 
+the merges so far and the flat buffer of symbol ids of all words, and training 
+can be resumed from it. An existing vocab can also be extended without a 
+checkpoint, by replaying its merges on the words of the word frequency dict 
+(which reproduces the training segmentation).
+Both check that the word frequency dict is the one the vocab was trained on 
+(same number of words and alphabet), from the checkpoint header or from the 
+meta file saved next to the vocab.
+
 Contains:
   - Vocab: BPE vocabulary class.
+  - WordShard: class for a shard of words stored as symbol ids.
+  - shard_worker: function running a WordShard in a worker process.
+  - merge_symbols: function merging a pair of symbol ids in a word.
+  - apply_merges: function applying ranked BPE merges to a list of tokens.
+  - get_merges_path: function returning the default path of the merges file.
+  - get_meta_path: function returning the default path of the meta file.
+  - get_checkpoint_path: function returning the default path of the checkpoint.
 """
 
 # Standard library
+import heapq
 import json
+import os
 import sys
 import warnings
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
 from pathlib import Path
 from typing import Optional
 
@@ -25,23 +67,58 @@ from tqdm import tqdm
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from profiler import profile
+from bpe_freqdict import read_freq_dict
+from bpe_pretokenize import PreTokenizer
+
+CHECKPOINT_MAGIC = b'BPECKPT1'
 
 
 class Vocab:
-    """BPE vocabulary class."""
-    def __init__(self, freq_dict_path: str, vocab_path: str) -> None:
+    """BPE vocabulary class.
+
+    The words of the word frequency dict are stored as symbol ids (token ids, 
+    i.e. indices into self.symbols) in a WordShard, i.e. in one flat integer 
+    buffer with the length and frequency of each word. Merged tokens are 
+    interned as new symbol ids."""
+    def __init__(self, 
+                 freq_dict_path: str, 
+                 vocab_path: str, 
+                 merges_path: Optional[str]=None, 
+                 checkpoint_path: Optional[str]=None, 
+                 pretokenizer: str='space') -> None:
         self.freq_dict_path = freq_dict_path
         self.vocab_path = vocab_path
+        self.merges_path = merges_path or get_merges_path(vocab_path)
+        self.checkpoint_path = checkpoint_path or get_checkpoint_path(vocab_path)
+
+        self.pretokenizer = PreTokenizer(pretokenizer)
+
+        # store words as ids of their characters, in order of first occurrence
+        # (the separator of the pre-tokens, if any, is part of the vocab)
+        char_ids = {c: i for i, c in enumerate(self.pretokenizer.separator)}
+        symbols, lens, freqs = array('i'), array('i'), array('q')
+        for word, freq in read_freq_dict(freq_dict_path):
+            for c in word:
+                if c not in char_ids:
+                    char_ids[c] = len(char_ids)
+                symbols.append(char_ids[c])
+            lens.append(len(word))
+            freqs.append(freq)
 
-        # initialize vocab and create freq_tokens dict
-        self.freq_tokens = {}  # {word1: (freq1, tokens1), etc.}
-        self.vocab = set(' ')  # since we split at spaces
-        with open(freq_dict_path, 'r') as f:
-            freq_dict: dict[str, int] = json.load(f)
-            for word, freq in freq_dict.items():
-                tokens = [c for c in word]
-                self.vocab.update(tokens)
-                self.freq_tokens[word] = (freq, tokens)
+        # initialize vocab to the characters of all words, and renumber them 
+        # to symbol ids in sorted order
+        self.vocab = set(char_ids)
+        self.alphabet = sorted(self.vocab)
+        self.merges = []  # merged pairs, ordered by rank
+        self.symbols = list(self.alphabet)  # tokens, indexed by symbol id
+        self.symbol_ids = {token: i for i, token in enumerate(self.symbols)}
+        char_symbols = [self.symbol_ids[c] for c in char_ids]
+        symbols = array('i', (char_symbols[i] for i in symbols))
+        self.shard = WordShard(symbols, lens, freqs, 0, self.symbol_lens())
+
+        self.trainer = None  # set by increase_vocab
+        self.shard_conns = []  # connections to running shard workers
 
         # Logger
         self.logger = Logger('vocab')
@@ -50,38 +127,107 @@ class Vocab:
         """Size of vocabulary."""
         return len(self.vocab)
 
-    def increase_vocab(self, size: int) -> None:
-        """Increase vocab to specified size by performing BPE merges."""
+    def increase_vocab(self, 
+                       size: int, 
+                       incremental: bool=True, 
+                       processes: int=1, 
+                       checkpoint_every: Optional[int]=None) -> None:
+        """Increase vocab to specified size by performing BPE merges. 
+        
+        If incremental is False, all pair frequencies are recounted for every 
+        merge (slow, kept for reference). If processes > 1, the incremental 
+        trainer is run on that many word shards in worker processes. If 
+        checkpoint_every is set, a checkpoint is saved every that many merges 
+        (see resume)."""
         if size < len(self):
             raise ValueError(f'target vocab size ({size}) cannot be less than initial vocab size ({len(self)})')
 
         self.logger.info(f'Increasing vocab size from {len(self)} to {size}')
 
-        for s in tqdm(range(len(self.vocab), size)):
-            pair = self.most_frequent_pair()
-            if pair is None:
-                msg = f'Vocab size reached maximal value of {s}, which is smaller than target value {size}.\n'
-                warnings.warn(msg)
-                self.logger.info(msg)
-                break
-            joined = ''.join(pair)
-            self.vocab.add(joined)
-            self.merge(pair)
-            self.logger.info(f'Vocab increased to size {s:6d} (target {size}): Added {joined} = {pair[0]} + {pair[1]}.')
+        with profile('increase_vocab'):
+            if processes > 1:
+                self.trainer = 'sharded'
+                with profile('start_shards'):
+                    self.start_shards(processes)
+            elif incremental:
+                self.trainer = 'incremental'
+                with profile('init_pair_stats'):
+                    self.init_pair_stats()
+            else:
+                self.trainer = 'naive'
+
+            try:
+                for s in tqdm(range(len(self.vocab), size)):
+                    with profile('next_pair'):
+                        pair = self.next_pair()
+                    if pair is None:
+                        msg = f'Vocab size reached maximal value of {s}, which is smaller than target value {size}.\n'
+                        warnings.warn(msg)
+                        self.logger.info(msg)
+                        break
+                    joined = ''.join(pair)
+                    self.vocab.add(joined)
+                    self.merges.append(pair)
+                    with profile('apply_merge'):
+                        self.apply_merge(pair)
+                    self.logger.info(f'Vocab increased to size {s:6d} (target {size}): Added {joined} = {pair[0]} + {pair[1]}.')
+                    if checkpoint_every and len(self.merges) % checkpoint_every == 0:
+                        with profile('save_checkpoint'):
+                            self.save_checkpoint()
+            finally:
+                if self.trainer == 'sharded':
+                    self.stop_shards()
 
         self.save_vocab()
+        if checkpoint_every:
+            self.save_checkpoint()
         self.logger.info(f'Finished increasing vocab.\n')
 
-    def most_frequent_pair(self) -> Optional[tuple[str, str]]:
-        """Return most frequent pair of adjacent tokens from token lists in 
-        self.freq_tokens"""
+    def next_pair(self) -> Optional[tuple[str, str]]:
+        """Return next pair to merge, using the current trainer."""
+        if self.trainer == 'naive':
+            pair = self.most_frequent_pair()
+        else:
+            pair = self.pop_most_frequent_pair()
+        if pair is None:
+            return None
+        return (self.symbols[pair[0]], self.symbols[pair[1]])
+
+    def apply_merge(self, pair: tuple[str, str]) -> None:
+        """Merge given pair of tokens, using the current trainer."""
+        pair_ids = (self.symbol_ids[pair[0]], self.symbol_ids[pair[1]])
+        joined = ''.join(pair)
+        new_symbol = self.intern(joined)
+        if self.trainer == 'naive':
+            self.merge(pair_ids, new_symbol)
+        elif self.trainer == 'incremental':
+            self.merge_incremental(pair_ids, new_symbol, len(joined))
+        else:
+            self.merge_sharded(pair_ids, new_symbol, len(joined))
+
+    def intern(self, token: str) -> int:
+        """Return symbol id of token, adding token to self.symbols if new."""
+        if token not in self.symbol_ids:
+            self.symbol_ids[token] = len(self.symbols)
+            self.symbols.append(token)
+        return self.symbol_ids[token]
+
+    def symbol_lens(self) -> list[int]:
+        """Return number of characters of each symbol."""
+        return [len(token) for token in self.symbols]
+
+    def most_frequent_pair(self) -> Optional[tuple[int, int]]:
+        """Return most frequent pair of adjacent symbols in the words."""
         # create pair frequency dict
         pair_freq = defaultdict(int)  # {pair1: freq1, etc.}
-        for freq, tokens in self.freq_tokens.values():
-            if len(tokens) < 2:
+        shard = self.shard
+        for idx in range(len(shard.lens)):
+            if shard.lens[idx] < 2:
                 continue
-            for t1, t2 in zip(tokens[:-1], tokens[1:]):
-                pair_freq[(t1, t2)] += freq
+            symbols = shard.word(idx)
+            freq = shard.freqs[idx]
+            for pair in zip(symbols[:-1], symbols[1:]):
+                pair_freq[pair] += freq
             
         # return most frequent pair
         if pair_freq:
@@ -90,33 +236,512 @@ class Vocab:
         else:
             return None
 
-    def merge(self, pair: tuple[str, str]) -> None:
-        """Merge given pair of tokens in all token lists in self.freq_tokens."""
-        for word in self.freq_tokens:
-            freq, tokens = self.freq_tokens[word]
-            if len(tokens) < 2:
+    def merge(self, pair: tuple[int, int], new_symbol: int) -> None:
+        """Merge given pair of symbols into new_symbol in all words."""
+        shard = self.shard
+        for idx in range(len(shard.lens)):
+            if shard.lens[idx] < 2:
                 continue
+            shard.set_word(idx, merge_symbols(shard.word(idx), pair, new_symbol))
+            
+    ##########################  Incremental trainer  ##########################
+
+    def init_pair_stats(self) -> None:
+        """Initialize pair statistics of the words (see WordShard), and the 
+        lazy max-heap of (-freq, word index, offset, pair) used by the 
+        incremental trainer. The first occurrence of a pair is used to break 
+        ties between pairs of equal frequency in the same way as 
+        most_frequent_pair."""
+        self.shard.symbol_lens = self.symbol_lens()
+        stats = self.shard.count_pairs()
+        self.pair_freq = self.shard.pair_freq
+        self.pair_first = self.shard.pair_first
 
-            # merge all occurences of pair in tokens, creating new_tokens list
-            new_tokens = []
-            i = 0
-            while i < len(tokens):
-                t1 = tokens[i]
-                t2 = tokens[i+1] if i+1 < len(tokens) else None
-                # if t1 and t2 form desired pair, append pair to new_tokens
-                if (t1, t2) == pair:
-                    new_tokens.append(''.join(pair))
-                    i += 2
-                # otherwise append t1 to new_tokens
+        self.pair_heap = [(-freq, *first, pair) 
+                          for pair, (freq, first) in stats.items()]
+        heapq.heapify(self.pair_heap)
+
+    def pop_most_frequent_pair(self) -> Optional[tuple[int, int]]:
+        """Return most frequent pair of adjacent symbols, popping stale heap 
+        entries (whose frequency or first occurrence has since changed)."""
+        while self.pair_heap:
+            neg_freq, word_idx, offset, pair = heapq.heappop(self.pair_heap)
+            if (self.pair_freq.get(pair) == -neg_freq 
+                and self.pair_first.get(pair) == (word_idx, offset)):
+                return pair
+        return None
+
+    def merge_incremental(self, 
+                          pair: tuple[int, int], 
+                          new_symbol: int, 
+                          new_len: int) -> None:
+        """Merge given pair of symbols in the words which contain it, and push 
+        the pairs whose statistics changed onto the heap."""
+        for p, (_, first) in self.shard.merge(pair, new_symbol, new_len).items():
+            if first is not None:
+                heapq.heappush(self.pair_heap, (-self.pair_freq[p], *first, p))
+
+    ############################  Sharded trainer  ############################
+
+    def start_shards(self, processes: int) -> None:
+        """Split words into contiguous shards, start one worker process per 
+        shard, and reduce the initial pair statistics of the shards.
+
+        The parent keeps the total pair frequencies, the first occurrence of 
+        each pair in each shard (self.shard_firsts), and the lazy max-heap."""
+        symbol_lens = self.symbol_lens()
+        num_words = len(self.shard.lens)
+        shard_size = -(-num_words // processes)
+        self.shard_conns = []
+        self.shard_procs = []
+        for word_offset in range(0, num_words, shard_size):
+            word_stop = word_offset + shard_size
+            symbols, lens = self.shard.words(word_offset, word_stop)
+            freqs = self.shard.freqs[word_offset:word_stop]
+
+            conn, child_conn = Pipe()
+            proc = Process(target=shard_worker, 
+                           args=(child_conn, symbols, lens, freqs, 
+                                 word_offset, symbol_lens), 
+                           daemon=True)
+            proc.start()
+            self.shard_conns.append(conn)
+            self.shard_procs.append(proc)
+
+        # reduce initial pair statistics
+        self.pair_freq = defaultdict(int)
+        self.pair_first = {}
+        self.shard_firsts = []
+        for conn in self.shard_conns:
+            firsts = {}
+            for pair, (freq, first) in conn.recv().items():
+                self.pair_freq[pair] += freq
+                firsts[pair] = first
+                if pair not in self.pair_first:  # shards are in word order
+                    self.pair_first[pair] = first
+            self.shard_firsts.append(firsts)
+
+        self.pair_heap = [(-freq, *self.pair_first[pair], pair) 
+                          for pair, freq in self.pair_freq.items()]
+        heapq.heapify(self.pair_heap)
+
+    def merge_sharded(self, 
+                      pair: tuple[int, int], 
+                      new_symbol: int, 
+                      new_len: int) -> None:
+        """Send merge of given pair of symbols to the shards containing it, and 
+        reduce the pair statistics deltas they send back."""
+        shards = [k for k, firsts in enumerate(self.shard_firsts) 
+                  if pair in firsts]
+        for k in shards:
+            self.shard_conns[k].send(('merge', pair, new_symbol, new_len))
+
+        touched = set()
+        for k in shards:
+            firsts = self.shard_firsts[k]
+            for p, (delta, first) in self.shard_conns[k].recv().items():
+                self.pair_freq[p] += delta
+                if first is None:
+                    firsts.pop(p, None)
                 else:
-                    new_tokens.append(t1)
-                    i += 1
+                    firsts[p] = first
+                touched.add(p)
+
+        for p in touched:
+            if self.pair_freq.get(p, 0) <= 0:
+                self.pair_freq.pop(p, None)
+                self.pair_first.pop(p, None)
+                continue
+            first = min(firsts[p] for firsts in self.shard_firsts if p in firsts)
+            self.pair_first[p] = first
+            heapq.heappush(self.pair_heap, (-self.pair_freq[p], *first, p))
+
+    def shard_words(self) -> tuple[array, array]:
+        """Return (symbols, lens) with the current symbol ids of all words, 
+        concatenated in word order, and the number of symbols of each word."""
+        symbols, lens = array('i'), array('i')
+        for conn in self.shard_conns:
+            conn.send(('words',))
+            shard_symbols, shard_lens = conn.recv()
+            symbols.extend(shard_symbols)
+            lens.extend(shard_lens)
+        return symbols, lens
+
+    def stop_shards(self) -> None:
+        """Copy the words back from the shards into self.shard, and stop the 
+        worker processes."""
+        symbols, lens = self.shard_words()
+        self.shard = WordShard(symbols, lens, self.shard.freqs, 0, self.symbol_lens())
+        for conn, proc in zip(self.shard_conns, self.shard_procs):
+            conn.send(('stop',))
+            proc.join()
+        self.shard_conns = []
+        self.shard_procs = []
+
+    #########################  Checkpoint and resume  #########################
+
+    def save_checkpoint(self) -> None:
+        """Save merges so far and the current segmentation of all words (as 
+        symbol ids, i.e. token ids in self.tokens()) to self.checkpoint_path.
+
+        The file consists of CHECKPOINT_MAGIC, the length of a json header 
+        (8 bytes, little endian), the json header, the number of symbols of 
+        each word and the flat buffer of symbol ids (both int32). It is 
+        written to a temporary file first, so an interrupted write does not 
+        corrupt the previous checkpoint."""
+        if self.shard_conns:
+            symbols, lens = self.shard_words()
+        else:
+            symbols, lens = self.shard.words()
+
+        header = json.dumps({
+            'freq_dict_path': self.freq_dict_path, 
+            'words': len(lens), 
+            'alphabet': self.alphabet, 
+            'merges': [list(pair) for pair in self.merges], 
+        }).encode('utf-8')
+
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(CHECKPOINT_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            lens.tofile(f)
+            symbols.tofile(f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.save_vocab()
+        self.logger.info(f'Saved checkpoint with {len(self.merges)} merges to {self.checkpoint_path}')
+
+    def load_checkpoint(self) -> None:
+        """Restore merges and segmentation of all words from the checkpoint 
+        at self.checkpoint_path."""
+        with open(self.checkpoint_path, 'rb') as f:
+            if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+                raise ValueError(f'{self.checkpoint_path} is not a BPE checkpoint')
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len).decode('utf-8'))
+            self.check_freq_dict(header, f'checkpoint {self.checkpoint_path}')
+            lens = array('i')
+            lens.fromfile(f, header['words'])
+            symbols = array('i')
+            symbols.frombytes(f.read())
+
+        self.set_merges([tuple(pair) for pair in header['merges']])
+        self.shard = WordShard(symbols, lens, self.shard.freqs, 0, self.symbol_lens())
+        self.logger.info(f'Loaded checkpoint with {len(self.merges)} merges from {self.checkpoint_path}')
+
+    def load_merges(self) -> None:
+        """Restore merges from the merges file at self.merges_path, and 
+        segment all words by replaying them (see apply_merges). The vocab 
+        must have been trained on the same word frequency dict, according to
+        its meta file (see save_vocab)."""
+        meta_path = get_meta_path(self.vocab_path)
+        if not os.path.exists(meta_path):
+            raise ValueError(f'cannot check that vocab {self.vocab_path} matches word frequency dict {self.freq_dict_path}: meta file {meta_path} is missing')
+        with open(meta_path, 'r') as f:
+            self.check_freq_dict(json.load(f), f'vocab {self.vocab_path}')
+
+        with open(self.merges_path, 'r') as f:
+            merges = [tuple(pair) for pair in json.load(f)]
+        merge_ranks = {}
+        for rank, pair in enumerate(merges):
+            merge_ranks.setdefault(pair, rank)
+
+        old_symbols = self.symbols
+        self.set_merges(merges)
+        symbols, lens = array('i'), array('i')
+        for idx in range(len(self.shard.lens)):
+            word = ''.join(old_symbols[i] for i in self.shard.word(idx))
+            tokens = apply_merges(list(word), merge_ranks)
+            symbols.extend(self.symbol_ids[token] for token in tokens)
+            lens.append(len(tokens))
+        self.shard = WordShard(symbols, lens, self.shard.freqs, 0, self.symbol_lens())
+        self.logger.info(f'Replayed {len(self.merges)} merges from {self.merges_path}')
+
+    def check_freq_dict(self, header: dict, name: str) -> None:
+        """Raise ValueError if the number of words or the alphabet in header
+        (of a checkpoint or vocab meta file) differ from those of the word 
+        frequency dict, i.e. if name was trained on another freq dict."""
+        if header['words'] != len(self.shard.lens) or header['alphabet'] != self.alphabet:
+            raise ValueError(f'{name} does not match word frequency dict {self.freq_dict_path}')
+
+    def set_merges(self, merges: list[tuple[str, str]]) -> None:
+        """Set merges, and the vocab and symbols resulting from them."""
+        self.merges = merges
+        self.symbols = self.tokens()
+        self.symbol_ids = {token: i for i, token in enumerate(self.symbols)}
+        self.vocab = set(self.symbols)
+
+    def resume(self) -> bool:
+        """Continue from a previous run: load the checkpoint if it exists, 
+        otherwise replay the merges of an existing vocab. Returns False if 
+        there is neither, i.e. training starts from the characters."""
+        if os.path.exists(self.checkpoint_path):
+            self.load_checkpoint()
+        elif os.path.exists(self.merges_path):
+            self.load_merges()
+        else:
+            return False
+        return True
+
+    def tokens(self) -> list[str]:
+        """Return list of tokens in vocab, ordered by id: the initial 
+        characters, followed by the merged tokens in the order they were added."""
+        return list(dict.fromkeys(self.alphabet + [''.join(pair) for pair in self.merges]))
+
+    def token_ids(self) -> dict[str, int]:
+        """Return {token: id} mapping of the vocab. Ids are stable, i.e. 
+        increasing the vocab size only adds new ids."""
+        return {token: i for i, token in enumerate(self.tokens())}
 
-            # replace tokens with new_tokens
-            self.freq_tokens[word] = (freq, new_tokens)
-            
     def save_vocab(self) -> None:
-        """Save vocab to file."""
+        """Save vocab (ordered by token id) and merges to file, and the word
+        frequency dict they were trained on (path, number of words and 
+        alphabet) to the meta file, which load_merges checks."""
+        tokens = self.tokens()
         with open(self.vocab_path, 'w') as f:
-            json.dump(list(self.vocab), f)
+            json.dump(tokens, f)
+        with open(self.merges_path, 'w') as f:
+            json.dump([list(pair) for pair in self.merges], f)
+        with open(get_meta_path(self.vocab_path), 'w') as f:
+            json.dump({
+                'freq_dict_path': self.freq_dict_path, 
+                'words': len(self.shard.lens), 
+                'alphabet': self.alphabet, 
+            }, f)
+
+
+class WordShard:
+    """Class for a shard of words stored as symbol ids, with the pair 
+    statistics needed for incremental BPE training.
+
+    The symbols of all words are stored in one flat integer buffer, with the 
+    start offset and current length of each word. Merges shrink words in place. 
+    Pairs of symbol ids are tracked with their frequency, the words containing 
+    them, and their first occurrence (global word index, char offset)."""
+    def __init__(self, 
+                 symbols: array, 
+                 lens: array, 
+                 freqs: array, 
+                 word_offset: int, 
+                 symbol_lens: list[int]) -> None:
+        self.symbols = symbols
+        self.lens = lens
+        self.freqs = freqs
+        self.starts = array('q', [0] * len(lens))
+        start = 0
+        for i, length in enumerate(lens):
+            self.starts[i] = start
+            start += length
+        self.word_offset = word_offset
+        self.symbol_lens = list(symbol_lens)
+
+        self.pair_freq = defaultdict(int)
+        self.pair_words = defaultdict(set)
+        self.pair_first = {}
+
+    def word(self, idx: int) -> array:
+        """Returns symbols of word idx."""
+        start = self.starts[idx]
+        return self.symbols[start:start + self.lens[idx]]
+
+    def set_word(self, idx: int, symbols: array) -> None:
+        """Replaces symbols of word idx by (at most as many) symbols."""
+        start = self.starts[idx]
+        self.symbols[start:start + len(symbols)] = symbols
+        self.lens[idx] = len(symbols)
+
+    def words(self, 
+              start: int=0, 
+              stop: Optional[int]=None) -> tuple[array, array]:
+        """Returns (symbols, lens) of words start:stop, with their symbols 
+        concatenated into a compact buffer."""
+        lens = self.lens[start:stop]
+        symbols = array('i')
+        for idx in range(start, start + len(lens)):
+            symbols.extend(self.word(idx))
+        return symbols, lens
+
+    def word_pairs(self, symbols: array) -> list[tuple[tuple[int, int], int]]:
+        """Return list of (pair, char offset) for adjacent pairs in symbols."""
+        pairs = []
+        offset = 0
+        for s1, s2 in zip(symbols[:-1], symbols[1:]):
+            pairs.append(((s1, s2), offset))
+            offset += self.symbol_lens[s1]
+        return pairs
+
+    def count_pairs(self) -> dict[tuple[int, int], tuple[int, tuple[int, int]]]:
+        """Initialize pair statistics, returning {pair: (freq, first)}."""
+        self.pair_freq = defaultdict(int)
+        self.pair_words = defaultdict(set)
+        self.pair_first = {}
+        for idx in range(len(self.lens)):
+            for pair, offset in self.word_pairs(self.word(idx)):
+                self.pair_freq[pair] += self.freqs[idx]
+                self.pair_words[pair].add(idx)
+                if pair not in self.pair_first:
+                    self.pair_first[pair] = (self.word_offset + idx, offset)
+        return {pair: (freq, self.pair_first[pair]) 
+                for pair, freq in self.pair_freq.items()}
+
+    def merge(self, 
+              pair: tuple[int, int], 
+              new_symbol: int, 
+              new_len: int) -> dict[tuple[int, int], tuple[int, Optional[tuple[int, int]]]]:
+        """Merge pair into new_symbol (of new_len chars) in all words of the 
+        shard containing it. Returns {pair: (freq delta, first occurrence or 
+        None if the pair no longer occurs)} for all pairs that changed."""
+        while len(self.symbol_lens) <= new_symbol:
+            self.symbol_lens.append(0)
+        self.symbol_lens[new_symbol] = new_len
+
+        deltas = defaultdict(int)
+        touched = set()
+        dirty = set()
+
+        for idx in self.pair_words.pop(pair, ()):
+            symbols = self.word(idx)
+            new_symbols = merge_symbols(symbols, pair, new_symbol)
+            self.set_word(idx, new_symbols)
+
+            # update pair frequencies
+            freq = self.freqs[idx]
+            old_counts = Counter(p for p, _ in self.word_pairs(symbols))
+            new_pairs = self.word_pairs(new_symbols)
+            new_counts = Counter(p for p, _ in new_pairs)
+            for p in old_counts.keys() | new_counts.keys():
+                diff = new_counts[p] - old_counts[p]
+                if diff:
+                    self.pair_freq[p] += diff * freq
+                    deltas[p] += diff * freq
+                    touched.add(p)
+
+            # update pair -> words index and first occurrences
+            global_idx = self.word_offset + idx
+            for p in old_counts.keys() - new_counts.keys():
+                if p == pair:
+                    continue
+                self.pair_words[p].discard(idx)
+                if self.pair_first[p][0] == global_idx:
+                    dirty.add(p)
+            new_offsets = {}
+            for p, offset in new_pairs:
+                new_offsets.setdefault(p, offset)
+            for p, offset in new_offsets.items():
+                self.pair_words[p].add(idx)
+                first = self.pair_first.get(p)
+                if first is None or first[0] >= global_idx:
+                    if first != (global_idx, offset):
+                        self.pair_first[p] = (global_idx, offset)
+                        touched.add(p)
+
+        # recompute first occurrences of pairs which left their first word
+        for p in dirty:
+            touched.add(p)
+            if not self.pair_words[p]:
+                continue
+            idx = min(self.pair_words[p])
+            offset = next(o for q, o in self.word_pairs(self.word(idx)) if q == p)
+            self.pair_first[p] = (self.word_offset + idx, offset)
+
+        # remove pairs which no longer occur
+        touched.add(pair)
+        result = {}
+        for p in touched:
+            if self.pair_freq.get(p, 0) <= 0:
+                self.pair_freq.pop(p, None)
+                self.pair_words.pop(p, None)
+                self.pair_first.pop(p, None)
+                result[p] = (deltas[p], None)
+            else:
+                result[p] = (deltas[p], self.pair_first[p])
+        return result
+
+
+def shard_worker(conn: Connection, 
+                 symbols: array, 
+                 lens: array, 
+                 freqs: array, 
+                 word_offset: int, 
+                 symbol_lens: list[int]) -> None:
+    """Runs a WordShard in a worker process, serving requests from conn:
+      - ('merge', pair, new_symbol, new_len): merge pair, send deltas
+      - ('words',): send (symbols, lens) with the current words
+      - ('stop',): exit"""
+    shard = WordShard(symbols, lens, freqs, word_offset, symbol_lens)
+    conn.send(shard.count_pairs())
+    while True:
+        request = conn.recv()
+        if request[0] == 'merge':
+            conn.send(shard.merge(*request[1:]))
+        elif request[0] == 'words':
+            conn.send(shard.words())
+        else:
+            break
+    conn.close()
+
+
+def merge_symbols(symbols: array, 
+                  pair: tuple[int, int], 
+                  new_symbol: int) -> array:
+    """Return symbols with all occurences of pair merged into new_symbol, 
+    left to right."""
+    new_symbols = array('i')
+    i = 0
+    while i < len(symbols):
+        if i + 1 < len(symbols) and (symbols[i], symbols[i+1]) == pair:
+            new_symbols.append(new_symbol)
+            i += 2
+        else:
+            new_symbols.append(symbols[i])
+            i += 1
+    return new_symbols
+
+
+def apply_merges(tokens: list[str], 
+                 merge_ranks: dict[tuple[str, str], int]) -> list[str]:
+    """Apply BPE merges {pair: rank} to list of tokens in rank order.
+    
+    Merges are only applied in increasing order of rank: a pair whose rank 
+    is lower than that of an already applied merge was merged before the 
+    pair existed during training, and hence is not merged."""
+    last_rank = -1
+    while len(tokens) > 1:
+        # lowest ranked pair which can still be applied
+        pair, rank = None, None
+        for candidate in zip(tokens[:-1], tokens[1:]):
+            candidate_rank = merge_ranks.get(candidate, -1)
+            if candidate_rank > last_rank and (rank is None or candidate_rank < rank):
+                pair, rank = candidate, candidate_rank
+        if pair is None:
+            break
+        last_rank = rank
+
+        # merge all occurences of pair, left to right
+        new_tokens = []
+        i = 0
+        while i < len(tokens):
+            if i + 1 < len(tokens) and (tokens[i], tokens[i+1]) == pair:
+                new_tokens.append(tokens[i] + tokens[i+1])
+                i += 2
+            else:
+                new_tokens.append(tokens[i])
+                i += 1
+        tokens = new_tokens
+    return tokens
+
+
+def get_merges_path(vocab_path: str) -> str:
+    """Return default path of merges file belonging to vocab file."""
+    return str(Path(vocab_path).with_suffix('.merges.json'))
+
+
+def get_meta_path(vocab_path: str) -> str:
+    """Return default path of meta file belonging to vocab file."""
+    return str(Path(vocab_path).with_suffix('.meta.json'))
+
 
+def get_checkpoint_path(vocab_path: str) -> str:
+    """Return default path of training checkpoint belonging to vocab file."""
+    return str(Path(vocab_path).with_suffix('.ckpt'))
@@ -4,33 +4,79 @@ Core functionality to deduplicate texts.
 Uses the MinHash and Locality Sensitive Hashing algorithms to perform 
 deduplication.
 
+N-grams (shingles) can either be taken as python strings (shingle_mode 'str', 
+the original behaviour) or as uint64 ids computed with a polynomial rolling 
+hash over the codepoints ('char'), the UTF-8 bytes ('byte') or the words 
+('word') of a text. The latter avoid creating one string object per n-gram and 
+compute the MinHash signature with vectorized numpy operations.
+
+By default the signatures, LSH dicts and duplicate candidates of all texts are
+held in memory. If memory_budget_mb is given, deduplicate uses external memory
+instead: the signatures are written to a file on disk in order of the texts
+(row ids), and the LSH entries (band, band hash, row id) are buffered up to a
+quarter of the budget and spilled as runs sorted by (band, band hash). A k-way
+merge of the runs yields the LSH buckets one by one, and the texts of a bucket
+are compared with their signatures read back from disk. Only the row ids of
+the texts to remove are kept in memory, so apart from these the peak memory
+does not grow with the size of the corpus.
+
+The input and output can also be binary record files, see records.py.
+
 Contains:
   - Deduplicator: class for deduplication using MinHash and LSH algorithms.
+  - write_lsh_run: function writing sorted LSH entries to a run file.
+  - merge_lsh_runs: function merging run files into LSH buckets.
+  - rolling_hashes: function for hashing many subarrays of an integer array.
+  - mix64: function for mixing the bits of uint64 hashes.
 """
 
 # Standard library
-import json
+import heapq
+import os
 import sys
+import tempfile
+from array import array
 from collections import defaultdict
 from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
 
 # Third-party
 import mmh3
+import numpy as np
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from profiler import profile
+from records import RecordWriter, count_records, load_record, read_records
+
+# Rolling hash constants. The base is odd, so it is invertible mod 2**64.
+ROLLING_BASE = 0x100000001B3
+ROLLING_BASE_INV = pow(ROLLING_BASE, -1, 2**64)
+
+# Codepoints treated as word separators in shingle_mode 'word'
+WHITESPACE_CODES = np.array([ord(c) for c in ' \t\n\r\x0b\x0c\x85\xa0\u2028\u2029'], 
+                            dtype=np.uint32)
+
+# LSH entries are pairs of uint64 (key, row id), with key = band << 32 | band hash
+LSH_ENTRY_BYTES = 16
+
 
 class Deduplicator:
     """Class for deduplicating texts using MinHash and LSH algorithms."""
+    SHINGLE_MODES = ('str', 'char', 'byte', 'word')
+
     def __init__(self, 
                  inpath: str, 
                  outpath: str, 
                  gram_len: int, 
                  signature_len: int, 
                  band_size: int, 
-                 similarity_threshold: float) -> None:
+                 similarity_threshold: float,
+                 shingle_mode: str='str', 
+                 output_format: str='jsonl', 
+                 memory_budget_mb: Optional[float]=None) -> None:
 
         # arguments
         self.inpath = inpath
@@ -43,6 +89,13 @@ class Deduplicator:
             raise ValueError(f"""band_size ({band_size}) does not divide 
                              signature_len ({signature_len}))""")
         self.n_bands = signature_len // band_size
+        if shingle_mode not in self.SHINGLE_MODES:
+            raise ValueError(f'shingle_mode must be one of {self.SHINGLE_MODES} but got {shingle_mode}')
+        self.shingle_mode = shingle_mode
+        self.output_format = output_format
+        if memory_budget_mb is not None and memory_budget_mb <= 0:
+            raise ValueError(f'memory_budget_mb must be positive but got {memory_budget_mb}')
+        self.memory_budget_mb = memory_budget_mb
 
         # storage containers
         self.min_hashes = {}
@@ -50,65 +103,158 @@ class Deduplicator:
         self.lsh_duplicate_candidates = []
         self.texts_to_remove_set = set()
         self.texts_to_remove_dict = defaultdict(list)
+        self.rows_to_remove = set()  # row ids, with memory_budget_mb
 
         # hash functions
         self.min_hash_fns = [lambda x, s=s: mmh3.hash(x, s) for s in range(signature_len)]
         self.lsh_hash_fn = lambda x, s=signature_len: mmh3.hash(x, s)
+        rng = np.random.default_rng(signature_len)
+        self.min_hash_seeds = rng.integers(0, 2**64, size=signature_len, 
+                                           dtype=np.uint64, endpoint=False)
+        # dtype of signatures spilled to disk (mmh3 hashes are signed)
+        self.signature_dtype = np.int64 if shingle_mode == 'str' else np.uint64
 
         # Logger
         self.logger = Logger('deduplicate')
 
     def deduplicate(self) -> None:
-        """Deduplicates infile and writes to outfile"""
+        """Deduplicates infile and writes to outfile, in memory or, if 
+        memory_budget_mb is set, with external memory."""
         self.logger.info(f'Start deduplicating {self.inpath}')
+        with profile('deduplicate'):
+            if self.memory_budget_mb is None:
+                self.deduplicate_in_memory()
+            else:
+                self.deduplicate_spilled()
+        self.logger.info(f'Finish deduplicating {self.inpath}\n')
 
+    def deduplicate_in_memory(self) -> None:
+        """Deduplicates infile and writes to outfile, holding signatures and
+        LSH dicts in memory."""
         # MinHash
-        self.logger.info(f'Stared MinHash with gram_len = {self.gram_len}, signature_len = {self.signature_len}')
-        self.min_hash_jsonl()
+        self.logger.info(f'Stared MinHash with gram_len = {self.gram_len}, signature_len = {self.signature_len}, shingle_mode = {self.shingle_mode}')
+        with profile('min_hash'):
+            self.min_hash_jsonl()
+
+        # Locality-Sensitive Hashing and texts to remove dict
+        self.find_duplicates()
 
+        # Create outfile
+        self.logger.info(f'Start writing to outfile {self.outpath}')
+        with profile('write_output'), RecordWriter(self.outpath, self.output_format) as writer:
+            for record in read_records(self.inpath):
+                entry = load_record(record)
+                self.remove_duplicates(entry['url'], entry['text_list'])
+                writer.write(entry)
+
+    def deduplicate_spilled(self) -> None:
+        """Deduplicates infile and writes to outfile, spilling signatures and
+        sorted runs of LSH entries to disk (see module docstring)."""
+        budget_bytes = int(self.memory_budget_mb * 2**20)
+        with tempfile.TemporaryDirectory(dir=Path(self.outpath).parent) as spill_dir:
+            # MinHash and LSH entries
+            self.logger.info(f'Stared MinHash with gram_len = {self.gram_len}, signature_len = {self.signature_len}, shingle_mode = {self.shingle_mode}, memory_budget_mb = {self.memory_budget_mb}')
+            with profile('min_hash'):
+                signatures_path, runs = self.min_hash_jsonl_spilled(spill_dir, budget_bytes // 4)
+
+            # merge runs into LSH buckets, and compare the texts of each bucket
+            self.logger.info(f'Merging {len(runs)} runs of LSH entries spilled to disk')
+            chunk_entries = max(1, budget_bytes // (2 * LSH_ENTRY_BYTES * max(1, len(runs))))
+            with profile('lsh_merge_runs'), open(signatures_path, 'rb') as signatures_file:
+                for rows in merge_lsh_runs(runs, chunk_entries):
+                    self.remove_duplicate_rows(rows, signatures_file)
+
+        # Create outfile
+        self.logger.info(f'Start writing to outfile {self.outpath}')
+        with profile('write_output'), RecordWriter(self.outpath, self.output_format) as writer:
+            first_row = 0
+            for record in read_records(self.inpath):
+                entry = load_record(record)
+                url, text_list = entry['url'], entry['text_list']
+                for i in range(len(text_list)):
+                    if first_row + i in self.rows_to_remove:
+                        self.logger.info(f'REMOVE DUPLICATE: item {i} in {url}')
+                        text_list[i] = "<DUPLICATE_REMOVED>"
+                first_row += len(text_list)
+                writer.write(entry)
+
+    def find_duplicates(self) -> None:
+        """Creates texts_to_remove_dict from the min_hashes dict."""
         # Locality-Sensitive Hashing
         self.logger.info(f'Start Locality-Sensitive Hashing')
         self.logger.info(f'Create LSH dicts.')
-        self.lsh_create_dicts()
+        with profile('lsh_create_dicts'):
+            self.lsh_create_dicts()
         self.logger.info(f'Determine duplicate candidates')
-        self.lsh_get_duplicate_candidates()
+        with profile('lsh_get_duplicate_candidates'):
+            self.lsh_get_duplicate_candidates()
 
         # Texts to remove dict
         self.logger.info(f'Create texts-to-remove dict')
-        self.get_texts_to_remove()
-
-        # Create outfile
-        self.logger.info(f'Start writing to outfile {self.outpath}')
-        with open(self.inpath, 'r') as infile, open(self.outpath, 'w') as outfile:
-            for line in infile:
-                entry = json.loads(line)
-                url = entry['url']
-                if url in self.texts_to_remove_dict:
-                    text_list = entry['text_list']
-                    idxs = self.texts_to_remove_dict[url]
-                    for i in idxs:
-                        self.logger.info(f'REMOVE DUPLICATE: item {i} in {url}')
-                        text_list[i] = "<DUPLICATE_REMOVED>"
-                json.dump(entry, outfile)
-                outfile.write('\n')
-        self.logger.info(f'Finish deduplicating {self.inpath}\n')
+        with profile('get_texts_to_remove'):
+            self.get_texts_to_remove()
+
+    def remove_duplicates(self, url: str, text_list: list[str]) -> None:
+        """Replaces the texts of article url to remove in text_list by 
+        "<DUPLICATE_REMOVED>"."""
+        for i in self.texts_to_remove_dict.get(url, ()):
+            self.logger.info(f'REMOVE DUPLICATE: item {i} in {url}')
+            text_list[i] = "<DUPLICATE_REMOVED>"
         
     def min_hash_jsonl(self) -> None:
         """Creates min_hashes dict."""
-        with open(self.inpath, 'r') as infile:
-            total_lines = sum(1 for _ in infile)
-            infile.seek(0)
-            for line_num, line in enumerate(infile):
-                entry = json.loads(line)
+        total_lines = count_records(self.inpath)
+        for line_num, record in enumerate(read_records(self.inpath)):
+            entry = load_record(record)
+            url = entry['url']
+            text_list = entry['text_list']
+
+            self.logger.info(f'MinHash article {line_num:6d}/{total_lines}: {url}')
+
+            self.min_hashes[url] = [self.min_hash(text) for text in text_list]
+
+    def min_hash_jsonl_spilled(self, spill_dir: str, buffer_bytes: int) -> tuple[str, list[str]]:
+        """Writes the MinHash signatures of all texts, in order, to a file in
+        spill_dir, and their LSH entries to sorted runs of about buffer_bytes
+        each. Returns the paths of the signature file and of the runs."""
+        signatures_path = os.path.join(spill_dir, 'signatures.bin')
+        runs = []
+        keys, rows = array('Q'), array('Q')
+        max_entries = max(1, buffer_bytes // LSH_ENTRY_BYTES)
+        row = 0
+        total_lines = count_records(self.inpath)
+        with open(signatures_path, 'wb') as signatures_file:
+            for line_num, record in enumerate(read_records(self.inpath)):
+                entry = load_record(record)
                 url = entry['url']
                 text_list = entry['text_list']
 
                 self.logger.info(f'MinHash article {line_num:6d}/{total_lines}: {url}')
 
-                self.min_hashes[url] = [self.min_hash(text) for text in text_list]
+                for text in text_list:
+                    signature = self.min_hash(text)
+                    signatures_file.write(np.array(signature, dtype=self.signature_dtype).tobytes())
+                    for band, hash_val in enumerate(self.band_hashes(signature)):
+                        keys.append(band << 32 | hash_val & 0xFFFFFFFF)
+                        rows.append(row)
+                    row += 1
+
+                if len(keys) >= max_entries:
+                    runs.append(write_lsh_run(keys, rows, spill_dir))
+                    keys, rows = array('Q'), array('Q')
+
+        if keys:
+            runs.append(write_lsh_run(keys, rows, spill_dir))
+        return signatures_path, runs
 
     def min_hash(self, text: str) -> list[int]:
         """Return MinHash signature of text"""
+        if self.shingle_mode != 'str':
+            with profile('shingle_ids'):
+                ids = self.shingle_ids(text)
+            with profile('min_hash_ids'):
+                return self.min_hash_ids(ids)
+
         assert len(text) >= self.gram_len, f"len(text) ({len(text)}) cannot be smaller than gram_len ({self.gram_len})"
 
         n_grams = set()
@@ -121,6 +267,45 @@ class Deduplicator:
 
         return signature
 
+    def shingle_ids(self, text: str) -> np.ndarray:
+        """Return array of unique uint64 n-gram ids of text, computed with a 
+        rolling hash according to self.shingle_mode."""
+        if self.shingle_mode == 'byte':
+            codes = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+        else:
+            codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+        if self.shingle_mode == 'word':
+            # hash each word, then hash n-grams of consecutive word hashes
+            is_word = ~np.isin(codes, WHITESPACE_CODES)
+            edges = np.diff(is_word.astype(np.int8), prepend=0, append=0)
+            word_starts = np.flatnonzero(edges == 1)
+            word_ends = np.flatnonzero(edges == -1)
+            assert len(word_starts) > 0, "text must contain at least one word"
+            codes = mix64(rolling_hashes(codes, word_starts, word_ends))
+
+        gram_len = self.gram_len
+        if self.shingle_mode == 'word':
+            # texts with fewer words than gram_len form a single n-gram
+            gram_len = min(gram_len, len(codes))
+        assert len(codes) >= gram_len, f"len(text) ({len(codes)}) cannot be smaller than gram_len ({gram_len})"
+
+        starts = np.arange(len(codes) - gram_len + 1)
+        ids = mix64(rolling_hashes(codes, starts, starts + gram_len))
+
+        return np.unique(ids)
+
+    def min_hash_ids(self, ids: np.ndarray) -> list[int]:
+        """Return MinHash signature of array of uint64 n-gram ids."""
+        # process the hash functions in chunks to bound memory for long texts
+        signature = np.empty(self.signature_len, dtype=np.uint64)
+        chunk = max(1, 2**20 // len(ids))
+        for start in range(0, self.signature_len, chunk):
+            seeds = self.min_hash_seeds[start:start + chunk]
+            hashes = mix64(ids[None, :] ^ seeds[:, None])
+            signature[start:start + chunk] = hashes.min(axis=1)
+
+        return signature.tolist()
 
     def lsh_create_dicts(self) -> None:
         """Creates lsh_dicts list"""
@@ -130,20 +315,18 @@ class Deduplicator:
             self.logger.info(f'Updating LSH dicts with article {line_num:6d}/{total_lines}: {url}')
             # loop over signatures
             for idx, signature in enumerate(signatures):
-                # loop over bands
-                for b, lsh_dict in zip(range(self.n_bands), self.lsh_dicts):
-                    # define band
-                    start = b * self.band_size
-                    end = start + self.band_size
-                    band = signature[start:end]
-                    band_bytes = str(band).encode()
-                    
-                    # compute hash val
-                    hash_val = self.lsh_hash_fn(band_bytes)
-
-                    # add to band dict
+                # loop over bands, and add to band dict
+                for lsh_dict, hash_val in zip(self.lsh_dicts, self.band_hashes(signature)):
                     lsh_dict[hash_val].add((url, idx))
 
+    def band_hashes(self, signature: list[int]) -> list[int]:
+        """Returns LSH hash value of each band of signature."""
+        hash_vals = []
+        for start in range(0, self.signature_len, self.band_size):
+            band = signature[start:start + self.band_size]
+            hash_vals.append(self.lsh_hash_fn(str(band).encode()))
+        return hash_vals
+
     def lsh_get_duplicate_candidates(self) -> None:
         """Create duplicate_candidates list"""
         total_dicts = len(self.lsh_dicts)
@@ -170,6 +353,23 @@ class Deduplicator:
         for url, idx in self.texts_to_remove_set:
             self.texts_to_remove_dict[url].append(idx)
 
+    def remove_duplicate_rows(self, rows: list[int], signatures_file: BinaryIO) -> None:
+        """Adds the texts of LSH bucket rows (row ids, increasing) which are
+        duplicates of an earlier text to rows_to_remove, so that the first
+        occurrence is kept, reading their signatures from signatures_file."""
+        row_bytes = self.signature_len * 8
+        signatures = []
+        for row in rows:
+            signatures_file.seek(row * row_bytes)
+            signatures.append(np.frombuffer(signatures_file.read(row_bytes), dtype=self.signature_dtype))
+
+        for i1 in range(len(rows) - 1):
+            for i2 in range(i1 + 1, len(rows)):
+                if (rows[i1] not in self.rows_to_remove and 
+                    rows[i2] not in self.rows_to_remove and
+                    np.count_nonzero(signatures[i1] == signatures[i2]) / self.signature_len > self.similarity_threshold):
+                    self.rows_to_remove.add(rows[i2])
+
     def are_duplicates(self, 
                        text1: tuple[str, int], 
                        text2: tuple[str, int]) -> bool:
@@ -190,4 +390,75 @@ class Deduplicator:
         n_total = len(sig1)
         return n_same / n_total
 
-        
\ No newline at end of file
+
+# Spilling and merging of LSH entries
+
+def write_lsh_run(keys: array, rows: array, spill_dir: str) -> str:
+    """Writes LSH entries (keys[i], rows[i]), with increasing rows, sorted by
+    key and row to a new run file in spill_dir, and returns its path."""
+    keys = np.frombuffer(keys, dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    entries = np.empty((len(keys), 2), dtype=np.uint64)
+    entries[:, 0] = keys[order]
+    entries[:, 1] = np.frombuffer(rows, dtype=np.uint64)[order]
+    fd, path = tempfile.mkstemp(suffix='.lsh', dir=spill_dir)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(entries.tobytes())
+    return path
+
+def read_lsh_run(path: str, chunk_entries: int) -> Iterator[tuple[int, int]]:
+    """Generator of (key, row) from run file, read chunk_entries at a time
+    (and converted to python ints a few thousand at a time, since these take
+    several times the memory of the raw entries)."""
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_entries * LSH_ENTRY_BYTES):
+            entries = np.frombuffer(chunk, dtype=np.uint64).reshape(-1, 2)
+            for start in range(0, len(entries), 4096):
+                yield from map(tuple, entries[start:start + 4096].tolist())
+
+def merge_lsh_runs(paths: list[str], chunk_entries: int) -> Iterator[list[int]]:
+    """Generator of the LSH buckets with more than one text, as increasing
+    row ids, from k-way merge of run files (each read chunk_entries at a 
+    time)."""
+    key, rows = None, []
+    for next_key, row in heapq.merge(*(read_lsh_run(path, chunk_entries) for path in paths)):
+        if next_key != key:
+            if len(rows) > 1:
+                yield rows
+            key, rows = next_key, []
+        rows.append(row)
+    if len(rows) > 1:
+        yield rows
+
+
+# Rolling hash functions
+
+def rolling_hashes(codes: np.ndarray, 
+                   starts: np.ndarray, 
+                   ends: np.ndarray) -> np.ndarray:
+    """Return polynomial hashes (mod 2**64) of the subarrays 
+    codes[starts[i]:ends[i]], computed from a single prefix sum.
+
+    With prefix[i] = sum_{j<i} codes[j] * B^-j, the hash of codes[s:e] is 
+    (prefix[e] - prefix[s]) * B^(e-1) = sum_{s<=j<e} codes[j] * B^(e-1-j), 
+    which does not depend on the position of the subarray."""
+    n = len(codes)
+    pows = np.ones(n + 1, dtype=np.uint64)
+    inv_pows = np.ones(n + 1, dtype=np.uint64)
+    np.cumprod(np.full(n, ROLLING_BASE, dtype=np.uint64), out=pows[1:])
+    np.cumprod(np.full(n, ROLLING_BASE_INV, dtype=np.uint64), out=inv_pows[1:])
+
+    prefix = np.zeros(n + 1, dtype=np.uint64)
+    np.cumsum(codes.astype(np.uint64) * inv_pows[:n], out=prefix[1:])
+
+    return (prefix[ends] - prefix[starts]) * pows[ends - 1]
+
+def mix64(x: np.ndarray) -> np.ndarray:
+    """Return splitmix64 finalizer of uint64 array x, which spreads the 
+    entropy of the input over all bits of the output."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return x
@@ -5,21 +5,25 @@ Contains:
   - Normalizer: class for normalizing Wikipedia text
   - normalize_jsonl: function for normalizing text stored in jsonl file. 
     Can utilize multiple processors.
+
+The input and output can also be binary record files, see records.py.
 """
 
 # Standard library
-import json
 import re
 import sys
 import unicodedata
-from multiprocessing import Pool, current_process
+from multiprocessing import current_process
 from pathlib import Path
-from typing import Iterator, TextIO
+from typing import Iterator, Optional
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from profiler import flush_profile, profile, profiled
+from records import BATCH_BYTES, RecordWriter, batch_records, count_records, load_record, read_records
+from workerpool import WorkerPool, get_pool
 
 class Normalizer:
     """Class for normalizing Wikipedia text."""
@@ -31,14 +35,17 @@ class Normalizer:
             self.quote_handler,
             self.dash_handler,
         ]
+        # time the handlers if profiling is enabled (see profiler.py)
+        self.HANDLERS = [profiled(handler) for handler in self.HANDLERS]
 
         # Logger
         self.logger = Logger('normalize')
 
     def normalize(self, text: str) -> str:
         """Normalize text."""
-        for handler in self.HANDLERS:
-            text = handler(text)
+        with profile('normalize'):
+            for handler in self.HANDLERS:
+                text = handler(text)
 
         return text
 
@@ -93,12 +100,14 @@ class Normalizer:
 
 # Multiprocessing functions
 
-def get_iterable(file: TextIO, 
+def get_iterable(records: Iterator[str | bytes], 
                  total_lines: int, 
-                 len_cutoff: int) -> Iterator[int, str, int, int]:
-    """Generator of worker() arguments."""
-    for page_num, line in enumerate(file, 1):
-        yield (page_num, line, total_lines, len_cutoff)
+                 len_cutoff: int, 
+                 batch_bytes: int) -> Iterator[tuple[int, list[str | bytes], int, int]]:
+    """Generator of worker() arguments: batches of about batch_bytes of 
+    records (see batch_records), with the page number of their first record."""
+    for first_page_num, batch in batch_records(records, batch_bytes):
+        yield (first_page_num, batch, total_lines, len_cutoff)
 
 def worker_init() -> None:
     """Initializes worker."""
@@ -107,28 +116,35 @@ def worker_init() -> None:
     process = current_process()
     print(f'Initialized {process.name}')
 
-def worker(page_num: int, 
-           line: str, 
+def worker(first_page_num: int, 
+           records: list[str | bytes], 
            total_lines: int, 
-           len_cutoff: int) -> tuple[str, list[str]]:
-    """Normalizes text in jsonl entry given by line."""
-
-    # read from line
-    entry = json.loads(line)
-    url = entry['url']
-    text_list = entry['text_list']
-
-    # log
-    normalizer.logger.info(f"Normalizing page {page_num} / {total_lines} : {url}")
-
-    # normalize
-    normalized_text_list = []
-    for text in text_list:
-        normalized_text = normalizer.normalize(text)
-        if len(normalized_text) >= len_cutoff:
-            normalized_text_list.append(normalized_text)
+           len_cutoff: int) -> list[tuple[str, list[str]]]:
+    """Normalizes text in the entries given by records."""
+    results = []
+    for page_num, record in enumerate(records, first_page_num):
+        # read from record
+        entry = load_record(record)
+        url = entry['url']
+        text_list = entry['text_list']
+
+        # log
+        normalizer.logger.info(f"Normalizing page {page_num} / {total_lines} : {url}")
+
+        # normalize
+        normalized_text_list = []
+        for text in text_list:
+            normalized_text = normalizer.normalize(text)
+            if len(normalized_text) >= len_cutoff:
+                normalized_text_list.append(normalized_text)
+        results.append((url, normalized_text_list))
     
-    return url, normalized_text_list
+    flush_profile()
+    return results
+
+def worker_star(args: tuple[int, list[str | bytes], int, int]) -> list[tuple[str, list[str]]]:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
 
 
 
@@ -137,8 +153,15 @@ def worker(page_num: int,
 def normalize_jsonl(inpath_list: list[str] | str, 
                     outpath: str, 
                     processes: int, 
-                    len_cutoff: int=-1) -> None:
-    """Normalize text stored in .jsonl file"""
+                    len_cutoff: int=-1, 
+                    output_format: str='jsonl', 
+                    pool: Optional[WorkerPool]=None, 
+                    batch_bytes: int=BATCH_BYTES) -> None:
+    """Normalize text stored in .jsonl file. The output is written as jsonl 
+    or binary records (output_format 'rec'). Each worker task normalizes a 
+    batch of about batch_bytes of input records. The same workers process 
+    all input files: those of the warm WorkerPool pool if given, and 
+    otherwise processes new ones."""
 
     normalizer = Normalizer()
     normalizer.logger.info(f"Started normalizing {inpath_list}")
@@ -152,18 +175,16 @@ def normalize_jsonl(inpath_list: list[str] | str,
         raise ValueError(f'inpath_list must be string or list but got type {type(inpath_list)}')
 
     # read files
-    for inpath in inpath_list:
-        with open(inpath, 'r') as infile, open(outpath, 'w') as outfile:
-            normalizer.logger.info(f"Started normalizing {inpath}")
-            total_lines = sum(1 for _ in infile)
-            infile.seek(0)
-
-            with Pool(processes=processes, initializer=worker_init) as pool:
-                iterable = get_iterable(infile, total_lines, len_cutoff)
-                for url, text_list in pool.starmap(worker, iterable):
-                    entry = {'url': url, 'text_list': text_list}
-                    json.dump(entry, outfile)
-                    outfile.write('\n')
-            normalizer.logger.info(f"Finished normalizing {inpath}")
+    with get_pool(pool, processes, worker_init) as stage_pool:
+        for inpath in inpath_list:
+            with RecordWriter(outpath, output_format) as writer:
+                normalizer.logger.info(f"Started normalizing {inpath}")
+                total_lines = count_records(inpath)
+
+                iterable = get_iterable(read_records(inpath), total_lines, len_cutoff, batch_bytes)
+                for results in stage_pool.imap(worker_star, iterable):
+                    for url, text_list in results:
+                        writer.write({'url': url, 'text_list': text_list})
+                normalizer.logger.info(f"Finished normalizing {inpath}")
         
     normalizer.logger.info(f"Finished normalizing {inpath_list}\n\n")
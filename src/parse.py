@@ -5,23 +5,30 @@ Contains:
   - Parser: class for parsing Wikipedia html
   - parse_jsonl: function for parsing text stored in jsonl file. 
     Can utilize multiple processors.
+
+The input and output can also be binary record files, see records.py.
 """
 
+from __future__ import annotations
+
 # Standard library
-import json
 import sys
-from multiprocessing import Pool, current_process
+from multiprocessing import current_process
 from pathlib import Path
-from typing import Iterator, Optional
+from typing import TYPE_CHECKING, Iterator, Optional
 
-# Third-party
-from bs4 import BeautifulSoup
-from bs4.element import Tag, NavigableString
+# Third-party (bs4 is imported when a Parser is created, since importing it 
+# also imports html5lib)
+if TYPE_CHECKING:
+    from bs4.element import Tag, NavigableString
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from profiler import flush_profile, profile, profiled
+from records import BATCH_BYTES, RecordWriter, batch_records, count_records, load_record, read_records
+from workerpool import WorkerPool, get_pool
 
 class Parser:
     """Class for parsing Wikipedia html."""
@@ -41,59 +48,70 @@ class Parser:
             (self.match_blockquote, self.format_blockquote),
             (self.match_heading, self.format_heading)
         ]
+        # time the format handlers if profiling is enabled (see profiler.py)
+        self.FORMAT_HANDLERS = [(match_fcn, profiled(format_fcn)) 
+                                for match_fcn, format_fcn in self.FORMAT_HANDLERS]
+
+        # bs4 classes
+        from bs4 import BeautifulSoup
+        from bs4.element import NavigableString
+        self.BeautifulSoup = BeautifulSoup
+        self.NavigableString = NavigableString
 
         # Logger
         self.logger = Logger('parse')
 
     def parse(self, html: str) -> list[str]:
         """Parse Wiki html and return list of text from each section."""
-        # soup
-        soup = BeautifulSoup(html, 'html5lib')
-
-        # title
-        title = soup.find('h1', id="firstHeading").get_text().strip()
-
-        # main tag
-        main_tag = soup.find('div', class_="mw-content-ltr mw-parser-output", lang="en")
-
-        if not main_tag:
-            return []
-
-        text_list = []
-        text = f'# {title}\n\n'
-        skip = True
-
-        for tag in main_tag.find_all(recursive=False):
-            # skip tags before first 'p' tag
-            if skip:
-                if tag.name == 'p':
-                    skip = False
+        with profile('parse'):
+            # soup
+            with profile('tree_building'):
+                soup = self.BeautifulSoup(html, 'html5lib')
+
+            # title
+            title = soup.find('h1', id="firstHeading").get_text().strip()
+
+            # main tag
+            main_tag = soup.find('div', class_="mw-content-ltr mw-parser-output", lang="en")
+
+            if not main_tag:
+                return []
+
+            text_list = []
+            text = f'# {title}\n\n'
+            skip = True
+
+            for tag in main_tag.find_all(recursive=False):
+                # skip tags before first 'p' tag
+                if skip:
+                    if tag.name == 'p':
+                        skip = False
+                        self.indent = ""
+                        self.last_char = ""
+                    else:  # skip current tag
+                        continue
+
+                if self.is_end(tag):
+                    break
+                elif self.is_new_section(tag):
+                    if text:
+                        text_list.append(text)
+                    text = "## " + self.heading_title(tag, level_str='h2') + "\n\n"
                     self.indent = ""
                     self.last_char = ""
-                else:  # skip current tag
-                    continue
-
-            if self.is_end(tag):
-                break
-            elif self.is_new_section(tag):
-                if text:
-                    text_list.append(text)
-                text = "## " + self.heading_title(tag, level_str='h2') + "\n\n"
-                self.indent = ""
-                self.last_char = ""
-            else:
-                text += self.get_text(tag)
+                else:
+                    text += self.get_text(tag)
         
-        if text:
-            text_list.append(text)
+            if text:
+                text_list.append(text)
 
-        return text_list       
+            return text_list       
 
     def get_text(self, node: Tag | NavigableString) -> str:
         """Returns parsed text from html node."""
 
         # Base cases
-        if isinstance(node, NavigableString):
+        if isinstance(node, self.NavigableString):
             return self.format_string_node(node)
         elif self.is_unwanted_tag(node):
             return ""
@@ -279,10 +297,13 @@ class Parser:
 
 # Multiprocessing functions
 
-def get_iterable(file, total_lines: int) -> Iterator[tuple[int, str, int]]:
-    """Generator of worker() arguments."""
-    for page_num, line in enumerate(file, 1):
-        yield (page_num, line, total_lines)
+def get_iterable(records: Iterator[str | bytes], 
+                 total_lines: int, 
+                 batch_bytes: int) -> Iterator[tuple[int, list[str | bytes], int]]:
+    """Generator of worker() arguments: batches of about batch_bytes of 
+    records (see batch_records), with the page number of their first record."""
+    for first_page_num, batch in batch_records(records, batch_bytes):
+        yield (first_page_num, batch, total_lines)
 
 def worker_init() -> None:
     """Initializes worker."""
@@ -291,39 +312,56 @@ def worker_init() -> None:
     process = current_process()
     print(f'Initialized {process.name}')
 
-def worker(page_num: int, line: str, total_lines: int) -> tuple[str, list[str]]:
-    """Parses html in jsonl entry given by line."""
-    # read from line
-    entry = json.loads(line)
-    url = entry['url']
-    html = entry['text']
+def worker(first_page_num: int, 
+           records: list[str | bytes], 
+           total_lines: int) -> list[tuple[str, list[str]]]:
+    """Parses html in the entries given by records."""
+    results = []
+    for page_num, record in enumerate(records, first_page_num):
+        # read from record
+        entry = load_record(record)
+        url = entry['url']
+        html = entry['text']
+
+        # log
+        parser.logger.info(f"Parsing page {page_num} / {total_lines} : {url}")
 
-    # log
-    parser.logger.info(f"Parsing page {page_num} / {total_lines} : {url}")
+        # parse
+        text_list = parser.parse(html)
+        results.append((url, text_list))
+    flush_profile()
+    return results
 
-    # parse
-    text_list = parser.parse(html)
-    return url, text_list
+def worker_star(args: tuple[int, list[str | bytes], int]) -> list[tuple[str, list[str]]]:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
 
 
 # Main entry point
 
-def parse_jsonl(raw_path: str, parsed_path: str, processes: int):
-    """Parse html data stored in .jsonl file using multiprocessing."""
+def parse_jsonl(raw_path: str, 
+                parsed_path: str, 
+                processes: int, 
+                output_format: str='jsonl', 
+                pool: Optional[WorkerPool]=None, 
+                batch_bytes: int=BATCH_BYTES):
+    """Parse html data stored in .jsonl file using multiprocessing. The 
+    output is written as jsonl or binary records (output_format 'rec'). Each 
+    worker task parses a batch of about batch_bytes of input records. If a 
+    warm WorkerPool is given, its workers are used instead of processes new 
+    ones."""
     parser = Parser()
     parser.logger.info(f"Started parsing {raw_path}")
 
     # read from file
-    with open(raw_path, 'r') as infile, open(parsed_path, 'w') as outfile:
-        total_lines = sum(1 for _ in infile)
-        infile.seek(0)
-
-        with Pool(processes=processes, initializer=worker_init) as pool:
-            iterable = get_iterable(infile, total_lines)
-            for url, text_list in pool.starmap(worker, iterable):
-                entry = {'url': url, 'text_list': text_list}
-                json.dump(entry, outfile)
-                outfile.write('\n')
+    with RecordWriter(parsed_path, output_format) as writer:
+        total_lines = count_records(raw_path)
+
+        with get_pool(pool, processes, worker_init) as stage_pool:
+            iterable = get_iterable(read_records(raw_path), total_lines, batch_bytes)
+            for results in stage_pool.imap(worker_star, iterable):
+                for url, text_list in results:
+                    writer.write({'url': url, 'text_list': text_list})
 
 
     parser.logger.info(f"Finished parsing {raw_path}\n\n")
@@ -0,0 +1,544 @@
+"""
+Core functionality to run the data preparation pipeline end to end.
+
+Running each stage with its own script writes a full jsonl file after every
+stage, which the next stage reads back and decodes again. The pipeline instead
+chains the stages inside the same worker process, so the text of an article
+passes from one stage to the next in memory:
+  1. parse: Parser, on the html of crawled articles
+  2. normalize: Normalizer, dropping texts shorter than len_cutoff
+  3. deduplicate: Deduplicator
+  4. segment: Segmenter
+  5. tokenize: Tokenizer
+Any ordered subset of the stages can be run, see config/config.yaml. The input
+is split into shards of shard_lines articles, and each worker task runs the
+stages on one shard.
+
+Deduplication needs the MinHash signatures of all texts before any text can be
+removed, so it is a barrier: the workers compute the signatures along with the
+stages before it (the front), and the output of the front is kept in the stage
+cache. Once all duplicates are found, the cached shards are passed through the
+stages after it (the back). Without the deduplicate stage, all stages run in a
+single pass.
+
+If cache_dir is given, the output of every stage on every shard is kept there
+(see StageCache), keyed by its input, the version of the stage code and the
+stage parameters. Stages whose output is already cached are skipped, so after
+a change to a stage only that stage and the stages after it run again, and
+only on the shards whose input changed. Without cache_dir, the cache is a
+temporary directory holding only the output of the front.
+
+The output of each stage can optionally be written to a jsonl file (a tap), in
+the same format as the corresponding script, e.g. for debugging. Tapped stages
+are never skipped.
+
+Contains:
+  - Pipeline: class for running the pipeline stages on a shard of articles.
+  - StageCache: class for caching the output of pipeline stages on disk.
+  - run_pipeline: function for running the pipeline on a jsonl file.
+    Can utilize multiple processors.
+"""
+
+# Standard library
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import current_process
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from logger import Logger
+from bpe_tokenize import TokenShardWriter, Tokenizer
+from bpe_vocab import get_merges_path
+from deduplicate import Deduplicator
+from normalize import Normalizer
+from parse import Parser
+from profiler import flush_profile
+from records import RecordWriter, load_record, read_records
+from segment import Segmenter, SentenceCache
+from workerpool import WorkerPool, get_pool
+
+STAGES = ('parse', 'normalize', 'deduplicate', 'segment', 'tokenize')
+
+# Source files (besides pipeline.py) of each step run on a shard, whose hash
+# is the code version of the step. Besides the stages, the steps are 'read'
+# (decoding the input records), 'min_hash' (MinHash signatures, the part of the
+# deduplicate stage run before the barrier) and 'duplicates' (the texts to
+# remove, found at the barrier).
+STEP_SOURCES = {
+    'read': [],
+    'parse': ['parse.py'],
+    'normalize': ['normalize.py'],
+    'min_hash': ['deduplicate.py'],
+    'duplicates': ['deduplicate.py'],
+    'deduplicate': ['deduplicate.py'],
+    'segment': ['segment.py'],
+    'tokenize': ['bpe_tokenize.py', 'bpe_pretokenize.py', 'bpe_vocab.py'],
+}
+
+# Deduplicator parameters which the MinHash signatures depend on
+MIN_HASH_PARAMS = ('gram_len', 'signature_len', 'shingle_mode')
+
+
+class Pipeline:
+    """Class for running the pipeline stages on a shard of articles."""
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.config = config
+        self.stages = get_stages(config)
+        self.taps = get_taps(config)
+        self.texts_to_remove = {}
+
+        # stage objects
+        if 'parse' in self.stages:
+            self.parser = Parser()
+        if 'normalize' in self.stages:
+            self.normalizer = Normalizer()
+            self.len_cutoff = config['normalize'].get('len_cutoff', -1)
+        if 'deduplicate' in self.stages:
+            self.deduplicator = get_deduplicator(config)
+        if 'segment' in self.stages:
+            segment_config = dict(config['segment'])
+            self.omit_duplicates = segment_config.pop('omit_duplicates', True)
+            if segment_config.get('cache_path'):
+                segment_config['cache_path'] = get_path(segment_config['cache_path'])
+            self.segmenter = Segmenter(**segment_config)
+        if 'tokenize' in self.stages:
+            self.tokenizer, self.output_format = get_tokenizer(config)
+
+        # Logger
+        self.logger = Logger('pipeline')
+
+    def run_shard(self, 
+                  shard_num: int, 
+                  total_shards: int, 
+                  cache_dir: str, 
+                  lines: Optional[list[str | bytes]], 
+                  input_step: Optional[tuple[str, str]], 
+                  steps: list[tuple[str, str]], 
+                  start: int, 
+                  store: set[str], 
+                  texts_to_remove: Optional[dict[str, list[int]]]) -> tuple[list, dict[str, list]]:
+        """Runs steps[start:] on a shard, where steps is a list of (step, key).
+
+        The input is the cached output of steps[start - 1], or of input_step
+        if start is 0, or the raw records of the shard for the 'read' step.
+        The outputs of steps in store are cached in cache_dir (see
+        StageCache). texts_to_remove are the
+        duplicates in the shard for the 'deduplicate' step.
+
+        Returns the output of the last step, a list of (url, output) for each
+        article of the shard, and the outputs of the tapped stages."""
+        self.logger.info(f"Running {[step for step, _ in steps[start:]]} on shard {shard_num} / {total_shards}")
+        self.texts_to_remove = texts_to_remove or {}
+        cache = StageCache(cache_dir)
+
+        if start > 0:
+            records = cache.get(*steps[start - 1])
+        elif input_step is not None:
+            records = cache.get(*input_step)
+        else:
+            records = [(None, record) for record in lines]
+
+        taps = {}
+        for step, key in steps[start:]:
+            if step == 'read':
+                records = [self.read(line) for _, line in records]
+            else:
+                method = getattr(self, step)
+                records = [(url, method(url, output)) for url, output in records]
+            if step in store:
+                cache.put(step, key, records)
+            if step in self.taps:
+                taps[step] = records
+        return records, taps
+
+    def read(self, record: str | bytes) -> tuple[str, Any]:
+        """Returns url and html (if the first stage is parse) or text_list of
+        the entry given by record."""
+        entry = load_record(record)
+        return entry['url'], entry['text'] if 'parse' in self.stages else entry['text_list']
+
+    def parse(self, url: str, html: str) -> list[str]:
+        """Parses html."""
+        return self.parser.parse(html)
+
+    def normalize(self, url: str, text_list: list[str]) -> list[str]:
+        """Normalizes texts, dropping texts shorter than len_cutoff."""
+        normalized_text_list = []
+        for text in text_list:
+            normalized_text = self.normalizer.normalize(text)
+            if len(normalized_text) >= self.len_cutoff:
+                normalized_text_list.append(normalized_text)
+        return normalized_text_list
+
+    def min_hash(self, url: str, text_list: list[str]) -> list[list[int]]:
+        """Returns MinHash signatures of texts (the part of the deduplicate
+        stage run before the barrier)."""
+        return [self.deduplicator.min_hash(text) for text in text_list]
+
+    def deduplicate(self, url: str, text_list: list[str]) -> list[str]:
+        """Replaces duplicate texts by "<DUPLICATE_REMOVED>"."""
+        text_list = list(text_list)
+        self.deduplicator.texts_to_remove_dict = self.texts_to_remove
+        self.deduplicator.remove_duplicates(url, text_list)
+        return text_list
+
+    def segment(self, url: str, text_list: list[str]) -> list[list[str]]:
+        """Segments texts into sentences."""
+        if self.omit_duplicates:
+            text_list = [text for text in text_list
+                         if text != "<DUPLICATE_REMOVED>"]
+        return self.segmenter.segment_batch(text_list)
+
+    def tokenize(self, url: str, text_list: list[list[str]]) -> str | tuple:
+        """Tokenizes sentences."""
+        return self.tokenizer.tokenize_sections(text_list, self.output_format)
+
+
+class StageCache:
+    """Class for caching the output of pipeline stages on disk.
+
+    The key of an output is a hash of the key of its input (for the input
+    shards, the hash of their content), the code version of the stage and the
+    stage parameters. A change to a stage thus changes the keys of its outputs
+    and, through them, the keys of all later outputs, while the outputs of the
+    earlier stages stay valid. Each output is a pickle file
+    {cache_dir}/{stage}/{key}.pkl."""
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = Path(cache_dir)
+
+    def key(self, stage: str, input_key: str, params: dict[str, Any]) -> str:
+        """Returns key of the output of stage on given input."""
+        data = json.dumps([stage, input_key, get_code_version(stage), params],
+                          sort_keys=True)
+        return get_hash(data.encode())
+
+    def path(self, stage: str, key: str) -> Path:
+        """Returns path of cached output."""
+        return self.cache_dir/stage/f'{key}.pkl'
+
+    def __contains__(self, step: tuple[str, str]) -> bool:
+        return self.path(*step).exists()
+
+    def get(self, stage: str, key: str) -> Any:
+        """Returns cached output."""
+        with open(self.path(stage, key), 'rb') as file:
+            return pickle.load(file)
+
+    def put(self, stage: str, key: str, output: Any) -> None:
+        """Caches output. It is written to a temporary file which is then
+        renamed, so an interrupted run never leaves a partial output."""
+        path = self.path(stage, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{key}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(output, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+# Multiprocessing functions
+
+def worker_init(config: dict[str, Any]) -> None:
+    """Initializes worker."""
+    global pipeline
+    pipeline = Pipeline(config)
+    process = current_process()
+    print(f'Initialized {process.name}')
+
+def worker(*args) -> tuple[list, dict[str, list]]:
+    """Runs steps on a shard (see Pipeline.run_shard)."""
+    results = pipeline.run_shard(*args)
+    flush_profile()
+    return results
+
+def worker_star(args: tuple) -> tuple[list, dict[str, list]]:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
+
+
+# Helper functions
+
+def get_stages(config: dict[str, Any]) -> list[str]:
+    """Returns the stages to run, in pipeline order."""
+    stages = config.get('stages') or list(STAGES)
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError(f'stages must be in {STAGES} but got {stage}')
+    if 'tokenize' in stages and stages[-1] != 'tokenize':
+        raise ValueError('tokenize must be the last stage')
+    return sorted(stages, key=STAGES.index)
+
+def get_taps(config: dict[str, Any]) -> dict[str, str]:
+    """Returns {stage: path} of the tapped stages, which must be run."""
+    stages = get_stages(config)
+    taps = {stage: get_path(path)
+            for stage, path in (config.get('taps') or {}).items() if path}
+    for stage in taps:
+        if stage not in stages:
+            raise ValueError(f'taps must be in the stages {stages} but got {stage}')
+    return taps
+
+def get_deduplicator(config: dict[str, Any]) -> Deduplicator:
+    """Returns Deduplicator for the deduplicate stage (without files)."""
+    return Deduplicator(None, None, **config['deduplicate'])
+
+def get_tokenizer(config: dict[str, Any]) -> tuple[Tokenizer, str]:
+    """Returns Tokenizer and output format for the tokenize stage."""
+    tokenize_config = dict(config['tokenize'])
+    output_format = tokenize_config.pop('output_format', 'jsonl')
+    tokenize_config['vocab_path'] = get_path(tokenize_config['vocab_path'])
+    if tokenize_config.get('merges_path'):
+        tokenize_config['merges_path'] = get_path(tokenize_config['merges_path'])
+    return Tokenizer(**tokenize_config), output_format
+
+def get_step_params(config: dict[str, Any], step: str) -> dict[str, Any]:
+    """Returns the parameters which the output of step depends on."""
+    if step == 'read':
+        return {'html': 'parse' in get_stages(config)}
+    if step == 'min_hash':
+        return {name: value for name, value in config['deduplicate'].items()
+                if name in MIN_HASH_PARAMS}
+    if step == 'duplicates':
+        return dict(config['deduplicate'])
+    if step in ('parse', 'deduplicate'):
+        return {}
+    params = dict(config.get(step) or {})
+    if step == 'tokenize':
+        # the tokens depend on the contents of the vocab and merges files
+        vocab_path = get_path(params['vocab_path'])
+        merges_path = get_path(params.get('merges_path') or get_merges_path(vocab_path))
+        params['vocab_hash'] = get_file_hash(vocab_path)
+        if os.path.exists(merges_path):
+            params['merges_hash'] = get_file_hash(merges_path)
+    return params
+
+@lru_cache(maxsize=None)
+def get_code_version(step: str) -> str:
+    """Returns hash of the source files of step."""
+    return get_hash(b''.join((ROOT/'src'/name).read_bytes()
+                             for name in ['pipeline.py', *STEP_SOURCES[step]]))
+
+def get_hash(data: bytes) -> str:
+    """Returns hex digest of 128-bit BLAKE2b hash of data."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def get_file_hash(path: str) -> str:
+    """Returns hash of the contents of file."""
+    with open(path, 'rb') as file:
+        return get_hash(file.read())
+
+def get_shards(records: Iterator[str | bytes], 
+               shard_lines: int) -> Iterator[list[str | bytes]]:
+    """Generator of shards, i.e. lists of shard_lines records."""
+    while shard := list(islice(records, shard_lines)):
+        yield shard
+
+def get_shard_hash(shard: list[str | bytes]) -> str:
+    """Returns hash of the raw records of shard."""
+    return get_hash(b''.join(record.encode() if isinstance(record, str) else record
+                             for record in shard))
+
+def get_path(path: str) -> str:
+    """Returns path, relative to the repo root unless it is absolute."""
+    return str(ROOT/path)
+
+def write_entry(file, url: str, text_list_json: str) -> None:
+    """Writes jsonl entry, given the json string of its text_list (same as
+    json.dump({'url': url, 'text_list': text_list}))."""
+    file.write(f'{{"url": {json.dumps(url)}, "text_list": {text_list_json}}}\n')
+
+
+# Main entry point
+
+def run_pipeline(config: dict[str, Any], pool: Optional[WorkerPool]=None) -> None:
+    """Runs the pipeline stages configured in config (the 'pipeline' section
+    of config/config.yaml) on the jsonl file config['input'], and writes the
+    output of the last stage to config['output'].
+
+    The input entries hold the html of an article ('text') if the first stage
+    is parse, and its list of texts ('text_list') otherwise, in a jsonl or
+    binary record file (see records.py). The output holds the texts of each
+    article, as jsonl or binary records (config['output_format'] 'rec'), or
+    for the tokenize stage its tokens (output_format 'jsonl') or binary shards
+    of token ids with prefix config['output'] (output_format 'bin').
+
+    The input is processed in shards of config['shard_lines'] records. If
+    config['cache_dir'] is given, the output of the stages on each shard is
+    cached there, and cached outputs are reused by later runs.
+
+    If a warm WorkerPool is given, its workers are used instead of processes
+    new ones, and they keep their stage objects between runs with the same
+    config."""
+    stages = get_stages(config)
+    inpath = get_path(config['input'])
+    outpath = get_path(config['output'])
+    processes = config.get('processes', 1)
+    shard_lines = config.get('shard_lines', 100)
+    cache_dir = config.get('cache_dir')
+    logger = Logger('pipeline')
+    logger.info(f"Started running {stages} on {inpath}")
+
+    # create the sentence cache once here, so that the workers only connect to it
+    if 'segment' in stages and config['segment'].get('cache_path'):
+        SentenceCache(get_path(config['segment']['cache_path']), namespace='').create()
+
+    # steps before and after the barrier
+    if 'deduplicate' in stages:
+        barrier = stages.index('deduplicate')
+        front_steps = ['read', *stages[:barrier], 'min_hash']
+        back_steps = stages[barrier:]
+        params = {step: get_step_params(config, step)
+                  for step in front_steps + back_steps + ['duplicates']}
+    else:
+        front_steps = ['read', *stages]
+        back_steps = []
+        params = {step: get_step_params(config, step) for step in front_steps}
+
+    # steps whose output is cached (the input of the back is always needed,
+    # unless it is the output of 'read', which the back reads again)
+    if cache_dir:
+        store = set(front_steps + back_steps) - {'read', 'deduplicate'}
+    else:
+        store = set()
+    if back_steps and front_steps[-2] != 'read':
+        store.add(front_steps[-2])
+
+    # output files
+    taps = {stage: open(path, 'w') for stage, path in get_taps(config).items()}
+    if stages[-1] == 'tokenize' and config['tokenize'].get('output_format') == 'bin':
+        tokenizer, _ = get_tokenizer(config)
+        # ids go up to unk_id = len(vocab)
+        writer = TokenShardWriter(outpath, tokenizer.unk_id + 1)
+        write_output = lambda url, output: writer.write(url, *output)
+    elif stages[-1] == 'tokenize':
+        writer = open(outpath, 'w')
+        write_output = lambda url, output: write_entry(writer, url, output)
+    else:
+        writer = RecordWriter(outpath, config.get('output_format', 'jsonl'))
+        write_output = lambda url, output: writer.write({'url': url, 'text_list': output})
+
+    def write_results(results: Iterator[tuple[list, dict[str, list]]]) -> Iterator[list]:
+        """Writes taps of results, and yields their outputs."""
+        for records, stage_taps in results:
+            for stage, stage_records in stage_taps.items():
+                for url, text_list in stage_records:
+                    write_entry(taps[stage], url, json.dumps(text_list))
+            yield records
+
+    with tempfile.TemporaryDirectory(dir=Path(outpath).parent) as tmp_dir:
+        cache = StageCache(get_path(cache_dir) if cache_dir else tmp_dir)
+
+        def get_steps(step_names: list[str], input_key: str) -> list[tuple[str, str]]:
+            """Returns (step, key) of steps, given the key of their input."""
+            steps = []
+            for step in step_names:
+                input_key = cache.key(step, input_key, params[step])
+                steps.append((step, input_key))
+            return steps
+
+        def get_start(steps: list[tuple[str, str]]) -> int:
+            """Returns the index of the first step to run: the step after the
+            last cached one, unless a tapped step comes before it. Then the
+            start moves back until the output of the previous step is cached
+            (the outputs of 'read' and 'deduplicate' never are), or to the
+            first step, whose input is the shard itself."""
+            start = 0
+            for i, step in enumerate(steps):
+                if step[0] in store and step in cache:
+                    start = i + 1
+            tapped = [i for i, (step, _) in enumerate(steps) if step in taps]
+            start = min([start, *tapped])
+            while start > 0 and not (steps[start - 1][0] in store and steps[start - 1] in cache):
+                start -= 1
+            return start
+
+        # keys of the steps of each shard, starting with the input content
+        shard_steps = [get_steps(front_steps, get_shard_hash(shard))
+                       for shard in get_shards(read_records(inpath), shard_lines)]
+        total_shards = len(shard_steps)
+
+        # duplicates in each shard, if already cached
+        duplicates = None
+        if back_steps:
+            duplicates_key = cache.key('duplicates',
+                                       ''.join(steps[-1][1] for steps in shard_steps),
+                                       params['duplicates'])
+            if cache_dir and ('duplicates', duplicates_key) in cache:
+                duplicates = cache.get('duplicates', duplicates_key)
+
+        def get_front_iterable() -> Iterator[tuple]:
+            """Generator of worker() arguments for the front. Skips shards
+            fully cached up to the barrier if the duplicates are cached."""
+            shards = get_shards(read_records(inpath), shard_lines)
+            for shard_num, (lines, steps) in enumerate(zip(shards, shard_steps), 1):
+                start = get_start(steps)
+                if back_steps and duplicates is not None and start == len(steps):
+                    continue
+                yield (shard_num, total_shards, str(cache.cache_dir),
+                       lines if start == 0 else None, None, steps, start, store, None)
+
+        def get_back_iterable() -> Iterator[tuple]:
+            """Generator of worker() arguments for the back. The input of each
+            shard is the cached output of the last front stage, or if that is
+            'read' (deduplicate is the first stage), the shard itself, which
+            is read again. Its duplicates determine the keys of the back 
+            steps."""
+            shards = get_shards(read_records(inpath), shard_lines)
+            for shard_num, (lines, front, shard_duplicates) in enumerate(zip(shards, shard_steps, duplicates), 1):
+                input_step = front[-2]
+                duplicates_hash = get_hash(json.dumps(shard_duplicates, sort_keys=True).encode())
+                steps = get_steps(back_steps, input_step[1] + duplicates_hash)
+                if input_step[0] == 'read':
+                    steps, input_step = [input_step, *steps], None
+                start = get_start(steps)
+                yield (shard_num, total_shards, str(cache.cache_dir),
+                       lines if input_step is None and start == 0 else None,
+                       input_step, steps, start, store, shard_duplicates)
+
+        # the workers only get the stage settings, so that those of a warm
+        # pool keep their stage objects when e.g. the input changes
+        worker_config = {key: config.get(key) for key in ('stages', 'taps', *STAGES)}
+        with get_pool(pool, processes, worker_init, (worker_config,)) as stage_pool:
+
+            # front stages (and MinHash)
+            results = write_results(stage_pool.imap(worker_star, get_front_iterable()))
+            if back_steps:
+                signatures = list(results)
+            else:
+                for records in results:
+                    for url, output in records:
+                        write_output(url, output)
+
+            # barrier: find duplicates, then back stages on the cached shards
+            if back_steps:
+                if duplicates is None:
+                    deduplicator = get_deduplicator(config)
+                    for records in signatures:
+                        deduplicator.min_hashes.update(records)
+                    deduplicator.find_duplicates()
+                    texts_to_remove = deduplicator.texts_to_remove_dict
+                    duplicates = [{url: sorted(texts_to_remove[url])
+                                   for url, _ in records if url in texts_to_remove}
+                                  for records in signatures]
+                    if cache_dir:
+                        cache.put('duplicates', duplicates_key, duplicates)
+                signatures = None
+
+                results = write_results(stage_pool.imap(worker_star, get_back_iterable()))
+                for records in results:
+                    for url, output in records:
+                        write_output(url, output)
+
+    writer.close()
+    for file in taps.values():
+        file.close()
+
+    logger.info(f"Finished running {stages} on {inpath}\n\n")
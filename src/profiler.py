@@ -0,0 +1,180 @@
+"""
+Core functionality for opt-in profiling of the stages.
+
+Profiling is enabled by setting the environment variable PIPELINE_PROFILE to a
+directory (e.g. `PIPELINE_PROFILE=log/profile python -m main parse`, or
+`python -m main --profile log/profile parse`), or by calling enable. Worker
+processes inherit the setting. When disabled, instrumented code runs
+unchanged: profiled returns the function itself, and profile returns a no-op
+context manager.
+
+The stages are instrumented with named blocks: the tree building and each
+format handler of the Parser, each handler of the Normalizer, the phases of the
+Deduplicator, and the steps of the BPE merge loop of the Vocab. Blocks nest, so
+each block is recorded with the stack of enclosing blocks, e.g.
+'parse;format_list;format_sup', and its self time (excluding nested blocks).
+
+Each process writes its stacks to a file in the profile directory at the end
+of each worker task (see flush_profile) and at exit. At exit, the main process
+merges the files of all processes into a single file profile.folded in
+collapsed-stack format, one line "stack microseconds" per stack, which can be
+rendered as a flamegraph (e.g. by flamegraph.pl or speedscope).
+
+Contains:
+  - enable: function enabling profiling in this process and its children.
+  - profile: function returning a context manager timing a block of code.
+  - profiled: function returning a function timed as a block.
+  - flush_profile: function writing the stacks of this process to file.
+  - merge_profiles: function merging the stack files of all processes.
+"""
+
+# Standard library
+import atexit
+import os
+import time
+from collections import defaultdict
+from functools import wraps
+from multiprocessing import parent_process
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+PROFILE_ENV = 'PIPELINE_PROFILE'
+MERGED_NAME = 'profile.folded'
+
+# profile directory (None if disabled), self time in ns of each stack of this
+# process, and the open blocks: [stack, start time, time of nested blocks]
+profile_dir = None
+stacks = defaultdict(int)
+frames = []
+file_name = None
+
+
+class Block:
+    """Context manager timing a named block."""
+    __slots__ = ('name',)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        stack = f'{frames[-1][0]};{self.name}' if frames else self.name
+        frames.append([stack, time.perf_counter_ns(), 0])
+
+    def __exit__(self, *exc) -> None:
+        stack, start, nested = frames.pop()
+        elapsed = time.perf_counter_ns() - start
+        stacks[stack] += elapsed - nested
+        if frames:
+            frames[-1][2] += elapsed
+
+
+class NullBlock:
+    """Context manager doing nothing, used when profiling is disabled."""
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+NULL_BLOCK = NullBlock()
+
+
+def enable(path: str) -> None:
+    """Enables profiling to directory path, in this process and in processes
+    started by it. Only objects created afterwards have profiled handlers. In
+    the main process, removes stack files left by earlier runs, and at exit
+    merges the stack files of all processes into path/profile.folded."""
+    global profile_dir, file_name
+    if profile_dir is not None:
+        return
+    profile_dir = Path(path)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    os.environ[PROFILE_ENV] = str(profile_dir)
+    file_name = get_file_name()
+    if parent_process() is None:
+        for stale_path in get_stack_paths(profile_dir):
+            stale_path.unlink()
+    atexit.register(finish)
+
+def profile(name: str) -> Block | NullBlock:
+    """Returns context manager timing the enclosed code as block name, if
+    profiling is enabled."""
+    return Block(name) if profile_dir is not None else NULL_BLOCK
+
+def profiled(func: Callable, name: Optional[str]=None) -> Callable:
+    """Returns func timed as block name (by default its __name__) if profiling
+    is enabled, and func itself otherwise."""
+    if profile_dir is None:
+        return func
+    block = Block(name or func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs) -> Any:
+        with block:
+            return func(*args, **kwargs)
+    return wrapper
+
+def flush_profile() -> None:
+    """Writes the stacks of this process to its file in the profile
+    directory (called by the workers at the end of each task, since pool
+    workers may be terminated without running exit handlers)."""
+    if profile_dir is None or not stacks:
+        return
+    path = profile_dir/file_name
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as file:
+        for stack, ns in stacks.items():
+            file.write(f'{stack} {ns // 1000}\n')
+    os.replace(tmp_path, path)
+
+def merge_profiles(path: str, outpath: Optional[str]=None) -> str:
+    """Merges the stack files of all processes in directory path into one
+    collapsed-stack file (by default path/profile.folded), summing the times
+    of equal stacks, and returns its path."""
+    merged = defaultdict(int)
+    for stack_path in get_stack_paths(Path(path)):
+        with open(stack_path, 'r') as file:
+            for line in file:
+                stack, us = line.rsplit(' ', 1)
+                merged[stack] += int(us)
+    outpath = outpath or str(Path(path)/MERGED_NAME)
+    with open(outpath, 'w') as file:
+        for stack in sorted(merged):
+            file.write(f'{stack} {merged[stack]}\n')
+    return outpath
+
+
+# Helper functions
+
+def finish() -> None:
+    """Writes the stacks of this process at exit, and in the main process
+    merges the stack files of all processes into profile.folded."""
+    flush_profile()
+    if parent_process() is None:
+        merge_profiles(str(profile_dir))
+        for stack_path in get_stack_paths(profile_dir):
+            stack_path.unlink()
+
+def get_file_name() -> str:
+    """Returns name of the stack file of this process."""
+    return f'{os.getpid()}-{time.time_ns()}.stacks'
+
+def get_stack_paths(path: Path) -> list[Path]:
+    """Returns paths of the stack files of all processes in directory path."""
+    return sorted(path.glob('*.stacks'))
+
+def reset_after_fork() -> None:
+    """Clears the stacks inherited by a forked child process, which writes
+    its own stack file."""
+    global file_name
+    stacks.clear()
+    frames.clear()
+    if profile_dir is not None:
+        file_name = get_file_name()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+if os.environ.get(PROFILE_ENV):
+    enable(os.environ[PROFILE_ENV])
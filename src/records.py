@@ -0,0 +1,228 @@
+"""
+Core functionality for reading and writing the article records passed between
+the stages of the pipeline.
+
+Each stage reads entries {'url': url, 'text_list': text_list} written by the
+previous stage, where text_list is a list of strings, or of lists of strings
+after segmentation (crawled entries hold the html as {'url': url, 'text':
+text} instead). Two record formats are available:
+  - 'jsonl': one json object per line.
+  - 'rec': length-prefixed binary records. The strings of an entry are
+    joined into a single utf-8 string heap, preceded by the lengths of the
+    nested lists, so that decoding an entry takes a single utf-8 decode and
+    split, instead of parsing and unescaping json.
+
+A 'rec' file starts with RECORDS_MAGIC, followed by the records. Each record
+is a uint32 byte length followed by the record itself (native byte order):
+  - header: uint8 depth (number of nested list levels of text_list, 0 for
+    'text'), bool separated, uint32 number of list lengths, uint32 number of
+    strings
+  - uint32 lengths of the lists, level by level, starting with text_list
+  - only if not separated: uint32 lengths of the strings in characters
+  - the string heap, utf-8 encoded: the url, then the texts, separated by
+    NUL characters if separated (i.e. unless a string contains NUL)
+
+Readers detect the format of a file from its first bytes, so every stage reads
+the output of the previous stage in either format. Writers write jsonl unless
+told otherwise, and convert_records exports a 'rec' file to jsonl.
+
+Contains:
+  - RecordWriter: class for writing entries to a file in either format.
+  - read_records: function yielding the raw records of a file.
+  - count_records: function counting the records of a file.
+  - batch_records: function grouping records into batches of about the same
+    size in bytes, to be sent to a worker as a single task.
+  - load_record: function decoding a raw record into an entry.
+  - convert_records: function converting a file to the given format.
+"""
+
+# Standard library
+import json
+import struct
+from array import array
+from itertools import accumulate, islice, pairwise
+from typing import Any, Iterable, Iterator
+
+RECORD_FORMATS = ('jsonl', 'rec')
+# default size of the batches of records sent to a worker in one task (see 
+# batch_records and scripts/run_batch_sweep.py)
+BATCH_BYTES = 256*1024
+RECORDS_MAGIC = b'RECORDS1'
+LENGTH = struct.Struct('=I')
+HEADER = struct.Struct('=B?II')
+SEPARATOR = '\x00'
+
+
+class RecordWriter:
+    """Class for writing entries to a file in either format."""
+    def __init__(self, path: str, record_format: str='jsonl') -> None:
+        if record_format not in RECORD_FORMATS:
+            raise ValueError(f'record_format must be one of {RECORD_FORMATS} but got {record_format}')
+        self.record_format = record_format
+        if record_format == 'rec':
+            self.file = open(path, 'wb')
+            self.file.write(RECORDS_MAGIC)
+        else:
+            self.file = open(path, 'w')
+
+    def __enter__(self) -> 'RecordWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, entry: dict[str, Any]) -> None:
+        """Writes entry."""
+        if self.record_format == 'rec':
+            record = encode_record(entry)
+            self.file.write(LENGTH.pack(len(record)))
+            self.file.write(record)
+        else:
+            # same as json.dump(entry, file)
+            self.file.write(json.dumps(entry) + '\n')
+
+    def write_record(self, record: str | bytes) -> None:
+        """Writes raw record, as yielded by read_records from a file of the
+        same format."""
+        if self.record_format == 'rec':
+            self.file.write(LENGTH.pack(len(record)))
+        self.file.write(record)
+
+    def close(self) -> None:
+        """Closes file."""
+        self.file.close()
+
+
+# Encoding and decoding of records
+
+def encode_record(entry: dict[str, Any]) -> bytes:
+    """Encodes entry with url and text, or url and (nested) text_list, into a
+    'rec' record. The lists of text_list must be nested to the same depth."""
+    lengths = array('I')
+    if 'text' in entry:
+        depth = 0
+        strings = [entry['text']]
+    else:
+        depth = 0
+        strings = [entry['text_list']]
+        while strings and isinstance(strings[0], list):
+            if not all(isinstance(items, list) for items in strings):
+                raise ValueError(f"text_list of {entry['url']} is not nested to the same depth")
+            lengths.extend(map(len, strings))
+            strings = [item for items in strings for item in items]
+            depth += 1
+    strings = [entry['url'], *strings]
+    heap = SEPARATOR.join(strings)
+    separated = heap.count(SEPARATOR) == len(strings) - 1
+    if separated:
+        string_lengths = array('I')
+    else:
+        string_lengths = array('I', map(len, strings))
+        heap = ''.join(strings)
+    return b''.join((HEADER.pack(depth, separated, len(lengths), len(strings)),
+                     lengths.tobytes(), string_lengths.tobytes(),
+                     heap.encode('utf-8', 'surrogatepass')))
+
+def decode_record(record: bytes) -> dict[str, Any]:
+    """Decodes 'rec' record into entry (reverses encode_record)."""
+    depth, separated, n_lengths, n_strings = HEADER.unpack_from(record)
+    pos = HEADER.size
+    lengths = array('I')
+    lengths.frombytes(record[pos:pos + 4*n_lengths])
+    pos += 4*n_lengths
+    if separated:
+        strings = record[pos:].decode('utf-8', 'surrogatepass').split(SEPARATOR)
+    else:
+        string_lengths = array('I')
+        string_lengths.frombytes(record[pos:pos + 4*n_strings])
+        heap = record[pos + 4*n_strings:].decode('utf-8', 'surrogatepass')
+        strings = [heap[start:end] for start, end in pairwise(accumulate(string_lengths, initial=0))]
+    url = strings[0]
+    if depth == 0:
+        return {'url': url, 'text': strings[1]}
+
+    # split list lengths into levels: each level holds the lengths of the
+    # lists making up the items of the previous level
+    levels = []
+    pos, size = 0, 1
+    for _ in range(depth):
+        levels.append(lengths[pos:pos + size])
+        pos += size
+        size = sum(levels[-1])
+
+    # nest strings from the innermost level out
+    items = strings[1:]
+    for level in reversed(levels):
+        items_iter = iter(items)
+        items = [list(islice(items_iter, length)) for length in level]
+    return {'url': url, 'text_list': items[0]}
+
+def load_record(record: str | bytes) -> dict[str, Any]:
+    """Decodes raw record yielded by read_records: a jsonl line (str) or a
+    'rec' record (bytes)."""
+    if isinstance(record, str):
+        return json.loads(record)
+    return decode_record(record)
+
+
+# Reading and converting files
+
+def get_record_format(path: str) -> str:
+    """Returns format of file, 'rec' if it starts with RECORDS_MAGIC, and
+    'jsonl' otherwise."""
+    with open(path, 'rb') as file:
+        magic = file.read(len(RECORDS_MAGIC))
+    return 'rec' if magic == RECORDS_MAGIC else 'jsonl'
+
+def read_records(path: str) -> Iterator[str | bytes]:
+    """Generator of the raw records of file in either format, to be decoded
+    with load_record (which can be done by the workers)."""
+    if get_record_format(path) == 'jsonl':
+        with open(path, 'r') as file:
+            yield from file
+        return
+    with open(path, 'rb') as file:
+        file.seek(len(RECORDS_MAGIC))
+        while prefix := file.read(LENGTH.size):
+            yield file.read(LENGTH.unpack(prefix)[0])
+
+def count_records(path: str) -> int:
+    """Returns number of records in file in either format."""
+    if get_record_format(path) == 'jsonl':
+        with open(path, 'r') as file:
+            return sum(1 for _ in file)
+    count = 0
+    with open(path, 'rb') as file:
+        file.seek(len(RECORDS_MAGIC))
+        while prefix := file.read(LENGTH.size):
+            file.seek(LENGTH.unpack(prefix)[0], 1)
+            count += 1
+    return count
+
+def batch_records(records: Iterable[str | bytes], 
+                  batch_bytes: int=BATCH_BYTES) -> Iterator[tuple[int, list[str | bytes]]]:
+    """Generator of (first_page_num, batch): lists of consecutive records, 
+    each holding records until their total size reaches batch_bytes, with the
+    (1-based) page number of their first record. Every batch holds at least 
+    one record, so batch_bytes=0 gives one record per batch. The size of a 
+    jsonl line is taken to be its number of characters."""
+    batch = []
+    size = 0
+    first_page_num = 1
+    for page_num, record in enumerate(records, 1):
+        batch.append(record)
+        size += len(record)
+        if size >= batch_bytes:
+            yield (first_page_num, batch)
+            batch = []
+            size = 0
+            first_page_num = page_num + 1
+    if batch:
+        yield (first_page_num, batch)
+
+def convert_records(inpath: str, outpath: str, record_format: str='jsonl') -> None:
+    """Converts file in either format to record_format, e.g. to export a 'rec'
+    file to jsonl."""
+    with RecordWriter(outpath, record_format) as writer:
+        for record in read_records(inpath):
+            writer.write(load_record(record))
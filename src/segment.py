@@ -4,81 +4,425 @@ Core functionality to segment text into sentences.
 Accurate sentence segmentation requires implementing many heuristics, e.g. to 
 handle abbrevitions properly. To avoid getting too sidetracked with this small 
 piece of the data preparation pipeline, I decided to use an external library 
-(spacy) to perform the sentence segmentation. I leave the implementation of a 
-sentence segmenter from scratch for a future project.
+(spacy) to perform the sentence segmentation.
+
+Only the spacy components needed for sentence boundaries are loaded, and the 
+sections of each article are processed in batches with nlp.pipe. Two modes are 
+available:
+  - 'parser' (default): boundaries come from the dependency parser, exactly as 
+    with the full en_core_web_sm pipeline. The tagger, attribute ruler, 
+    lemmatizer and NER components are excluded, since doc.sents does not 
+    depend on them.
+  - 'senter' (opt-in): boundaries come from the small statistical senter 
+    component, which is considerably faster than the parser but does not 
+    reproduce its boundaries exactly.
+
+Sentence boundaries can optionally be cached on disk (SentenceCache), keyed by 
+a hash of the section text, so that re-running the segmentation on mostly 
+unchanged input skips the NLP call for all unchanged sections.
+
+Alternatively a rule-based engine (RuleSegmenter) can be selected, which needs 
+no model and is much faster, at the cost of some accuracy. See 
+scripts/run_segment_eval.py for its agreement with spacy.
 
 Contains:
   - Segmenter: class for segmenting text into sentences.
+  - RuleSegmenter: class for rule-based segmentation of text into sentences.
+  - SentenceCache: class for caching sentence boundaries of texts on disk.
   - segment_jsonl: function for segmenting text stored in jsonl file. 
     Can utilize multiple processors.
+
+The input and output can also be binary record files, see records.py.
 """
 
 # Standard library
-import json
+import gc
+import hashlib
+import os
+import re
+import sqlite3
 import sys
-from multiprocessing import Pool, current_process
+import time
+from array import array
+from bisect import bisect_right
+from multiprocessing import current_process, get_context
 from pathlib import Path
-from typing import Iterator, TextIO
-
-# Third-party
-import spacy
+from typing import Iterator, Optional
 
 # Local
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.append(str(ROOT/'src'))
 from logger import Logger
+from records import BATCH_BYTES, RecordWriter, batch_records, count_records, load_record, read_records
+from workerpool import WorkerPool, get_pool
 
 
 class Segmenter:
     """Class for segmenting text into sentences."""
-    def __init__(self):
-        # spacy NLP object
-        self.nlp = spacy.load("en_core_web_sm")
+    ENGINES = ('spacy', 'rule')
+
+    # components excluded from en_core_web_sm in each mode
+    EXCLUDE = {
+        'parser': ["tagger", "attribute_ruler", "lemmatizer", "ner", "senter"],
+        'senter': ["tok2vec", "tagger", "parser", "attribute_ruler", 
+                   "lemmatizer", "ner"],
+    }
+
+    def __init__(self, 
+                 engine: str='spacy', 
+                 mode: str='parser', 
+                 batch_size: int=64,
+                 cache_path: Optional[str]=None) -> None:
+        if engine not in self.ENGINES:
+            raise ValueError(f'engine must be one of {self.ENGINES} but got {engine}')
+        if mode not in self.EXCLUDE:
+            raise ValueError(f'mode must be one of {list(self.EXCLUDE)} but got {mode}')
+        self.engine = engine
+        self.mode = mode
+        self.batch_size = batch_size
+
+        # spacy NLP object (spacy is only imported by the spacy engine, as
+        # importing it takes about a second)
+        if engine == 'rule':
+            self.nlp = None
+            self.rule_segmenter = RuleSegmenter()
+        else:
+            import spacy
+            if mode == 'senter':
+                # senter is disabled by default in en_core_web_sm
+                self.nlp = spacy.load("en_core_web_sm", 
+                                      exclude=self.EXCLUDE[mode], 
+                                      enable=["senter"])
+            else:
+                self.nlp = spacy.load("en_core_web_sm", exclude=self.EXCLUDE[mode])
+
+        # sentence boundary cache (boundaries depend on engine and mode)
+        namespace = engine if engine == 'rule' else f'{engine}-{mode}'
+        self.cache = SentenceCache(cache_path, namespace) if cache_path else None
 
         # Logger 
         self.logger = Logger('segment')
 
     def segment(self, text: str) -> list[str]:
-        doc = self.nlp(text)
-        return [str(sent) for sent in doc.sents]
+        """Segment text into sentences."""
+        return self.segment_batch([text])[0]
+
+    def segment_batch(self, texts: list[str]) -> list[list[str]]:
+        """Segment each text in texts into sentences. Sentence boundaries are 
+        looked up in the cache if there is one, and otherwise computed."""
+        if self.cache is None:
+            spans_list = self.segment_spans_batch(texts)
+        else:
+            spans_list = self.cache.get_many(texts)
+            misses = [i for i, spans in enumerate(spans_list) if spans is None]
+            if misses:
+                miss_texts = [texts[i] for i in misses]
+                miss_spans = self.segment_spans_batch(miss_texts)
+                for i, spans in zip(misses, miss_spans):
+                    spans_list[i] = spans
+                self.cache.put_many(miss_texts, miss_spans)
+
+        return [[text[start:end] for start, end in spans] 
+                for text, spans in zip(texts, spans_list)]
+
+    def segment_spans_batch(self, 
+                            texts: list[str]) -> list[list[tuple[int, int]]]:
+        """Return (start, end) character offsets of the sentences of each text 
+        in texts, using nlp.pipe for the spacy engine."""
+        if self.engine == 'rule':
+            return [self.rule_segmenter.segment_spans(text) for text in texts]
+        docs = self.nlp.pipe(texts, batch_size=self.batch_size)
+        return [[(sent.start_char, sent.end_char) for sent in doc.sents] 
+                for doc in docs]
+
+
+class RuleSegmenter:
+    """Class for rule-based segmentation of text into sentences.
+
+    A sentence ends at a run of terminal punctuation (plus closing quotes and 
+    brackets) which is followed by whitespace and a capitalized word, unless 
+    the punctuation belongs to an abbreviation, an initial or a numbered list 
+    marker. In addition each list item (lines starting with '•' or '1.') is a 
+    sentence of its own, and paragraph breaks end a sentence unless they follow 
+    a heading. No boundaries are placed inside $...$ or $$...$$ math.
+
+    Like spacy, whitespace between sentences that contains a newline is kept 
+    at the end of the previous sentence, other whitespace is dropped."""
+    # abbreviations followed by a capitalized word (abbreviations that are 
+    # usually followed by a number, e.g. 'No.' or 'pp.', need not be listed)
+    ABBREVIATIONS = set([
+        'Mr', 'Mrs', 'Ms', 'Dr', 'Prof', 'Sr', 'Jr', 'St', 'Mt', 'Ft', 'Rev', 
+        'Hon', 'Gen', 'Col', 'Lt', 'Capt', 'Sgt', 'Gov', 'Sen', 'Rep', 'Pres', 
+        'Vol', 'Vols', 'vol', 'ed', 'eds', 'Ed', 'Eds', 'trans', 'Fig', 'Figs', 
+        'Ch', 'Univ', 'Dept', 'Assn', 'Bros', 'vs', 'cf', 'al', 'ca', 'approx', 
+        'op', 'cit', 'ibid', 'Jan', 'Feb', 'Mar', 'Apr', 'Jun', 'Jul', 'Aug', 
+        'Sep', 'Sept', 'Oct', 'Nov', 'Dec', 'e.g', 'i.e', 'viz', 'resp',
+    ])
+
+    def __init__(self) -> None:
+        # terminal punctuation, closing quotes/brackets, then whitespace
+        self.end_re = re.compile(r'[.!?]+["\'\)\]]*(\s+)(?=\S)')
+        # characters that may start a sentence
+        self.start_re = re.compile(r'["\'\(\[]*[A-Z\u00C0-\u00DE#•$]')
+        # word preceding terminal punctuation (superscripts are stripped)
+        self.word_re = re.compile(r'(\S+?)(?:\^\S*)?[.!?]+["\'\)\]]*$')
+        # dotted acronyms, e.g. U.S. or Ph.D.
+        self.acronym_re = re.compile(r'(?:\w\.)+\w$')
+        # numbered list markers, e.g. "1." at the start of a line
+        self.number_marker_re = re.compile(r'[ \t]*\d+$')
+        # list items, paragraph breaks, and math
+        self.item_re = re.compile(r'\n[ \t]*(?=•|\d+\.\s)')
+        self.paragraph_re = re.compile(r'\n[ \t]*\n\s*(?=\S)')
+        self.math_re = re.compile(r'\$\$.*?\$\$|\$[^$\n]*\$', re.DOTALL)
+
+    def segment(self, text: str) -> list[str]:
+        """Segment text into sentences."""
+        return [text[start:end] for start, end in self.segment_spans(text)]
+
+    def segment_spans(self, text: str) -> list[tuple[int, int]]:
+        """Return (start, end) character offsets of the sentences in text."""
+        math_spans = [m.span() for m in self.math_re.finditer(text)]
+        math_starts = [start for start, _ in math_spans]
+        def in_math(idx: int) -> bool:
+            i = bisect_right(math_starts, idx) - 1
+            return i >= 0 and idx < math_spans[i][1]
+
+        # boundaries: start offsets of new sentences
+        boundaries = set()
+
+        # terminal punctuation
+        for m in self.end_re.finditer(text):
+            start = m.end()
+            if (self.start_re.match(text, start) 
+                and not in_math(m.start())
+                and not self.is_abbreviation(text, m.start(1))):
+                boundaries.add(start)
+
+        # list items: boundaries before and after each item
+        for m in self.item_re.finditer(text):
+            boundaries.add(self.skip_whitespace(text, m.end()))
+            line_end = text.find('\n', m.end())
+            if line_end != -1:
+                boundaries.add(self.skip_whitespace(text, line_end))
+
+        # paragraph breaks, except after headings
+        for m in self.paragraph_re.finditer(text):
+            line_start = text.rfind('\n', 0, m.start()) + 1
+            if (not text.startswith('#', line_start) 
+                and not in_math(m.start())):
+                boundaries.add(m.end())
+
+        # convert boundaries to spans
+        spans = []
+        start = self.skip_whitespace(text, 0)
+        for boundary in sorted(boundaries):
+            if boundary <= start or boundary >= len(text):
+                continue
+            end = boundary
+            gap_start = len(text[start:boundary].rstrip()) + start
+            if '\n' not in text[gap_start:boundary]:
+                end = gap_start
+            spans.append((start, end))
+            start = boundary
+        if start < len(text):
+            spans.append((start, len(text)))
+
+        return spans
+
+    def is_abbreviation(self, text: str, end: int) -> bool:
+        """Checks if the terminal punctuation before text[end] belongs to an 
+        abbreviation, an initial, or a numbered list marker."""
+        line_start = text.rfind('\n', 0, end) + 1
+        word_start = max(text.rfind(' ', line_start, end) + 1, line_start)
+        match = self.word_re.match(text, word_start, end)
+        if not match:
+            return False
+        if not text[match.end(1):end].startswith('.'):
+            return False  # only periods can belong to abbreviations
+
+        word = match.group(1).lstrip('"\'([')
+        return (word in self.ABBREVIATIONS
+                or (len(word) == 1 and word.isupper())
+                or bool(self.acronym_re.match(word))
+                or bool(self.number_marker_re.match(text, line_start, match.end(1))))
+
+    def skip_whitespace(self, text: str, idx: int) -> int:
+        """Returns index of first non-whitespace character at or after idx."""
+        while idx < len(text) and text[idx].isspace():
+            idx += 1
+        return idx
+
+class SentenceCache:
+    """Class for caching sentence boundaries of texts on disk.
+
+    Maps a hash of (namespace, text) to the sentence offsets of the text, 
+    stored as an array of uint32 (start, end) pairs, in an sqlite database. 
+    Each entry records when it was last used, so that the cache can be bounded 
+    in size by evicting the least recently used entries. The database can be 
+    shared by several processes, once it was created by create (in the parent
+    process, before the workers connect), which also switches it to WAL mode."""
+    # keys per query, below the limit on the number of sqlite parameters
+    QUERY_KEYS = 500
+    SCHEMA = """CREATE TABLE IF NOT EXISTS boundaries (
+        key BLOB PRIMARY KEY, spans BLOB, size INTEGER, last_used INTEGER)"""
+
+    def __init__(self, path: str, namespace: str) -> None:
+        self.path = path
+        self.namespace = namespace.encode()
+        self.pid = None
+        self.connection = None
+
+    def create(self) -> None:
+        """Creates the database (if it doesn't exist yet) in WAL mode, so that
+        workers can read and write it concurrently."""
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(self.SCHEMA)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def connect(self) -> sqlite3.Connection:
+        """Returns connection to the database, opening a new one if the 
+        current process doesn't have one yet (e.g. after a fork). Creates the 
+        table if it doesn't exist yet, e.g. if create wasn't called."""
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute(self.SCHEMA)
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def key(self, text: str) -> bytes:
+        """Returns cache key of text."""
+        digest = hashlib.blake2b(self.namespace, digest_size=16)
+        digest.update(b'\0' + text.encode('utf-8'))
+        return digest.digest()
+
+    def get_many(self, texts: list[str]) -> list[Optional[list[tuple[int, int]]]]:
+        """Returns cached sentence spans of each text, or None for texts which 
+        are not in the cache."""
+        connection = self.connect()
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), self.QUERY_KEYS):
+            chunk = keys[start:start + self.QUERY_KEYS]
+            rows = connection.execute(
+                f'SELECT key, spans FROM boundaries WHERE key IN ({",".join("?" * len(chunk))})', 
+                chunk).fetchall()
+            found.update(rows)
+
+        # mark hits as recently used
+        if found:
+            now = time.time_ns()
+            connection.executemany('UPDATE boundaries SET last_used = ? WHERE key = ?', 
+                                   [(now, key) for key in found])
+            connection.commit()
+
+        spans_list = []
+        for key in keys:
+            if key in found:
+                offsets = array('I', found[key])
+                spans_list.append(list(zip(offsets[::2], offsets[1::2])))
+            else:
+                spans_list.append(None)
+        return spans_list
+
+    def put_many(self, 
+                 texts: list[str], 
+                 spans_list: list[list[tuple[int, int]]]) -> None:
+        """Stores sentence spans of each text in the cache."""
+        connection = self.connect()
+        now = time.time_ns()
+        rows = []
+        for text, spans in zip(texts, spans_list):
+            blob = array('I', [offset for span in spans for offset in span]).tobytes()
+            rows.append((self.key(text), blob, 16 + len(blob), now))
+        connection.executemany('INSERT OR REPLACE INTO boundaries VALUES (?, ?, ?, ?)', rows)
+        connection.commit()
+
+    def evict(self, max_bytes: int) -> int:
+        """Evicts least recently used entries until the total size of the 
+        cached entries is at most max_bytes. Returns number of evicted entries."""
+        connection = self.connect()
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM boundaries').fetchone()[0]
+        evicted = 0
+        if total > max_bytes:
+            rows = connection.execute('SELECT key, size FROM boundaries ORDER BY last_used')
+            keys = []
+            for key, size in rows:
+                if total <= max_bytes:
+                    break
+                keys.append((key,))
+                total -= size
+            connection.executemany('DELETE FROM boundaries WHERE key = ?', keys)
+            connection.commit()
+            evicted = len(keys)
+        return evicted
+
 
 # Multiprocessing functions
 
-def get_iterable(file: TextIO, 
+# segmenter of the current process and its arguments, set by worker_init or 
+# preloaded by the parent process in segment_jsonl
+segmenter = None
+segmenter_args = None
+
+def get_iterable(records: Iterator[str | bytes], 
                  total_lines: int, 
-                 omit_duplicates: bool) -> Iterator[int, str, int, bool]:
-    """Generator of worker() arguments."""
-    for page_num, line in enumerate(file, 1):
-        yield (page_num, line, total_lines, omit_duplicates)
-
-def worker_init() -> None:
-    """Initializes worker."""
-    global segmenter
-    segmenter = Segmenter()
+                 omit_duplicates: bool, 
+                 batch_bytes: int) -> Iterator[tuple[int, list[str | bytes], int, bool]]:
+    """Generator of worker() arguments: batches of about batch_bytes of 
+    records (see batch_records), with the page number of their first record."""
+    for first_page_num, batch in batch_records(records, batch_bytes):
+        yield (first_page_num, batch, total_lines, omit_duplicates)
+
+def worker_init(engine: str, 
+                mode: str, 
+                batch_size: int, 
+                cache_path: Optional[str]) -> None:
+    """Initializes worker. 
+    
+    If the parent process preloaded a segmenter before forking (see 
+    segment_jsonl), or the worker (of a WorkerPool) already has a segmenter 
+    with the same arguments, the worker reuses it instead of loading its own 
+    model."""
+    global segmenter, segmenter_args
+    args = (engine, mode, batch_size, cache_path)
+    if segmenter is None or segmenter_args != args:
+        segmenter = Segmenter(*args)
+        segmenter_args = args
     process = current_process()
     print(f'Initialized {process.name}')
 
-def worker(page_num: int, 
-           line: str, 
+def worker(first_page_num: int, 
+           records: list[str | bytes], 
            total_lines: int, 
-           omit_duplicates: bool) -> tuple[str, list[list[str]]]:
-    """Segments texts in jsonl entry given by line."""
-    # read from line
-    entry = json.loads(line)
-    url = entry['url']
-    text_list = entry['text_list']
+           omit_duplicates: bool) -> list[tuple[str, list[list[str]]]]:
+    """Segments texts in the entries given by records."""
+    results = []
+    for page_num, record in enumerate(records, first_page_num):
+        # read from record
+        entry = load_record(record)
+        url = entry['url']
+        text_list = entry['text_list']
+
+        # log
+        segmenter.logger.info(f"Segmenting page {page_num} / {total_lines}: {url}")
 
-    # log
-    segmenter.logger.info(f"Segmenting page {page_num} / {total_lines}: {url}")
+        # segment
+        if omit_duplicates:
+            text_list = [text for text in text_list 
+                         if text != "<DUPLICATE_REMOVED>"]
+        segmented_text_list = segmenter.segment_batch(text_list)
+        results.append((url, segmented_text_list))
 
-    # segment
-    segmented_text_list = []
-    for text in text_list:
-        if omit_duplicates and text == "<DUPLICATE_REMOVED>":
-            continue
-        segmented_text_list.append(segmenter.segment(text))
+    return results
 
-    return url, segmented_text_list
+def worker_star(args: tuple[int, list[str | bytes], int, bool]) -> list[tuple[str, list[list[str]]]]:
+    """Calls worker() with unpacked args (for Pool.imap)."""
+    return worker(*args)
 
 
 # Main entry point
@@ -86,21 +430,70 @@ def worker(page_num: int,
 def segment_jsonl(inpath: str, 
                   outpath: str, 
                   processes: int, 
-                  omit_duplicates: bool=True) -> None:
-    """Segment text stored in .jsonl file into sentences"""
+                  omit_duplicates: bool=True,
+                  engine: str='spacy',
+                  mode: str='parser',
+                  batch_size: int=64,
+                  preload: bool=False,
+                  cache_path: Optional[str]=None,
+                  cache_max_bytes: int=1024*1024*1024, 
+                  output_format: str='jsonl', 
+                  pool: Optional[WorkerPool]=None, 
+                  batch_bytes: int=BATCH_BYTES) -> None:
+    """Segment text stored in .jsonl file into sentences. The output is 
+    written as jsonl or binary records (output_format 'rec'). Each worker 
+    task segments a batch of about batch_bytes of input records.
+
+    If cache_path is given, sentence boundaries are cached in an sqlite 
+    database at cache_path, which is bounded to cache_max_bytes by evicting 
+    the least recently used entries at the end of the run.
+    
+    If preload is True the segmenter (and its spacy model) is loaded once in 
+    the parent process before the workers are forked, so that all workers 
+    share the model weights copy-on-write instead of each loading a copy. 
+    This requires the 'fork' start method, i.e. a POSIX system. 
+
+    If a warm WorkerPool is given, its workers are used instead of processes 
+    new ones, and preload is ignored, since these workers keep their 
+    segmenter from one call to the next."""
+    global segmenter, segmenter_args
+
+    logger = Logger('segment')
+    logger.info(f"Started segmenting {inpath}")
+
+    # create the cache once here, so that the workers only connect to it
+    if cache_path:
+        SentenceCache(cache_path, namespace='').create()
+
+    preload = preload and pool is None
+    if preload:
+        logger.info(f"Preloading segmenter before forking workers")
+        segmenter = Segmenter(engine, mode, batch_size, cache_path)
+        segmenter_args = (engine, mode, batch_size, cache_path)
+        # move the model out of the garbage collector's generations, so that 
+        # collections in the workers don't touch (and copy) its pages
+        gc.freeze()
+        context = get_context('fork')
+    else:
+        context = get_context()
+
+    with RecordWriter(outpath, output_format) as writer:
+        total_lines = count_records(inpath)
 
-    segmenter = Segmenter()
-    segmenter.logger.info(f"Started segmenting {inpath}")
+        with get_pool(pool, processes, worker_init, 
+                      (engine, mode, batch_size, cache_path), context) as stage_pool:
+            iterable = get_iterable(read_records(inpath), total_lines, omit_duplicates, batch_bytes)
+            for results in stage_pool.imap(worker_star, iterable):
+                for url, text_list in results:
+                    writer.write({'url': url, 'text_list': text_list})
 
-    with open(inpath, 'r') as infile, open(outpath, 'w') as outfile:
-        total_lines = sum(1 for _ in infile)
-        infile.seek(0)
+    if preload:
+        gc.unfreeze()
+        segmenter = None
+        segmenter_args = None
 
-        with Pool(processes=processes, initializer=worker_init) as pool:
-            iterable = get_iterable(infile, total_lines, omit_duplicates)
-            for url, text_list in pool.starmap(worker, iterable):
-                entry = {'url': url, 'text_list': text_list}
-                json.dump(entry, outfile)
-                outfile.write('\n')
+    if cache_path:
+        evicted = SentenceCache(cache_path, namespace='').evict(cache_max_bytes)
+        logger.info(f"Evicted {evicted} entries from sentence cache {cache_path}")
 
-        segmenter.logger.info(f"Finished segmenting {inpath}")
+    logger.info(f"Finished segmenting {inpath}")
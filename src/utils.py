@@ -16,9 +16,8 @@ from collections import defaultdict
 from pathlib import Path
 from typing import Any, Callable
 
-# Third-party
-import matplotlib.pyplot as plt
-import numpy as np
+# Third-party (matplotlib and numpy are only imported by the functions using 
+# them, so that loading a config doesn't pay for importing them)
 import yaml
 
 
@@ -45,6 +44,8 @@ def get_jsonl_len_stats(path: str) -> dict[str, float]:
       - std dev of number of characters per paragraph
     """
 
+    import numpy as np
+
     pars_per_article = []
     chars_per_par = []
     stats = {}
@@ -65,6 +66,8 @@ def get_jsonl_len_stats(path: str) -> dict[str, float]:
 
 def plot_len_frequencies(path: str, plot_title) -> None:
     """Plot text length vs frequency for file given by specified path."""
+    import matplotlib.pyplot as plt
+
     with open(path, 'r') as file:
         len_counter = defaultdict(int)
         for line in file:
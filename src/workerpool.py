@@ -0,0 +1,117 @@
+"""
+Core functionality for a warm pool of worker processes shared by all stages.
+
+Each *_jsonl function creates its own multiprocessing Pool, whose workers are
+initialized by the worker_init function of the stage (creating e.g. a Parser
+or loading the spacy model of a Segmenter). When several stages or files are
+processed one after another, processes are started and stages initialized
+again for every call. A WorkerPool instead keeps its processes alive, and can
+be passed to the *_jsonl functions (and run_pipeline) with pool=...:
+  - The workers start without any stage state. The state of a stage is
+    initialized lazily, by calling the stage's worker_init in a worker the
+    first time that worker gets a task of the stage.
+  - The state is kept for later tasks, also of later calls, as long as the
+    worker_init arguments stay the same. Otherwise worker_init is called again
+    with the new arguments, replacing the state.
+So after the first job, starting a job takes milliseconds instead of seconds.
+
+Contains:
+  - WorkerPool: class for a long-lived pool of worker processes.
+  - StagePool: class for submitting tasks of one stage to a WorkerPool.
+  - get_pool: function returning a StagePool of a WorkerPool, or a new Pool.
+"""
+
+# Standard library
+import multiprocessing
+import multiprocessing.pool
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+# worker_init arguments of the stages initialized in the current (worker)
+# process, by module and name of worker_init
+initialized = {}
+
+
+class WorkerPool:
+    """Class for a long-lived pool of worker processes, accepting tasks of any
+    stage (see StagePool)."""
+    def __init__(self, processes: Optional[int]=None, context: Any=None) -> None:
+        self.processes = processes
+        self.pool = (context or multiprocessing).Pool(processes=processes)
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def stage(self, initializer: Callable, initargs: tuple=()) -> 'StagePool':
+        """Returns StagePool for tasks of the stage initialized by
+        initializer(*initargs)."""
+        return StagePool(self, initializer, initargs)
+
+    def close(self) -> None:
+        """Stops the worker processes once all tasks are done."""
+        self.pool.close()
+        self.pool.join()
+
+
+class StagePool:
+    """Class for submitting tasks of one stage to a WorkerPool, with the same
+    interface as the methods of multiprocessing.Pool used by the stages.
+    Closing it (e.g. leaving a with block) leaves the WorkerPool running."""
+    def __init__(self, 
+                 worker_pool: WorkerPool, 
+                 initializer: Callable, 
+                 initargs: tuple) -> None:
+        self.worker_pool = worker_pool
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+
+    def __enter__(self) -> 'StagePool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def starmap(self, func: Callable, iterable: Iterable[tuple]) -> list:
+        """Returns [func(*args) for args in iterable], computed by the
+        workers (like Pool.starmap)."""
+        tasks = [(self.initializer, self.initargs, func, args) for args in iterable]
+        return self.worker_pool.pool.map(run_task, tasks)
+
+    def imap(self, func: Callable, iterable: Iterable) -> Iterator:
+        """Generator of func(arg) for arg in iterable, computed by the workers
+        (like Pool.imap)."""
+        tasks = ((self.initializer, self.initargs, func, (arg,)) for arg in iterable)
+        return self.worker_pool.pool.imap(run_task, tasks)
+
+
+# Multiprocessing functions
+
+def run_task(task: tuple[Callable, tuple, Callable, tuple]) -> Any:
+    """Runs task (initializer, initargs, func, args) in a worker: calls
+    initializer(*initargs) unless the stage was already initialized with
+    initargs in this process, then returns func(*args)."""
+    initializer, initargs, func, args = task
+    name = f'{initializer.__module__}.{initializer.__qualname__}'
+    if name not in initialized or initialized[name] != initargs:
+        initializer(*initargs)
+        initialized[name] = initargs
+    return func(*args)
+
+
+# Helper functions
+
+def get_pool(pool: Optional[WorkerPool], 
+             processes: int, 
+             initializer: Callable, 
+             initargs: tuple=(), 
+             context: Any=None) -> StagePool | multiprocessing.pool.Pool:
+    """Returns StagePool of pool for the stage initialized by
+    initializer(*initargs), or if pool is None a new multiprocessing Pool of
+    processes workers (of the given multiprocessing context)."""
+    if pool is not None:
+        return pool.stage(initializer, initargs)
+    return (context or multiprocessing).Pool(processes=processes,
+                                              initializer=initializer,
+                                              initargs=initargs)
@@ -0,0 +1,369 @@
+"""
+Core functionality to run a stage sharded across several machines.
+
+The *_jsonl functions only scale to the processors of one machine. To spread a
+stage across machines, its input is split into shards, which are processed
+independently by nodes on any host that can access a shared file system:
+  1. create_job: splits the input into shards in the job directory, and
+     writes the manifest (stage, parameters, shards) and the work table.
+  2. run_node: claims a shard, runs the stage on it (with the processes of
+     its own machine) and commits the output, until all shards are done.
+     Any number of nodes can run at the same time, on any host.
+  3. merge_outputs: concatenates the outputs of the shards in order.
+
+Nodes coordinate through WorkQueue, an sqlite work table in the job
+directory. A node claims a shard by taking a lease on it, which it renews
+while the shard is processed. If a node dies, its lease expires and the shard
+is claimed again by another node. Outputs are written to a temporary
+directory and committed by renaming it, so a shard's output is either
+complete or absent, even if two nodes end up processing the same shard. A
+shard which fails max_attempts times is marked as failed.
+
+The stages which can be sharded are those which process each article on its
+own: parse, normalize, segment and tokenize. Deduplication and the word
+frequency dict need all articles at once.
+
+Job directory layout:
+  - manifest.json: stage, parameters, output file name and shards
+  - queue.sqlite: work table
+  - shards/{shard:05d}.{jsonl,rec}: input shards, in the format of the input
+  - out/{shard:05d}/{output}: committed outputs
+
+Contains:
+  - WorkQueue: class for the work table of a sharded job.
+  - create_job: function splitting a stage's input into a sharded job.
+  - run_node: function processing shards of a job until all are done.
+  - run_local: function running several nodes on the local machine.
+  - merge_outputs: function concatenating the outputs of a job.
+"""
+
+# Standard library
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from multiprocessing import Process
+from pathlib import Path
+from typing import Any, Optional
+
+# Local
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT/'src'))
+from logger import Logger
+from bpe_tokenize import tokenize_jsonl
+from normalize import normalize_jsonl
+from parse import parse_jsonl
+from records import RecordWriter, count_records, get_record_format, read_records
+from segment import segment_jsonl
+from workerpool import WorkerPool
+
+# Stage functions, called as function(inpath, outpath, **params)
+STAGE_FUNCTIONS = {
+    'parse': parse_jsonl,
+    'normalize': normalize_jsonl,
+    'segment': segment_jsonl,
+    'tokenize': tokenize_jsonl,
+}
+
+
+class WorkQueue:
+    """Class for the work table of a sharded job.
+
+    Each shard is 'pending', 'leased' (by owner until lease_expires), 'done'
+    or 'failed'. A lease is identified by its owner and attempt, so that a
+    node whose lease expired cannot change the shard, even if it was claimed
+    again under the same owner name. All changes are made in immediate transactions, which lock
+    the database, so that a shard is never claimed by two nodes at once.
+
+    The database is opened in sqlite's default rollback journal mode (WAL
+    mode requires shared memory, i.e. a single host), so the shared file
+    system must support POSIX file locks, as e.g. NFSv4 does. A new
+    connection is opened for each operation, so a WorkQueue can be used from
+    several threads and processes."""
+    def __init__(self, path: str, max_attempts: int=3) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+
+    def connect(self) -> sqlite3.Connection:
+        """Returns new connection to the database, in autocommit mode (i.e.
+        transactions are begun explicitly)."""
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute("""CREATE TABLE IF NOT EXISTS shards (
+            shard INTEGER PRIMARY KEY, state TEXT, owner TEXT,
+            lease_expires REAL, attempts INTEGER)""")
+        return connection
+
+    def create(self, num_shards: int) -> None:
+        """Adds shards 0, ..., num_shards - 1 as pending."""
+        connection = self.connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany("INSERT INTO shards VALUES (?, 'pending', NULL, NULL, 0)",
+                                   [(shard,) for shard in range(num_shards)])
+        connection.close()
+
+    def claim(self, owner: str, lease_seconds: float) -> Optional[tuple[int, int]]:
+        """Leases a pending shard, or a shard whose lease has expired, to
+        owner. Returns the shard and the attempt of the lease, or None if no 
+        shard can be claimed. Shards whose lease expired after max_attempts 
+        attempts are marked as failed."""
+        connection = self.connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            connection.execute("""UPDATE shards SET state = 'failed', owner = NULL
+                WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                (now, self.max_attempts))
+            row = connection.execute("""SELECT shard, attempts + 1 FROM shards WHERE state = 'pending'
+                OR (state = 'leased' AND lease_expires < ?) ORDER BY shard LIMIT 1""",
+                (now,)).fetchone()
+            if row is not None:
+                connection.execute("""UPDATE shards SET state = 'leased', owner = ?,
+                    lease_expires = ?, attempts = attempts + 1 WHERE shard = ?""",
+                    (owner, now + lease_seconds, row[0]))
+        connection.close()
+        return None if row is None else tuple(row)
+
+    def renew(self, shard: int, owner: str, attempt: int, lease_seconds: float) -> bool:
+        """Extends the lease of owner on shard. Returns False if owner lost the
+        lease (because it expired and the shard was claimed again)."""
+        connection = self.connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            cursor = connection.execute("""UPDATE shards SET lease_expires = ?
+                WHERE shard = ? AND state = 'leased' AND owner = ? AND attempts = ?""",
+                (time.time() + lease_seconds, shard, owner, attempt))
+        connection.close()
+        return cursor.rowcount == 1
+
+    def complete(self, shard: int, owner: str, attempt: int) -> bool:
+        """Marks shard as done, once its output is committed by owner. Returns
+        False if owner lost the lease (because it expired and the shard was
+        claimed again, or marked as failed), leaving the shard unchanged."""
+        connection = self.connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            cursor = connection.execute("""UPDATE shards SET state = 'done', owner = NULL
+                WHERE shard = ? AND state = 'leased' AND owner = ? AND attempts = ?""",
+                (shard, owner, attempt))
+        connection.close()
+        return cursor.rowcount == 1
+
+    def release(self, shard: int, owner: str, attempt: int) -> None:
+        """Releases the lease of owner on shard after a failure, marking the
+        shard as pending again, or as failed after max_attempts attempts."""
+        connection = self.connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute("""UPDATE shards SET owner = NULL, lease_expires = NULL,
+                state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END
+                WHERE shard = ? AND state = 'leased' AND owner = ? AND attempts = ?""",
+                (self.max_attempts, shard, owner, attempt))
+        connection.close()
+
+    def counts(self) -> dict[str, int]:
+        """Returns number of shards in each state."""
+        connection = self.connect()
+        rows = connection.execute('SELECT state, COUNT(*) FROM shards GROUP BY state').fetchall()
+        connection.close()
+        return dict(rows)
+
+
+# Jobs
+
+def create_job(job_dir: str, 
+               stage: str, 
+               inpath: str, 
+               output: str, 
+               num_shards: int, 
+               params: Optional[dict[str, Any]]=None, 
+               max_attempts: int=3) -> None:
+    """Splits the input of stage (a jsonl or record file) into num_shards
+    shards of consecutive articles in job_dir, and creates the manifest and
+    work table of the job. The stage is run with the parameters params (see
+    STAGE_FUNCTIONS), writing the output of each shard to a file named
+    output."""
+    if stage not in STAGE_FUNCTIONS:
+        raise ValueError(f'stage must be one of {tuple(STAGE_FUNCTIONS)} but got {stage}')
+    logger = Logger('workqueue')
+    logger.info(f"Creating job {job_dir} for stage {stage} on {inpath}")
+
+    job_dir = Path(job_dir)
+    (job_dir/'shards').mkdir(parents=True)
+    (job_dir/'out').mkdir()
+    (job_dir/'tmp').mkdir()
+
+    # split input
+    record_format = get_record_format(inpath)
+    total_lines = count_records(inpath)
+    records = read_records(inpath)
+    shards = []
+    for shard in range(num_shards):
+        # shards differ in size by at most one article
+        size = total_lines // num_shards + (shard < total_lines % num_shards)
+        name = f'shards/{shard:05d}.{record_format}'
+        with RecordWriter(str(job_dir/name), record_format) as writer:
+            for _ in range(size):
+                writer.write_record(next(records))
+        shards.append({'shard': shard, 'input': name, 'records': size})
+
+    # manifest (paths are relative to job_dir, which may be mounted at
+    # different paths on different hosts)
+    manifest = {
+        'stage': stage,
+        'input': str(inpath),
+        'output': output,
+        'params': params or {},
+        'max_attempts': max_attempts,
+        'shards': shards,
+    }
+    with open(job_dir/'manifest.json.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    WorkQueue(str(job_dir/'queue.sqlite'), max_attempts).create(num_shards)
+    os.replace(job_dir/'manifest.json.tmp', job_dir/'manifest.json')
+
+    logger.info(f"Created job {job_dir} with {num_shards} shards of {total_lines} articles")
+
+def load_manifest(job_dir: str) -> dict[str, Any]:
+    """Returns manifest of job."""
+    with open(Path(job_dir)/'manifest.json', 'r') as f:
+        return json.load(f)
+
+def run_node(job_dir: str, 
+             owner: Optional[str]=None, 
+             lease_seconds: float=600, 
+             poll_seconds: float=10) -> int:
+    """Claims and processes shards of the job in job_dir until all shards are
+    done or failed, and returns the number of shards processed.
+
+    While other nodes hold leases, the node polls every poll_seconds, so that
+    it picks up shards whose lease expires. The lease is renewed every
+    lease_seconds / 3 while a shard is processed, so lease_seconds only bounds
+    how long the shard of a dead node waits to be retried.
+
+    All shards are processed by the same warm WorkerPool, with the number of
+    processes given by the stage parameters, so the stage is only initialized
+    once per node."""
+    job_dir = Path(job_dir)
+    owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+    manifest = load_manifest(str(job_dir))
+    function = STAGE_FUNCTIONS[manifest['stage']]
+    queue = WorkQueue(str(job_dir/'queue.sqlite'), manifest['max_attempts'])
+    logger = Logger('workqueue')
+    logger.info(f"Started node {owner} on job {job_dir}")
+
+    processed = 0
+    with WorkerPool(manifest['params'].get('processes')) as pool:
+        while True:
+            lease = queue.claim(owner, lease_seconds)
+            if lease is None:
+                counts = queue.counts()
+                if counts.get('pending', 0) + counts.get('leased', 0) == 0:
+                    break
+                time.sleep(poll_seconds)
+                continue
+            shard, attempt = lease
+
+            logger.info(f"Node {owner} processing shard {shard} / {len(manifest['shards'])}")
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=renew_lease, 
+                                         args=(queue, shard, owner, attempt, lease_seconds, stop))
+            heartbeat.start()
+            try:
+                commit = process_shard(job_dir, manifest, shard, owner, function, pool)
+            except Exception as e:
+                logger.info(f"Node {owner} failed on shard {shard}: {e!r}", exc_info=True)
+                stop.set()
+                heartbeat.join()
+                queue.release(shard, owner, attempt)
+                continue
+            stop.set()
+            heartbeat.join()
+            if not queue.complete(shard, owner, attempt):
+                # the output is committed, but the shard is another node's now
+                logger.info(f"Node {owner} lost lease on shard {shard}, not marking it as done")
+                continue
+            processed += 1
+            logger.info(f"Node {owner} {'committed' if commit else 'discarded'} output of shard {shard}")
+
+    logger.info(f"Finished node {owner} on job {job_dir}: processed {processed} shards, {queue.counts()}")
+    return processed
+
+def renew_lease(queue: WorkQueue, 
+                shard: int, 
+                owner: str, 
+                attempt: int, 
+                lease_seconds: float, 
+                stop: threading.Event) -> None:
+    """Renews lease of owner on shard every lease_seconds / 3 until stop is
+    set (run in a heartbeat thread)."""
+    while not stop.wait(lease_seconds / 3):
+        if not queue.renew(shard, owner, attempt, lease_seconds):
+            Logger('workqueue').info(f"Node {owner} lost lease on shard {shard}")
+            return
+
+def process_shard(job_dir: Path, 
+                  manifest: dict[str, Any], 
+                  shard: int, 
+                  owner: str, 
+                  function, 
+                  pool: Optional[WorkerPool]=None) -> bool:
+    """Runs the stage on shard (with the workers of pool), writing to a temporary directory which is
+    then renamed to out/{shard:05d}. Returns False if the output had already
+    been committed (by a node whose lease expired) and was discarded."""
+    tmp_dir = job_dir/'tmp'/f'{shard:05d}.{owner.replace("/", "_")}'
+    out_dir = job_dir/'out'/f'{shard:05d}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+
+    inpath = str(job_dir/manifest['shards'][shard]['input'])
+    function(inpath, str(tmp_dir/manifest['output']), **manifest['params'], pool=pool)
+
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        if not out_dir.is_dir():
+            raise
+        # committed by another node, with the same output
+        shutil.rmtree(tmp_dir)
+        return False
+    return True
+
+def run_local(job_dir: str, 
+              nodes: int, 
+              lease_seconds: float=600, 
+              poll_seconds: float=1) -> None:
+    """Runs nodes on the job in job_dir in separate processes of the local
+    machine, e.g. for testing."""
+    processes = [Process(target=run_node,
+                         args=(job_dir, f'{socket.gethostname()}:node{node}',
+                               lease_seconds, poll_seconds))
+                 for node in range(nodes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def merge_outputs(job_dir: str, outpath: str) -> None:
+    """Concatenates the outputs of all shards of the job in job_dir, in order
+    of the shards, into outpath (in the format of the outputs). Outputs which
+    are not jsonl or record files, i.e. binary token shards, are not merged
+    but can be used from the out directory."""
+    job_dir = Path(job_dir)
+    manifest = load_manifest(str(job_dir))
+    counts = WorkQueue(str(job_dir/'queue.sqlite')).counts()
+    if set(counts) != {'done'}:
+        raise ValueError(f'all shards of job {job_dir} must be done but got {counts}')
+    if manifest['params'].get('output_format') == 'bin':
+        raise ValueError('outputs with output_format bin are binary token shards and cannot be merged')
+
+    paths = [str(job_dir/'out'/f'{shard["shard"]:05d}'/manifest['output'])
+             for shard in manifest['shards']]
+    with RecordWriter(outpath, get_record_format(paths[0])) as writer:
+        for path in paths:
+            for record in read_records(path):
+                writer.write_record(record)